@@ -8,31 +8,149 @@ import network
 import os
 import time
 import uasyncio as asyncio
+import uhashlib
 import ujson
+import ustruct as struct
 import uselect as select
 import usocket as socket
 
+from array import array
 from machine import I2C
+from machine import PWM
 from machine import Pin
 from machine import WDT
+from machine import lightsleep
 from machine import unique_id
 from machine import reset
 from ubinascii import hexlify
-from umqtt.robust import MQTTClient
 
 import logging
 import bme280
+import psychro
 
 import wificonfig as wc
 
-logging.basicConfig(level=logging.DEBUG)
+LOG_RING = 64  # Number of log records kept in memory
+
+logging.basicConfig(level=getattr(wc, 'LOG_LEVEL', logging.INFO), ring=LOG_RING)
 LOG = logging.getLogger(wc.SNAME)
 
 SAMPLING = 120.0
 STATE_FILE = "/tmp/state.json"
 TEMPERATURE_THRESHOLD = 22.0
+HYSTERESIS = 0.0   # Degrees below the threshold before the fan stops
+# Humidity mode: the fan also runs when the air is within DEW_SPREAD
+# degrees of its dew point, until the spread grows by DEW_HYSTERESIS.
+DEW_SPREAD = 3.0
+DEW_HYSTERESIS = 1.0
+
+# BME280 measurement profiles. The fan logic only needs the temperature,
+# 'weather' keeps the filtered high resolution pressure in normal mode, the
+# others take a single forced measurement per reading.
+SENSOR_PROFILES = {
+  'control': {'osr_t': bme280.BME280_OVERSAMPLING_2X, 'osr_h': bme280.BME280_OVERSAMPLING_1X,
+              'osr_p': bme280.BME280_OVERSAMPLING_1X, 'filter': bme280.BME280_FILTER_COEFF_OFF,
+              'mode': bme280.BME280_FORCED_MODE},
+  'weather': {'osr_t': bme280.BME280_OVERSAMPLING_2X, 'osr_h': bme280.BME280_OVERSAMPLING_1X,
+              'osr_p': bme280.BME280_OVERSAMPLING_16X, 'filter': bme280.BME280_FILTER_COEFF_16,
+              'standby_time': bme280.BME280_STANDBY_TIME_500_MS,
+              'mode': bme280.BME280_NORMAL_MODE},
+  'low-power': {'osr_t': bme280.BME280_OVERSAMPLING_1X, 'osr_h': bme280.BME280_OVERSAMPLING_1X,
+                'osr_p': bme280.BME280_OVERSAMPLING_1X, 'filter': bme280.BME280_FILTER_COEFF_OFF,
+                'mode': bme280.BME280_FORCED_MODE},
+}
+SENSOR_PROFILE = getattr(wc, 'SENSOR_PROFILE', 'control')
+# Adaptive sampling: read fast near the threshold or when the temperature
+# moves, slowly when it's stable.
+SENSOR_FAST = 15     # Seconds
+SENSOR_SLOW = 60    # Seconds
+SENSOR_NEAR = 1.0   # Degrees from the threshold
+SENSOR_RATE = 0.2   # Degrees per minute
+# Sensor health: attempts per reading, seconds before retrying a failed
+# reading and before the data is stale. The fan falls back to
+# SENSOR_FAILSAFE (on or off) while the data is stale.
+SENSOR_RETRIES = 3
+SENSOR_RETRY = 15
+SENSOR_STALE = 180
+SENSOR_FAILSAFE = getattr(wc, 'SENSOR_FAILSAFE', False)
+# Plausible BME280 readings, and the largest temperature jump accepted
+# without confirmation: SENSOR_SPIKE degrees plus SENSOR_SLEW per minute
+SENSOR_LIMITS = {'temperature': (-40, 85), 'humidity': (0, 100), 'pressure': (300, 1100)}
+SENSOR_SPIKE = 2.0
+SENSOR_SLEW = 1.0
+
+I2C_SCL = 5
+I2C_SDA = 4
+I2C_FREQ = 400000
+
+# Fan zones: the name used in the URLs, MQTT feeds and state file, the
+# relay pin and the I2C address of the zone's BME280 (0x76 or 0x77). The
+# first zone also answers on the original /api/v1 paths and MQTT feeds.
+ZONES_CONFIG = getattr(wc, 'ZONES', [{'name': 'attic', 'pin': 15, 'address': 0x76}])
+
+# Range of the numeric settings accepted by POST /api/v1/config
+CONFIG_LIMITS = {
+  'threshold': (0, 50),
+  'hysteresis': (0, 5),
+  'sampling': (10, 3600),
+  'dew_spread': (0, 20),
+}
+
+# Variable speed (PWM) fan. The curve maps the number of degrees above the
+# threshold to a duty cycle between 0.0 and 1.0.
+FAN_PWM = getattr(wc, 'FAN_PWM', False)
+FAN_CURVE = getattr(wc, 'FAN_CURVE', ((0.0, 0.3), (2.0, 0.5), (5.0, 1.0)))
+FAN_RAMP = getattr(wc, 'FAN_RAMP', 0.05)  # Max duty change per second
+PWM_FREQ = getattr(wc, 'PWM_FREQ', 1000)
+
+TZ_OFFSET = getattr(wc, 'TZ_OFFSET', 0)  # Hours from UTC
+NTP_RETRY = 60          # Seconds before retrying a failed clock synchronization
+NTP_RESYNC = 6 * 3600   # Seconds between two synchronizations, the RTC drifts
+FAN_WATTS = getattr(wc, 'FAN_WATTS', 0)
+COUNTERS_SAVE = 900  # Save the fan counters every 15 minutes
+MAX_BODY = 2048
+HTTP_PORT = getattr(wc, 'HTTP_PORT', 80)
+MAX_CONNECTIONS = 4     # Concurrent HTTP clients
+READ_TIMEOUT = 2000     # ms to receive a header line or an upload chunk
+REQUEST_TIMEOUT = 5000  # ms to read and answer a request
+
+# /api/v1/sensors.bin record, little endian: version, unix time of the
+# reading, temperature (0.01 C), humidity (0.01 %), pressure (Pa),
+# fan flags (bits 0-2 mode, bit 7 running), duty cycle (%), dew point
+# (0.01 C) and absolute humidity (0.01 g/m3).
+SENSORS_FMT = '<BIhHIBBhH'
+SENSORS_VERSION = 2
+UNIX_OFFSET = 946684800 if time.localtime(0)[0] == 2000 else 0
+
+BOOT_PIN = getattr(wc, 'BOOT_PIN', 0)  # BOOT button on most ESP32 boards
+WIFI_TIMEOUT = 20       # Seconds to wait for the association
+WIFI_BACKOFF_MAX = 300  # Max seconds between two connection attempts
+WIFI_CHECK = 5          # Seconds between two link checks
+
+WDT_TIMEOUT = 15        # Seconds
+TASK_DEADLINE = 10      # Seconds a critical task can go without checking in
+
+# Opt-in light sleep while the fan is off and no HTTP client is connected.
+LOW_POWER = getattr(wc, 'LOW_POWER', False)
+LP_MIN_SLEEP = 500                      # ms, shorter pauses are not worth a sleep
+LP_MAX_SLEEP = WDT_TIMEOUT * 1000 // 2  # ms, the watchdog is fed before each sleep
+MQTT_KEEPALIVE = getattr(wc, 'MQTT_KEEPALIVE', 0)  # Seconds, 0 to disable
+MQTT_CONNECT_TIMEOUT = 3  # Seconds, the connection blocks the event loop
+
+# Over the air updates, disabled when there is no token.
+OTA_TOKEN = getattr(wc, 'OTA_TOKEN', None)
+OTA_ROOT = ''                # Directory holding the application files
+OTA_DIRS = ('', 'lib', 'html')
+OTA_CHUNK = 1024
+OTA_MAX_FILE = 256 * 1024
+OTA_RATE = 8 * 1024          # Bytes/s, slowest upload before it times out
+
+GC_WATERMARK = 24 * 1024  # Collect from the idle hook below this free heap
 
 HTML_PATH = b'/html'
+# The files are replaced in place by an OTA update, none of them can be immutable
+HTML_CACHE = {b'html': 'no-cache'}
+STATIC_CACHE = 'public, max-age=3600'
 
 HTML_ERROR = """<!DOCTYPE html><html><head><title>404 Not Found</title>
 <body><h1>{} {}</h1></body></html>
@@ -41,25 +159,43 @@ HTML_ERROR = """<!DOCTYPE html><html><head><title>404 Not Found</title>
 HTTPCodes = {
   200: ('OK', 'OK'),
   303: ('Moved', 'Moved'),
+  304: ('Not Modified', 'Not modified'),
   307: ('Temporary Redirect', 'Moved temporarily'),
   400: ('Bad Request', 'Bad request'),
+  401: ('Unauthorized', 'Unauthorized'),
   404: ('Not Found', 'File not found'),
+  411: ('Length Required', 'Length required'),
+  413: ('Payload Too Large', 'Request too large'),
+  429: ('Too Many Requests', 'Too many requests'),
   500: ('Internal Server Error', 'Server erro'),
+  503: ('Service Unavailable', 'Server busy'),
 }
 
+LATENCY_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500)  # ms
+US_BUCKETS = (500, 1000, 2500, 5000, 10000, 25000, 50000)  # us
+ROUTES = ('index', 'sensors', 'sensors_bin', 'togglefan', 'schedule', 'config', 'reboot',
+          'threshold', 'profiles', 'zones', 'ota', 'metrics', 'logs', 'wifi', 'static',
+          'throttled', 'error')
+
 MIME_TYPES = {
+  b'bin': 'application/octet-stream',
   b'css': 'text/css',
   b'html': 'text/html',
   b'js': 'application/javascript',
   b'json': 'application/json',
+  b'metrics': 'text/plain; version=0.0.4',
   b'txt': 'text/plain',
 }
 
 def parse_headers(head_lines):
+  """Raise ValueError when the request line is malformed"""
   headers = {}
   for line in head_lines:
     if line.startswith(b'GET') or line.startswith(b'POST'):
-      method, uri, proto = line.split()
+      parts = line.split()
+      if len(parts) != 3:
+        raise ValueError('Invalid request line')
+      method, uri, proto = parts
       headers[b'Method'] = method
       headers[b'URI'] = uri
       headers[b'Protocol'] = proto
@@ -67,108 +203,806 @@ def parse_headers(head_lines):
       try:
         key, val = line.split(b":", 1)
         headers[key] = val
-      except:
+      except ValueError:
         LOG.warning('header line warning: %s', line)
   return headers
 
-class EnvSensor(bme280.BME280):
+class Histogram:
+  """Fixed bucket histogram. Recording a value doesn't allocate memory."""
+
+  def __init__(self, buckets=LATENCY_BUCKETS):
+    self.buckets = buckets
+    self.counts = array('L', [0] * (len(buckets) + 1))
+    self.total = array('L', [0])
+
+  def observe(self, value):
+    idx = 0
+    for bound in self.buckets:
+      if value <= bound:
+        break
+      idx += 1
+    self.counts[idx] += 1
+    self.total[0] += value
+
+  def render(self, name, labels=''):
+    count = 0
+    for bound, nb in zip(self.buckets + ('+Inf',), self.counts):
+      count += nb
+      yield '{}_bucket{{{}le="{}"}} {:d}\n'.format(name, labels, bound, count)
+    labels = '{' + labels.rstrip(',') + '}' if labels else ''
+    yield '{}_sum{} {:d}\n'.format(name, labels, self.total[0])
+    yield '{}_count{} {:d}\n'.format(name, labels, count)
+
+
+class Metrics:
+  """Runtime statistics, exposed in the Prometheus text format on /metrics"""
+
+  def __init__(self):
+    self.requests = {route: Histogram() for route in ROUTES}
+    self.sensor = Histogram(US_BUCKETS)
+    self.gc = Histogram(US_BUCKETS)
+    self.loop_lag = Histogram()
+    self.counters = {'mqtt_publish': 0, 'mqtt_fail': 0, 'wifi_connects': 0,
+                     'wifi_disconnects': 0, 'wifi_failures': 0, 'http_rejected': 0,
+                     'http_throttled': 0, 'http_timeout': 0, 'sleeps': 0, 'sleep_ms': 0,
+                     'sensor_errors': 0, 'sensor_rejected': 0, 'sensor_stale': 0,
+                     'i2c_recoveries': 0}
+    self.gauges = {}
+
+  def incr(self, name, value=1):
+    self.counters[name] += value
+
+  def render(self):
+    yield '# TYPE atticfan_heap_free_bytes gauge\n'
+    yield 'atticfan_heap_free_bytes {:d}\n'.format(gc.mem_free())
+    yield '# TYPE atticfan_heap_alloc_bytes gauge\n'
+    yield 'atticfan_heap_alloc_bytes {:d}\n'.format(gc.mem_alloc())
+    largest = largest_free_block()
+    if largest is not None:
+      yield '# TYPE atticfan_heap_largest_free_bytes gauge\n'
+      yield 'atticfan_heap_largest_free_bytes {:d}\n'.format(largest)
+    for name, value in self.gauges.items():
+      yield '# TYPE atticfan_{} gauge\n'.format(name)
+      yield 'atticfan_{} {}\n'.format(name, value)
+    for name, value in self.counters.items():
+      yield '# TYPE atticfan_{}_total counter\n'.format(name)
+      yield 'atticfan_{}_total {:d}\n'.format(name, value)
+    yield '# TYPE atticfan_task_restarts_total counter\n'
+    for name, task in SUPERVISOR.tasks.items():
+      yield 'atticfan_task_restarts_total{{task="{}"}} {:d}\n'.format(name, task['restarts'])
+    yield '# TYPE atticfan_task_last_seen_seconds gauge\n'
+    for name, age in SUPERVISOR.ages():
+      yield 'atticfan_task_last_seen_seconds{{task="{}"}} {:.1f}\n'.format(name, age / 1000)
+    yield '# TYPE atticfan_task_last_error gauge\n'
+    for name, task in SUPERVISOR.tasks.items():
+      if task['error']:
+        error = task['error'].replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' ')
+        yield 'atticfan_task_last_error{{task="{}",error="{}"}} 1\n'.format(name, error)
+    yield '# TYPE atticfan_request_duration_ms histogram\n'
+    for route, hist in self.requests.items():
+      for line in hist.render('atticfan_request_duration_ms', 'route="{}",'.format(route)):
+        yield line
+    yield '# TYPE atticfan_sensor_read_us histogram\n'
+    for line in self.sensor.render('atticfan_sensor_read_us'):
+      yield line
+    yield '# TYPE atticfan_gc_duration_us histogram\n'
+    for line in self.gc.render('atticfan_gc_duration_us'):
+      yield line
+    yield '# TYPE atticfan_loop_lag_ms histogram\n'
+    for line in self.loop_lag.render('atticfan_loop_lag_ms'):
+      yield line
+
+METRICS = Metrics()
+
+def gc_setup():
+  """Let the allocator trigger a collection after a quarter of the free heap is used"""
+  gc.collect()
+  gc.threshold(gc.mem_free() // 4 + gc.mem_alloc())
 
-  _instance = None
-  def __new__(cls, *args, **kwargs):
-    if cls._instance is None:
-      cls._instance = super(EnvSensor, cls).__new__(cls)
-    return cls._instance
+def gc_collect():
+  start = time.ticks_us()
+  gc.collect()
+  METRICS.gc.observe(time.ticks_diff(time.ticks_us(), start))
 
-  def __init__(self, i2c=None):
-    if hasattr(self, 'i2c'):
-      return
+def gc_idle():
+  """Idle hook, only run a collection when the free heap is low"""
+  if gc.mem_free() < GC_WATERMARK:
+    gc_collect()
+
+def largest_free_block():
+  try:
+    import esp32
+    return max(heap[2] for heap in esp32.idf_heap_info(esp32.HEAP_DATA))
+  except (ImportError, AttributeError, ValueError):
+    return None
+
+class Supervisor:
+  """Restart the tasks that die and feed the watchdog only when all the
+  critical tasks have checked in recently."""
+
+  def __init__(self):
+    self.tasks = {}
+    self.wdt = None
+
+  def spawn(self, name, factory, critical=False, deadline=TASK_DEADLINE):
+    """Run the coroutine returned by `factory`, call it again when the task dies"""
+    self.tasks[name] = {'critical': critical, 'deadline': deadline * 1000,
+                        'seen': time.ticks_ms(), 'restarts': 0, 'error': None}
+    asyncio.get_event_loop().create_task(self._guard(name, factory))
+
+  async def _guard(self, name, factory):
+    task = self.tasks[name]
+    while True:
+      try:
+        await factory()
+        LOG.warning('Task %s exited', name)
+      except Exception as exc:
+        task['error'] = '{}: {}'.format(type(exc).__name__, exc)
+        LOG.exc(exc, 'Task %s crashed', name)
+      task['restarts'] += 1
+      await asyncio.sleep_ms(1000)
+
+  def checkin(self, name):
+    self.tasks[name]['seen'] = time.ticks_ms()
+
+  def ages(self):
+    now = time.ticks_ms()
+    for name, task in self.tasks.items():
+      yield name, time.ticks_diff(now, task['seen'])
+
+  def stalled(self):
+    """Return the name of the first critical task which didn't check in"""
+    for name, age in self.ages():
+      task = self.tasks[name]
+      if task['critical'] and age > task['deadline']:
+        return name
+    return None
+
+  def feed(self):
+    """Feed the watchdog if all the critical tasks are alive"""
+    name = self.stalled()
+    if name is not None:
+      LOG.critical('Task %s stalled, the watchdog will reset the device', name)
+      return False
+    if self.wdt:
+      self.wdt.feed()
+    return True
+
+  def resume(self, slept):
+    """The tasks couldn't check in while the CPU was sleeping"""
+    for task in self.tasks.values():
+      task['seen'] = time.ticks_add(task['seen'], slept)
+
+  async def run(self):
+    self.wdt = WDT(timeout=WDT_TIMEOUT * 1000)
+    while True:
+      self.feed()
+      await asyncio.sleep_ms(1000)
+
+SUPERVISOR = Supervisor()
+
+class RateLimiter:
+  """Token bucket per client address"""
+
+  def __init__(self, rate, burst, size=16):
+    self.rate = rate          # Tokens per second
+    self.burst = burst
+    self.size = size          # Max number of clients tracked
+    self.buckets = {}
+
+  def allow(self, key):
+    now = time.ticks_ms()
+    bucket = self.buckets.get(key)
+    if bucket is None:
+      if len(self.buckets) >= self.size:
+        oldest = max(self.buckets, key=lambda k: time.ticks_diff(now, self.buckets[k][1]))
+        del self.buckets[oldest]
+      bucket = self.buckets[key] = [self.burst, now]
+    tokens = min(self.burst, bucket[0] + time.ticks_diff(now, bucket[1]) * self.rate / 1000)
+    bucket[1] = now
+    if tokens < 1:
+      bucket[0] = tokens
+      return False
+    bucket[0] = tokens - 1
+    return True
+
+class Snapshot:
+  """Version of the sensor and fan state. The encoded views of the state are
+  cached until the next change bumps the version."""
+
+  def __init__(self):
+    # Random start so that an ETag from before a reboot doesn't match
+    self.version = int.from_bytes(os.urandom(3), 'little')
+    self._cache = {}
+
+  def bump(self):
+    self.version += 1
+    self._cache.clear()
+
+  def get(self, name, build):
+    """Return the cached value of `name` for the current version"""
+    value = self._cache.get(name)
+    if value is None:
+      value = self._cache[name] = build()
+    return value
+
+SNAPSHOT = Snapshot()
+
+READ_LIMIT = RateLimiter(10, 20)
+WRITE_LIMIT = RateLimiter(0.5, 3)
+
+def is_mutating(method, uri):
+  return (method == b'POST' or uri == b'/api/v1/togglefan' or uri.startswith(b'/api/v1/reboot')
+          or b'threshold=' in uri)
+
+def curve_duty(delta, curve=FAN_CURVE):
+  """Return the duty cycle for a temperature `delta` above the threshold"""
+  if delta < curve[0][0]:
+    return 0.0
+  x0, y0 = curve[0]
+  for x1, y1 in curve[1:]:
+    if delta < x1:
+      return y0 + (y1 - y0) * (delta - x0) / (x1 - x0)
+    x0, y0 = x1, y1
+  return y0
+
+def ramp(current, target, step=FAN_RAMP):
+  """Move `current` toward `target` by at most `step`"""
+  if target > current + step:
+    return current + step
+  if target < current - step:
+    return current - step
+  return target
+
+def week_minute():
+  """Minutes elapsed since Monday 00:00 local time"""
+  tm = time.localtime(time.time() + TZ_OFFSET * 3600)
+  return tm[6] * 1440 + tm[3] * 60 + tm[4]
+
+
+class Schedule:
+  """Weekly schedule of fan modes and thresholds.
+
+  A rule looks like: {"days": [0, 1, 2, 3, 4], "start": "22:00",
+  "status": 0, "threshold": 24.0}. Days go from 0 (Monday) to 6
+  (Sunday), "status" and "threshold" are optional. The rules are
+  expanded into a table of transitions sorted by minute of the week.
+  """
+
+  def __init__(self, rules=None):
+    self.clock_set = False
+    self.load(rules or [])
+
+  def load(self, rules):
+    """Raise ValueError, KeyError or TypeError on an invalid rule"""
+    if not isinstance(rules, list):
+      raise ValueError('the schedule must be a list of rules')
+    low, high = CONFIG_LIMITS['threshold']
+    table = []
+    for rule in rules:
+      if not isinstance(rule, dict):
+        raise ValueError('invalid rule {}'.format(rule))
+      start = rule['start']
+      if not isinstance(start, str) or start.count(':') != 1:
+        raise ValueError('invalid start time {}'.format(start))
+      hour, minute = [int(x) for x in start.split(':')]
+      if not (0 <= hour < 24 and 0 <= minute < 60):
+        raise ValueError('invalid start time {}'.format(start))
+      status = rule.get('status')
+      if status is not None and (isinstance(status, bool) or status not in FAN.modes()):
+        raise ValueError('invalid status {}'.format(status))
+      threshold = rule.get('threshold')
+      if threshold is not None:
+        if isinstance(threshold, bool) or not isinstance(threshold, (int, float)):
+          raise ValueError('invalid threshold {}'.format(threshold))
+        if not low <= threshold <= high:
+          raise ValueError('threshold out of range {}-{}'.format(low, high))
+        threshold = float(threshold)
+      days = rule.get('days', range(7))
+      if not isinstance(days, (list, range)):
+        raise ValueError('invalid days {}'.format(days))
+      for day in days:
+        if isinstance(day, bool) or not isinstance(day, int) or not 0 <= day < 7:
+          raise ValueError('invalid day {}'.format(day))
+        table.append((day * 1440 + hour * 60 + minute, status, threshold))
+    table.sort(key=lambda x: x[0])
+    self.rules = rules
+    self._table = table
+
+  def __getitem__(self, idx):
+    return self._table[idx]
+
+  def lookup(self, minute):
+    """Return the index of the transition active at `minute` of the week"""
+    table = self._table
+    if not table:
+      return None
+    low, high = 0, len(table)
+    while low < high:
+      mid = (low + high) // 2
+      if table[mid][0] <= minute:
+        low = mid + 1
+      else:
+        high = mid
+    # Before the first transition the last one of the previous week applies
+    return (low - 1) % len(table)
+
+
+def content_length(headers):
+  """Return the Content-Length of the request, None if missing or invalid"""
+  length = headers.get(b'Content-Length', b'').strip()
+  if not length.isdigit():
+    return None
+  return int(length)
+
+async def read_body(sreader, headers):
+  length = content_length(headers)
+  if length is None or length > MAX_BODY:
+    raise ValueError('Invalid request body length')
+  body = bytearray(length)
+  view = memoryview(body)
+  pos = 0
+  while pos < length:
+    chunk = await sreader.read(length - pos)
+    if not chunk:
+      raise ValueError('Truncated request body')
+    view[pos:pos + len(chunk)] = chunk
+    pos += len(chunk)
+  return body.decode()
+
+class OTA:
+  """Over the air update. The uploads are staged next to their target with
+  a .new suffix, commit() swaps them in."""
+
+  def __init__(self, token=None, root=None):
+    self.token = token or OTA_TOKEN
+    self.root = OTA_ROOT if root is None else root
+    self.staged = []
+
+  def authorized(self, headers):
+    if not self.token:
+      return False
+    expected = 'Bearer {}'.format(self.token).encode()
+    given = headers.get(b'Authorization', b'').strip()
+    # Constant time comparison
+    diff = len(given) ^ len(expected)
+    for char_a, char_b in zip(given, expected):
+      diff |= char_a ^ char_b
+    return diff == 0
+
+  def path(self, name):
+    """Return the local path of an application file, raise ValueError otherwise"""
+    if isinstance(name, bytes):
+      name = name.decode()
+    parts = name.lstrip('/').split('/')
+    if '..' in parts or '' in parts or '/'.join(parts[:-1]) not in OTA_DIRS:
+      raise ValueError('Invalid path: {}'.format(name))
+    return '/'.join([self.root] + parts) if self.root else '/'.join(parts)
+
+  @staticmethod
+  def digest(path):
+    """SHA-256 of the file as hex, None if it doesn't exist"""
+    sha = uhashlib.sha256()
+    buf = bytearray(OTA_CHUNK)
+    try:
+      with open(path, 'rb') as fd:
+        while True:
+          size = fd.readinto(buf)
+          if not size:
+            break
+          sha.update(memoryview(buf)[:size])
+    except OSError:
+      return None
+    return hexlify(sha.digest()).decode()
+
+  def need(self, manifest):
+    """Return the files of the manifest {name: sha256} that differ from the local copy"""
+    if not isinstance(manifest, dict):
+      raise TypeError('The manifest must be an object')
+    return [name for name, digest in manifest.items() if self.digest(self.path(name)) != digest]
+
+  async def receive(self, sreader, name, length, digest):
+    """Stream the upload to a temporary file and check its SHA-256"""
+    path = self.path(name)
+    tmp = path + '.new'
+    sha = uhashlib.sha256()
+    try:
+      with open(tmp, 'wb') as fd:
+        while length:
+          chunk = await asyncio.wait_for_ms(sreader.read(min(OTA_CHUNK, length)), READ_TIMEOUT)
+          if not chunk:
+            raise ValueError('Truncated upload')
+          sha.update(chunk)
+          fd.write(chunk)
+          length -= len(chunk)
+      if hexlify(sha.digest()).decode() != digest:
+        raise ValueError('SHA-256 mismatch: {}'.format(name))
+    except (OSError, ValueError, asyncio.TimeoutError):
+      try:
+        os.remove(tmp)
+      except OSError:
+        pass
+      raise
+    if path not in self.staged:
+      self.staged.append(path)
+
+  def commit(self):
+    """Swap the staged files in and return their names"""
+    for path in self.staged:
+      try:
+        os.rename(path + '.new', path)
+      except OSError:
+        # The FAT driver doesn't rename over an existing file
+        os.remove(path)
+        os.rename(path + '.new', path)
+    files, self.staged = self.staged, []
+    return files
+
+def i2c_recover(i2c):
+  """Free the bus from a device stuck in the middle of a byte: clock SCL until
+  it releases SDA, send a STOP and start the I2C controller again"""
+  METRICS.incr('i2c_recoveries')
+  scl = Pin(I2C_SCL, Pin.OPEN_DRAIN, value=1)
+  sda = Pin(I2C_SDA, Pin.OPEN_DRAIN, value=1)
+  for _ in range(9):
+    if sda.value():
+      break
+    scl.value(0)
+    time.sleep_us(5)
+    scl.value(1)
+    time.sleep_us(5)
+  # STOP: SDA goes high while SCL is high
+  sda.value(0)
+  time.sleep_us(5)
+  sda.value(1)
+  time.sleep_us(5)
+  released = sda.value()
+  i2c.init(scl=Pin(I2C_SCL), sda=Pin(I2C_SDA), freq=I2C_FREQ)
+  LOG.warning('I2C bus recovery, SDA %s', 'released' if released else 'stuck low')
+  return released
+
+
+class EnvSensor(bme280.BME280):
+  """BME280 with retries, bus recovery and plausibility checks. The last good
+  reading is kept, `stale` tells when it is too old to be trusted."""
+
+  def __init__(self, i2c=None, address=bme280.BME280_I2C_ADDR_PRIM):
     if not i2c:
       raise OSError('I2C bus argument missing')
-    self.cache_time = 0
-    super(EnvSensor, self).__init__(i2c=i2c)
-    self.set_measurement_settings({
-      'filter': bme280.BME280_FILTER_COEFF_16,
-      'standby_time': bme280.BME280_STANDBY_TIME_500_US,
-      'osr_h': bme280.BME280_OVERSAMPLING_1X,
-      'osr_p': bme280.BME280_OVERSAMPLING_16X,
-      'osr_t': bme280.BME280_OVERSAMPLING_2X})
-    self.set_power_mode(bme280.BME280_NORMAL_MODE)
+    # The driver is initialized by _configure(), after a fault as well
+    self.address = address
+    self.i2c = i2c
+    self.compensated_data = None
+    self.cache_time = 0     # Time of the last good reading
+    self._retry = 0
+    self._reinit = True
+    self._suspect = None
+    self.health = 100       # Recent success rate of the readings (%)
+    self._stale = None      # Last value of `stale`
+    self.interval = SENSOR_FAST
+    self.rate = 0.0         # Degrees per minute
+    self.profile = None
+    self.usage = {name: [0, 0] for name in SENSOR_PROFILES}  # Readings, active ms
+    self.set_profile(SENSOR_PROFILE)
     gc.collect()
 
+  def set_profile(self, name):
+    settings = SENSOR_PROFILES[name]
+    self._account()
+    self.profile = name
+    self.conversion_us = self.measurement_time_us(settings)
+    self._forced = settings['mode'] == bme280.BME280_FORCED_MODE
+    self._retry = 0
+    try:
+      self._configure()
+    except OSError as err:
+      self._fault(err)
+    LOG.info('Sensor profile %s, conversion %d us', name, self.conversion_us)
+
+  def _configure(self):
+    """Write the settings of the profile. In forced mode the sensor sleeps
+    between two readings."""
+    if self._reinit:
+      self.reinit()
+      self._reinit = False
+    settings = SENSOR_PROFILES[self.profile]
+    self.set_measurement_settings(settings)
+    self.set_power_mode(bme280.BME280_SLEEP_MODE if self._forced else settings['mode'])
+
+  def _fault(self, err):
+    METRICS.incr('sensor_errors')
+    LOG.warning('Sensor 0x%02x: %s', self.address, err)
+    self._reinit = True
+    self.health = self.health * 7 // 8
+
+  def _account(self):
+    now = time.ticks_ms()
+    if self.profile:
+      self.usage[self.profile][1] += time.ticks_diff(now, self._since)
+    self._since = now
+
+  def profiles(self):
+    """Conversion time and readings per hour of each profile"""
+    self._account()
+    info = {}
+    for name, settings in SENSOR_PROFILES.items():
+      readings, active = self.usage[name]
+      info[name] = {'conversion_ms': self.measurement_time_us(settings) / 1000,
+                    'readings': readings,
+                    'readings_per_hour': round(readings * 3600000 / active, 1) if active else None}
+    return {'profile': self.profile, 'interval': self.interval, 'rate': round(self.rate, 3),
+            'profiles': info}
+
+  def low_power(self, enable):
+    """Take forced measurements, the sensor sleeps between two readings"""
+    mode = SENSOR_PROFILES[self.profile]['mode']
+    if mode == bme280.BME280_FORCED_MODE or self._forced == enable:
+      return
+    self._forced = enable
+    try:
+      self.set_power_mode(bme280.BME280_SLEEP_MODE if enable else mode)
+    except OSError as err:
+      self._fault(err)
+
+  def adapt(self, threshold):
+    """Choose the sampling interval from the distance to the threshold and the rate
+    of change of the temperature"""
+    if self.compensated_data is None:
+      return
+    near = abs(self.compensated_data['temperature'] - threshold) < SENSOR_NEAR
+    self.interval = SENSOR_FAST if near or self.rate > SENSOR_RATE else SENSOR_SLOW
+
+  def due(self):
+    """Time of the next reading"""
+    return max(self.cache_time + self.interval, self._retry)
+
+  @property
+  def stale(self):
+    """The data goes stale with time, without a reading, in any fan mode"""
+    data = self.read_data()
+    stale = data is None or time.time() - self.cache_time > SENSOR_STALE
+    if stale != self._stale:
+      self._stale = stale
+      SNAPSHOT.bump()
+    return stale
+
+  def plausible(self, data, now):
+    """Reject the values out of range and the temperature spikes. A jump is
+    accepted when a later reading confirms it. A retry right away would read
+    the same data registers."""
+    for key, (low, high) in SENSOR_LIMITS.items():
+      if not low <= data[key] <= high:
+        return False
+    temp = data['temperature']
+    last = self.compensated_data
+    if last is not None:
+      limit = SENSOR_SPIKE + SENSOR_SLEW * (now - self.cache_time) / 60
+      suspect = self._suspect
+      if abs(temp - last['temperature']) > limit and (
+          suspect is None or suspect[1] == now or abs(temp - suspect[0]) > SENSOR_SPIKE):
+        self._suspect = (temp, now)
+        return False
+    self._suspect = None
+    return True
+
+  def _sample(self, now):
+    """Up to SENSOR_RETRIES attempts. After an error the sensor is initialized
+    again, after two in a row the bus is recovered as well."""
+    for attempt in range(SENSOR_RETRIES):
+      try:
+        if self._reinit:
+          self._configure()
+        if self._forced:
+          self.force_measurement(self.conversion_us)
+        data = self.get_measurement()
+      except OSError as err:
+        self._fault(err)
+        if attempt:
+          try:
+            i2c_recover(self.i2c)
+          except (OSError, AttributeError) as err:
+            LOG.error('I2C bus recovery failed: %s', err)
+        continue
+      if self.plausible(data, now):
+        self.health = (self.health * 7 + 107) // 8
+        return data
+      METRICS.incr('sensor_rejected')
+      LOG.warning('Sensor 0x%02x: implausible reading %.2f C %.2f %% %.2f hPa', self.address,
+                  data['temperature'], data['humidity'], data['pressure'])
+      self.health = self.health * 7 // 8
+      if self._suspect and self._suspect[1] == now:
+        # A spike, wait for the next reading to confirm it
+        return None
+    return None
+
   def read_data(self):
-    """Read the compensated data and cache it for 15 seconds"""
+    """Read the compensated data and cache it for the sampling interval.
+    Return the last good reading, None if there is none."""
     now = time.time()
-    if not hasattr(self, "compensated_data") or  now < self.cache_time + 30:
+    if now >= self.due():
+      start = time.ticks_us()
+      health = self.health
+      data = self._sample(now)
+      METRICS.sensor.observe(time.ticks_diff(time.ticks_us(), start))
+      if data is None:
+        self._retry = now + SENSOR_RETRY
+        if self.health != health:
+          SNAPSHOT.bump()
+        return self.compensated_data
+      data['dewpoint'], data['abs_humidity'] = psychro.derive(data['temperature'],
+                                                              data['humidity'])
+      if self.compensated_data is not None and now > self.cache_time:
+        delta = data['temperature'] - self.compensated_data['temperature']
+        self.rate = abs(delta) * 60 / (now - self.cache_time)
       self.cache_time = now
-      self.compensated_data = self.get_measurement()
-
-    gc.collect()
+      self.compensated_data = data
+      self.usage[self.profile][0] += 1
+      SNAPSHOT.bump()
     return self.compensated_data
 
+  def _value(self, key):
+    data = self.read_data()
+    return data[key] if data else None
+
   @property
   def pressure(self):
-    data = self.read_data()
-    return data['pressure']
+    return self._value('pressure')
 
   @property
   def temp(self):
-    data = self.read_data()
-    return data['temperature']
+    return self._value('temperature')
 
   @property
   def humidity(self):
-    data = self.read_data()
-    return data['humidity']
+    return self._value('humidity')
 
   @property
   def temperature(self):
     return self.temp
 
+  @property
+  def dewpoint(self):
+    return self._value('dewpoint')
+
+  @property
+  def abs_humidity(self):
+    return self._value('abs_humidity')
+
 
 class FAN:
+  """A zone: the fan relay, its sensor, the fan policy and the saved state"""
   OFF = const(0)
   ON = const(1)
   AUTOMATIC = const(2)
-
-  _instance = None
-  def __new__(cls, *args, **kwargs):
-    if cls._instance is None:
-      cls._instance = super(FAN, cls).__new__(cls)
-    return cls._instance
-
-  def __init__(self, pin=None, sensor=None):
-    if not hasattr(self, '_pin'):
-      # This is the first call
-      self._pin = pin
-      self.sensor = sensor
-
+  VARIABLE = const(3)
+  HUMIDITY = const(4)
+
+  def __init__(self, pin=None, sensor=None, pwm=PWM, name='attic', primary=True):
+    self._pin = pin
+    self.sensor = sensor
+    self.name = name
+    self.primary = primary
+    self.state_file = STATE_FILE if primary else STATE_FILE.replace('.json',
+                                                                    '-{}.json'.format(name))
+    self._pwm_class = pwm
+    self._pwm = None
+    self._duty = 0.0
+    self.schedule = Schedule()
+    self._period = None
+    self._first = True
+    self._failsafe = False
+    self.counters = {'runtime': 0, 'starts': 0, 'energy': 0}
+    self._tick = self._saved = self._started = time.ticks_ms()
     self._read_state()
 
   def _read_state(self):
     try:
       os.mkdir('/tmp')
-      with open(STATE_FILE, "w") as fd:
+      with open(self.state_file, "w") as fd:
         fd.write(ujson.dumps({"status": self.AUTOMATIC, "threshold": TEMPERATURE_THRESHOLD}))
     except OSError:
       pass
 
-    try:
+    state = {}
+    # The .tmp file is left alone when the FAT fallback of _save_state is cut short
+    for path in (self.state_file, self.state_file + '.tmp'):
+      try:
+        with open(path, "r") as fd:
+          state = ujson.loads(fd.read())
+        break
+      except OSError as err:
+        LOG.warning('%s: %s', path, err)
+      except ValueError as err:
+        LOG.error('%s is corrupted: %s', path, err)
+    if not isinstance(state, dict):
+      LOG.error('%s is corrupted, using the defaults', self.state_file)
       state = {}
-      with open(STATE_FILE, "r") as fd:
-        state = ujson.loads(fd.read())
-    except OSError as err:
-      LOG.warning(err)
 
     self._status = state.get("status", self.AUTOMATIC)
+    if self._status not in self.modes():
+      self._status = self.AUTOMATIC
     self._threshold = state.get("threshold", TEMPERATURE_THRESHOLD)
+    self.hysteresis = state.get("hysteresis", HYSTERESIS)
+    self.sampling = state.get("sampling", SAMPLING)
+    self.dew_spread = state.get("dew_spread", DEW_SPREAD)
+    profile = state.get("profile")
+    if self.sensor and profile in SENSOR_PROFILES and profile != self.sensor.profile:
+      self.sensor.set_profile(profile)
+    counters = state.get("counters")
+    if isinstance(counters, dict):
+      self.counters.update(counters)
+    try:
+      self.schedule.load(state.get("schedule", []))
+    except (KeyError, TypeError, ValueError) as err:
+      LOG.error('Schedule error: %s', err)
     gc.collect()
 
   def _save_state(self):
+    """Write a temporary file and rename it, a reset never leaves a truncated state"""
+    tmp = self.state_file + '.tmp'
     try:
-      with open(STATE_FILE, "w") as fd:
-        fd.write(ujson.dumps({"status": self._status, "threshold": self._threshold}))
+      with open(tmp, "w") as fd:
+        fd.write(ujson.dumps({"status": self._status, "threshold": self._threshold,
+                              "hysteresis": self.hysteresis, "sampling": self.sampling,
+                              "dew_spread": self.dew_spread,
+                              "profile": self.sensor.profile if self.sensor else None,
+                              "schedule": self.schedule.rules, "counters": self.counters}))
+      try:
+        os.rename(tmp, self.state_file)
+      except OSError:
+        # The FAT driver doesn't rename over an existing file
+        os.remove(self.state_file)
+        os.rename(tmp, self.state_file)
     except OSError as err:
       LOG.warning(err)
+    self._saved = time.ticks_ms()
+
+  def _account(self):
+    """Add the time since the last call to the counters and return the duty cycle"""
+    now = time.ticks_ms()
+    elapsed = time.ticks_diff(now, self._tick)
+    self._tick = now
+    duty = self.duty
+    if duty:
+      self.counters['runtime'] += elapsed
+      self.counters['energy'] += int(FAN_WATTS * duty * elapsed)
+    return duty
+
+  def _start(self):
+    self._started = time.ticks_ms()
+    self.counters['starts'] += 1
+    SNAPSHOT.bump()
+
+  def stats(self):
+    running = self._account()
+    return {
+      'runtime': self.counters['runtime'] // 1000,
+      'starts': self.counters['starts'],
+      'current_run': time.ticks_diff(self._tick, self._started) // 1000 if running else 0,
+      'kwh': self.counters['energy'] / 3600000000,  # watt x ms -> kWh
+    }
+
+  def set_schedule(self, rules):
+    self.schedule.load(rules)
+    self._period = None
+    self._save_state()
+
+  def run_schedule(self):
+    if not self.schedule.clock_set:
+      return
+    idx = self.schedule.lookup(week_minute())
+    if idx is None or idx == self._period:
+      return
+    self._period = idx
+    _, status, threshold = self.schedule[idx]
+    LOG.info('Schedule transition: status: %s threshold: %s', status, threshold)
+    if threshold is not None:
+      self._threshold = threshold
+      SNAPSHOT.bump()
+    if status is not None:
+      self.status(status)
+    else:
+      self._save_state()
 
   @property
   def threshold(self):
@@ -177,24 +1011,70 @@ class FAN:
   @threshold.setter
   def threshold(self, val):
     self._threshold = val
-    self.runfan()
+    SNAPSHOT.bump()
+    self.control()
     self._save_state()
 
   def runfan(self):
     if self.threshold < self.sensor.temp:
       self.on()
-    elif self.threshold > self.sensor.temp:
+    elif self.threshold - self.hysteresis > self.sensor.temp:
       self.off()
 
-  async def run(self):
-    while True:
-      if self._status == self.AUTOMATIC:
-        self.runfan()
-      elif self._status == self.ON and not self.is_running():
+  def runhumidity(self):
+    """The temperature rule, or the air is close to condensation"""
+    temp = self.sensor.temp
+    spread = temp - self.sensor.dewpoint
+    if self.threshold < temp or spread < self.dew_spread:
+      self.on()
+    elif self.threshold - self.hysteresis > temp and spread > self.dew_spread + DEW_HYSTERESIS:
+      self.off()
+
+  def runpwm(self):
+    target = curve_duty(self.sensor.temp - self.threshold)
+    self.speed(ramp(self._duty, target))
+
+  def control(self):
+    """Apply the policy of the current mode. The modes driven by the sensor
+    fall back to SENSOR_FAILSAFE while its data is stale."""
+    if self._status in (self.AUTOMATIC, self.VARIABLE, self.HUMIDITY) and self.sensor.stale:
+      if not self._failsafe:
+        LOG.error('Zone %s: no sensor data, fan %s', self.name,
+                  'on' if SENSOR_FAILSAFE else 'off')
+        METRICS.incr('sensor_stale')
+        self._failsafe = True
+        SNAPSHOT.bump()
+      if SENSOR_FAILSAFE:
         self.on()
-      elif self._status == self.OFF and self.is_running():
+      else:
         self.off()
-      await asyncio.sleep_ms(1000)
+      return
+    if self._failsafe:
+      LOG.info('Zone %s: sensor data back', self.name)
+      self._failsafe = False
+      SNAPSHOT.bump()
+    if self._status == self.VARIABLE:
+      self.runpwm()
+    elif self._status == self.AUTOMATIC:
+      self.runfan()
+    elif self._status == self.HUMIDITY:
+      self.runhumidity()
+    elif self._status == self.ON and not self.is_running():
+      self.on()
+    elif self._status == self.OFF and self.is_running():
+      self.off()
+
+  def step(self):
+    """Run the schedule and the fan policy once"""
+    self.run_schedule()
+    self.control()
+    if self._first:
+      LOG.info('Zone %s first fan decision %d ms after boot', self.name, time.ticks_ms())
+      self._first = False
+    self.sensor.adapt(self.threshold)
+    self._account()
+    if time.ticks_diff(time.ticks_ms(), self._saved) > COUNTERS_SAVE * 1000:
+      self._save_state()
 
   def status(self, val=None):
     if val is None:
@@ -204,272 +1084,993 @@ class FAN:
     except ValueError as err:
       LOG.error(err)
       return
+    if val not in self.modes():
+      LOG.error('Invalid fan mode: %d', val)
+      return
+    self._set_status(val)
+    self._save_state()
+
+  def _set_status(self, val):
+    if val != self.VARIABLE:
+      self._release_pwm()
     self._status = val
+    SNAPSHOT.bump()
+
+  def configure(self, config):
+    """Validate all the settings, then apply them with a single state write"""
+    if not isinstance(config, dict):
+      raise TypeError('The configuration must be an object')
+    for key, val in config.items():
+      if key == 'profile':
+        if val not in SENSOR_PROFILES:
+          raise ValueError('Unknown sensor profile: {}'.format(val))
+        continue
+      if isinstance(val, bool) or not isinstance(val, (int, float)):
+        raise TypeError('{}: a number is expected'.format(key))
+      if key == 'status':
+        if val not in self.modes():
+          raise ValueError('Invalid fan mode: {}'.format(val))
+      elif key in CONFIG_LIMITS:
+        low, high = CONFIG_LIMITS[key]
+        if not low <= val <= high:
+          raise ValueError('{} out of range {}-{}'.format(key, low, high))
+      else:
+        raise KeyError('Unknown setting: {}'.format(key))
+
+    if 'status' in config:
+      self._set_status(int(config['status']))
+    self._threshold = config.get('threshold', self._threshold)
+    self.hysteresis = config.get('hysteresis', self.hysteresis)
+    self.sampling = config.get('sampling', self.sampling)
+    self.dew_spread = config.get('dew_spread', self.dew_spread)
+    if config.get('profile', self.sensor.profile) != self.sensor.profile:
+      self.sensor.set_profile(config['profile'])
+    SNAPSHOT.bump()
+    self.control()
     self._save_state()
 
+  @staticmethod
+  def modes():
+    if FAN_PWM:
+      return (FAN.OFF, FAN.ON, FAN.AUTOMATIC, FAN.VARIABLE, FAN.HUMIDITY)
+    return (FAN.OFF, FAN.ON, FAN.AUTOMATIC, FAN.HUMIDITY)
+
+  @property
+  def duty(self):
+    if self._pwm:
+      return self._duty
+    return float(self.is_running())
+
+  def speed(self, duty):
+    """Drive the fan pin with PWM at `duty` (0.0 - 1.0)"""
+    if not self._account() and duty:
+      self._start()
+    if not self._pwm:
+      self._pwm = self._pwm_class(self._pin, freq=PWM_FREQ, duty=0)
+    if duty != self._duty:
+      self._duty = duty
+      SNAPSHOT.bump()
+    self._pwm.duty(int(duty * 1023))
+
+  def _release_pwm(self):
+    if self._pwm:
+      self._account()
+      self._pwm.deinit()
+      self._pwm = None
+      self._duty = 0.0
+      self._pin.init(Pin.OUT)
+      SNAPSHOT.bump()
+
   def on(self):
+    if not self._account():
+      self._start()
+    self._release_pwm()
     self._pin.on()
 
   def off(self):
+    if self._account():
+      SNAPSHOT.bump()
+    self._release_pwm()
     self._pin.off()
 
   def is_running(self):
+    if self._pwm:
+      return self._duty > 0
     return bool(self._pin.value())
 
+class Zones:
+  """The fan zones, all sampled and driven by a single task"""
+
+  def __init__(self):
+    self.zones = []
+
+  def setup(self, i2c, config):
+    names, pins = set(), set()
+    for conf in config:
+      name, pin = conf['name'], conf['pin']
+      if not name or name in names or not all(c.isalpha() or c.isdigit() for c in name):
+        raise ValueError('Invalid or duplicate zone name: {}'.format(name))
+      if pin in pins:
+        raise ValueError('Zone {}: pin {:d} already used'.format(name, pin))
+      names.add(name)
+      pins.add(pin)
+      sensor = EnvSensor(i2c, conf.get('address', bme280.BME280_I2C_ADDR_PRIM))
+      self.zones.append(FAN(Pin(pin, Pin.OUT, value=0), sensor, name=name,
+                            primary=not self.zones))
+    LOG.info('Zones: %s', ', '.join(zone.name for zone in self.zones))
+
+  def __iter__(self):
+    return iter(self.zones)
+
+  def __len__(self):
+    return len(self.zones)
+
+  @property
+  def primary(self):
+    return self.zones[0]
+
+  def get(self, name):
+    for zone in self.zones:
+      if zone.name == name:
+        return zone
+    return None
+
+  async def run(self):
+    while True:
+      for zone in self.zones:
+        zone.step()
+      SUPERVISOR.checkin('fan')
+      await asyncio.sleep_ms(1000)
+
+ZONES = Zones()
+
 class Server:
 
-  def __init__(self, addr='0.0.0.0', port=80):
+  def __init__(self, addr='0.0.0.0', port=80, wifi=None):
     self.addr = addr
     self.port = port
+    self.wifi = wifi
     self.open_socks = []
-    self.fan = FAN()
-    self.sensor = EnvSensor()
+    self._rebind = False
+    self._bin = {zone.name: bytearray(struct.calcsize(SENSORS_FMT)) for zone in ZONES}
+    self.ota = OTA()
 
-  async def run(self, loop):
+  def link_up(self):
+    """The WiFi link came back, bind the listening socket again"""
+    self._rebind = True
+
+  def link_down(self):
+    pass
+
+  def bind(self):
     addr = socket.getaddrinfo(self.addr, self.port, 0, socket.SOCK_STREAM)[0][-1]
     s_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     s_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     s_sock.bind(addr)
     s_sock.listen(5)
-    self.open_socks.append(s_sock)
     LOG.info('Awaiting connection on %s:%d', self.addr, self.port)
+    return s_sock
 
-    poller = select.poll()
-    poller.register(s_sock, select.POLLIN)
+  async def run(self, loop):
     while True:
-      if poller.poll(1):  # 1ms
-        c_sock, addr = s_sock.accept()  # get client socket
-        LOG.info('Connection from %s:%d', *addr)
-        loop.create_task(self.process_request(c_sock))
-        gc.collect()
-      await asyncio.sleep_ms(100)
-
-  async def process_request(self, sock):
-    LOG.info('Process request %s', sock)
+      self._rebind = False
+      try:
+        s_sock = self.bind()
+      except OSError as err:
+        LOG.error('Server bind error: %s', err)
+        await asyncio.sleep_ms(5000)
+        continue
+      self.open_socks.append(s_sock)
+      poller = select.poll()
+      poller.register(s_sock, select.POLLIN)
+      try:
+        while not self._rebind:
+          SUPERVISOR.checkin('server')
+          if poller.poll(1):  # 1ms
+            # Accept all the pending connections
+            for _ in range(MAX_CONNECTIONS):
+              try:
+                c_sock, addr = s_sock.accept()  # get client socket
+              except OSError as err:
+                LOG.warning('Accept error: %s', err)
+                break
+              self.accept(loop, c_sock, addr)
+              if not poller.poll(0):
+                break
+          elif len(self.open_socks) == 1:
+            gc_idle()
+          # Poll faster while clients are connected
+          await asyncio.sleep_ms(100 if len(self.open_socks) == 1 else 10)
+      finally:
+        poller.unregister(s_sock)
+        s_sock.close()
+        self.open_socks.remove(s_sock)
+
+  def accept(self, loop, sock, addr):
+    LOG.info('Connection from %s:%d', *addr)
+    # open_socks holds the listening socket and the clients
+    if len(self.open_socks) > MAX_CONNECTIONS:
+      LOG.warning('Server busy, rejecting %s', addr[0])
+      METRICS.incr('http_rejected')
+      try:
+        # Closing with the request unread would reset the connection
+        sock.setblocking(False)
+        sock.recv(MAX_BODY)
+      except OSError:
+        pass
+      try:
+        sock.send(self._headers(503))
+      except OSError:
+        pass
+      sock.close()
+      return
     self.open_socks.append(sock)
+    METRICS.gauges['open_sockets'] = len(self.open_socks)
+    loop.create_task(self.process_request(sock, addr))
+
+  async def process_request(self, sock, addr):
+    LOG.info('Process request %s', sock)
+    start = time.ticks_ms()
+    route = 'error'
     sreader = asyncio.StreamReader(sock)
     swriter = asyncio.StreamWriter(sock, '')
     try:
-      head_lines = []
-      while True:
-        line = await sreader.readline()
-        line = line.rstrip()
-        if line in (b'', b'\r\n'):
-          break
-        head_lines.append(line)
-
-      headers = parse_headers(head_lines)
-      uri = headers.get(b'URI')
-      if not uri:
-        LOG.debug('Empty request')
-        raise OSError
-
-      LOG.info('Request %s %s', headers[b'Method'].decode(), uri.decode())
-      if uri == b'/' or uri == b'/index.html':
-        await self.send_file(swriter, b'/index.html')
-      elif uri == b'/api/v1/sensors':
-        data = await self.get_sensors()
-        await self.send_json(swriter, data)
-      elif uri == b'/api/v1/togglefan':
-        self.fan.status((self.fan.status() + 1) % 3)
-        data = await self.get_sensors()
-        await self.send_json(swriter, data)
-      elif uri.startswith('/api/v1/select/'):
-        await self.switch_antenna(swriter, uri)
-      elif uri.startswith('/api/v1/reboot'):
-        await self.reboot(swriter)
-      elif 'threshold=' in uri:
-        _, val = uri.split(b'=')
-        if val.isdigit():
-          self.fan.threshold = int(val)
-          await self.send_redirect(swriter)
-        else:
-          await self.send_error(swriter, uri)
-      else:
-        await self.send_file(swriter, uri)
+      headers = await asyncio.wait_for_ms(self.read_headers(sreader), REQUEST_TIMEOUT)
+      timeout = self.request_timeout(headers) - time.ticks_diff(time.ticks_ms(), start)
+      route = await asyncio.wait_for_ms(self.handle_request(sreader, swriter, addr[0], headers),
+                                        max(timeout, 0))
+    except asyncio.TimeoutError:
+      LOG.warning('Request timeout from %s', addr[0])
+      METRICS.incr('http_timeout')
     except OSError:
       pass
+    except Exception as exc:
+      # A malformed request is a 400, anything else a bug in the handler
+      if isinstance(exc, ValueError):
+        LOG.warning('Bad request from %s: %s', addr[0], exc)
+        code = 400
+      else:
+        LOG.exc(exc, 'Request error from %s', addr[0])
+        code = 500
+      try:
+        await asyncio.wait_for_ms(self.send_error(swriter, code), READ_TIMEOUT)
+      except (OSError, asyncio.TimeoutError):
+        pass
+    finally:
+      # Always free the connection slot
+      LOG.debug('Disconnecting %s / %d', sock, len(self.open_socks))
+      sock.close()
+      self.open_socks.remove(sock)
+      METRICS.gauges['open_sockets'] = len(self.open_socks)
+      METRICS.requests[route].observe(time.ticks_diff(time.ticks_ms(), start))
 
-    LOG.debug("%r", self.fan)
-    gc.collect()
-    LOG.debug('Disconnecting %s / %d', sock, len(self.open_socks))
-    sock.close()
-    self.open_socks.remove(sock)
+  @staticmethod
+  async def read_headers(sreader):
+    head_lines = []
+    while True:
+      line = await asyncio.wait_for_ms(sreader.readline(), READ_TIMEOUT)
+      line = line.rstrip()
+      if line in (b'', b'\r\n'):
+        break
+      head_lines.append(line)
+
+    headers = parse_headers(head_lines)
+    if not headers.get(b'URI'):
+      LOG.debug('Empty request')
+      raise OSError
+    return headers
+
+  def request_timeout(self, headers):
+    """REQUEST_TIMEOUT, plus the time to receive an authenticated OTA upload"""
+    if headers[b'URI'].startswith(b'/api/v1/ota/file/') and self.ota.authorized(headers):
+      length = min(content_length(headers) or 0, OTA_MAX_FILE)
+      return REQUEST_TIMEOUT + length * 1000 // OTA_RATE
+    return REQUEST_TIMEOUT
+
+  async def handle_request(self, sreader, swriter, client, headers):
+    """Answer the request and return the name of the route"""
+    uri = headers[b'URI']
+    LOG.info('Request %s %s', headers[b'Method'].decode, uri.decode)
+    # /api/v1/zones/<name>/... is the /api/v1/... API of that zone
+    zone = ZONES.primary
+    if uri.startswith(b'/api/v1/zones/'):
+      name, _, path = uri[14:].partition(b'/')
+      zone = ZONES.get(name.decode())
+      if not zone:
+        await self.send_error(swriter, 404)
+        return 'zones'
+      uri = b'/api/v1/' + path
+    limiter = WRITE_LIMIT if is_mutating(headers[b'Method'], uri) else READ_LIMIT
+    # An authenticated update uploads several files in a row
+    trusted = uri.startswith(b'/api/v1/ota/') and self.ota.authorized(headers)
+    if not trusted and not limiter.allow(client):
+      LOG.warning('Too many requests from %s', client)
+      METRICS.incr('http_throttled')
+      await self.send_error(swriter, 429)
+      return 'throttled'
+
+    if uri == b'/' or uri == b'/index.html':
+      route = 'index'
+      await self.send_file(swriter, b'/index.html', headers)
+    elif uri == b'/api/v1/sensors':
+      route = 'sensors'
+      await self.send_sensors(swriter, headers, zone)
+    elif uri == b'/api/v1/sensors.bin':
+      route = 'sensors_bin'
+      if zone.sensor.read_data() is None:
+        await self.send_error(swriter, 503)
+      else:
+        data = SNAPSHOT.get(zone.name + '.bin', lambda: self.pack_sensors(zone))
+        await swriter.awrite(self._headers(200, b'bin', content_len=len(data)))
+        await swriter.awrite(data)
+    elif uri == b'/api/v1/togglefan':
+      route = 'togglefan'
+      modes = zone.modes()
+      zone.status(modes[(modes.index(zone.status()) + 1) % len(modes)])
+      await self.send_sensors(swriter, headers, zone)
+    elif uri == b'/api/v1/schedule':
+      route = 'schedule'
+      if headers[b'Method'] == b'POST':
+        await self.set_schedule(sreader, swriter, headers, zone)
+      else:
+        await self.send_json(swriter, zone.schedule.rules)
+    elif uri == b'/api/v1/config' and headers[b'Method'] == b'POST':
+      route = 'config'
+      await self.set_config(sreader, swriter, headers, zone)
+    elif uri == b'/api/v1/profiles':
+      route = 'profiles'
+      await self.send_json(swriter, zone.sensor.profiles())
+    elif uri == b'/api/v1/zones':
+      route = 'zones'
+      await self.send_json(swriter, [self.get_sensors(zone) for zone in ZONES])
+    elif uri == b'/metrics':
+      route = 'metrics'
+      await self.send_metrics(swriter)
+    elif uri == b'/api/v1/wifi':
+      route = 'wifi'
+      await self.send_json(swriter, self.wifi.info())
+    elif uri == b'/api/v1/logs':
+      route = 'logs'
+      await self.send_logs(swriter)
+    elif uri.startswith(b'/api/v1/ota/') and headers[b'Method'] == b'POST':
+      route = 'ota'
+      await self.ota_request(sreader, swriter, headers, uri[12:])
+    elif uri.startswith(b'/api/v1/reboot'):
+      route = 'reboot'
+      await self.reboot(swriter)
+    elif b'threshold=' in uri:
+      route = 'threshold'
+      val = uri.split(b'threshold=', 1)[1].split(b'&', 1)[0]
+      if val.isdigit():
+        zone.threshold = int(val)
+        await self.send_redirect(swriter)
+      else:
+        await self.send_error(swriter, 400)
+    else:
+      route = 'static'
+      await self.send_file(swriter, uri, headers)
+    return route
+
+  async def set_schedule(self, rfd, wfd, headers, zone):
+    try:
+      body = await read_body(rfd, headers)
+      zone.set_schedule(ujson.loads(body))
+    except (KeyError, TypeError, ValueError) as err:
+      LOG.error('Schedule error: %s', err)
+      await self.send_error(wfd, 400)
+      return
+    await self.send_json(wfd, zone.schedule.rules)
 
-  async def get_sensors(self):
+  async def set_config(self, rfd, wfd, headers, zone):
+    length = content_length(headers)
+    if length is None:
+      await self.send_error(wfd, 411)
+      return
+    if length > MAX_BODY:
+      await self.send_error(wfd, 413)
+      return
+    try:
+      body = await read_body(rfd, headers)
+      zone.configure(ujson.loads(body))
+    except (KeyError, TypeError, ValueError) as err:
+      LOG.error('Configuration error: %s', err)
+      await self.send_error(wfd, 400)
+      return
+    await self.send_sensors(wfd, {}, zone)
+
+  async def ota_request(self, rfd, wfd, headers, action):
+    """manifest: list the files to upload, file/<path>: upload a file,
+    commit: swap the uploaded files in and reboot"""
+    if not self.ota.authorized(headers):
+      LOG.warning('Unauthorized OTA request')
+      await self.send_error(wfd, 401 if self.ota.token else 404)
+      return
+    try:
+      if action == b'manifest':
+        body = await read_body(rfd, headers)
+        await self.send_json(wfd, {'need': self.ota.need(ujson.loads(body))})
+      elif action.startswith(b'file/'):
+        length = content_length(headers)
+        if length is None:
+          await self.send_error(wfd, 411)
+          return
+        if length > OTA_MAX_FILE:
+          await self.send_error(wfd, 413)
+          return
+        digest = headers.get(b'X-SHA256', b'').strip().decode()
+        await self.ota.receive(rfd, action[5:], length, digest)
+        await self.send_json(wfd, {'staged': self.ota.staged})
+      elif action == b'commit':
+        files = self.ota.commit()
+        LOG.info('OTA update: %s', files)
+        if files:
+          await self.reboot(wfd, {'files': files})
+        else:
+          await self.send_json(wfd, {'files': files})
+      else:
+        await self.send_error(wfd, 404)
+    except (KeyError, TypeError, ValueError) as err:
+      LOG.error('OTA error: %s', err)
+      await self.send_error(wfd, 400)
+
+  async def send_sensors(self, wfd, headers, zone):
+    """Send the cached JSON snapshot, or a 304 if the client has this version"""
+    zone.sensor.stale    # Reads the sensor, a change bumps the version
+    etag = SNAPSHOT.get(zone.name + '.etag',
+                        lambda: '"{}-{:d}"'.format(zone.name, SNAPSHOT.version))
+    if etag.encode() in headers.get(b'If-None-Match', b''):
+      await wfd.awrite(SNAPSHOT.get(zone.name + '.304',
+                                    lambda: self._headers(304, cache='no-cache', etag=etag)))
+      return
+    head, body = SNAPSHOT.get(zone.name + '.json', lambda: self.sensors_json(zone, etag))
+    await wfd.awrite(head)
+    await wfd.awrite(body)
+
+  def sensors_json(self, zone, etag):
+    body = ujson.dumps(self.get_sensors(zone))
+    return (self._headers(200, b'json', content_len=len(body), cache='no-cache', etag=etag),
+            body)
+
+  @staticmethod
+  def get_sensors(zone):
+    """The counters are as fresh as the last version change"""
+    sensor = zone.sensor
     data = {}
-    data['fan'] = self.fan.status()
-    data['running'] = self.fan.is_running()
-    data['threshold'] = self.fan.threshold
-    data['temp'] = self.sensor.temp
-    data['humidity'] = self.sensor.humidity
-    data['pressure'] = self.sensor.pressure
-    gc.collect()
+    data['zone'] = zone.name
+    data['fan'] = zone.status()
+    data['running'] = zone.is_running()
+    data['duty'] = zone.duty
+    data.update(zone.stats())
+    data['threshold'] = zone.threshold
+    data['hysteresis'] = zone.hysteresis
+    data['sampling'] = zone.sampling
+    data['dew_spread'] = zone.dew_spread
+    data['profile'] = sensor.profile
+    data['temp'] = sensor.temp
+    data['humidity'] = sensor.humidity
+    data['pressure'] = sensor.pressure
+    data['dewpoint'] = sensor.dewpoint
+    data['abs_humidity'] = sensor.abs_humidity
+    data['stale'] = sensor.stale
+    data['health'] = sensor.health
     return data
 
+  def pack_sensors(self, fan):
+    """Pack the sensor record into the zone's preallocated buffer"""
+    data = fan.sensor.read_data()
+    buf = self._bin[fan.name]
+    struct.pack_into(SENSORS_FMT, buf, 0, SENSORS_VERSION,
+                     int(fan.sensor.cache_time) + UNIX_OFFSET,
+                     round(data['temperature'] * 100), round(data['humidity'] * 100),
+                     round(data['pressure'] * 100),
+                     fan.status() | (0x80 if fan.is_running() else 0), round(fan.duty * 100),
+                     round(data['dewpoint'] * 100), round(data['abs_humidity'] * 100))
+    return buf
+
   async def send_json(self, wfd, data):
     LOG.debug('send_json')
     jdata = ujson.dumps(data)
     await wfd.awrite(self._headers(200, b'json', content_len=len(jdata)))
     await wfd.awrite(jdata)
-    gc.collect()
 
-  async def send_file(self, wfd, url):
+  async def send_metrics(self, wfd):
+    await wfd.awrite(self._headers(200, b'metrics'))
+    await self.send_lines(wfd, METRICS.render())
+
+  async def send_logs(self, wfd):
+    await wfd.awrite(self._headers(200, b'txt'))
+    await self.send_lines(wfd, ('{:d} {}\n'.format(record[0], logging._format(record))
+                                for record in logging.records()))
+
+  @staticmethod
+  async def send_lines(wfd, lines):
+    buf = []
+    size = 0
+    for line in lines:
+      buf.append(line)
+      size += len(line)
+      if size > 512:
+        await wfd.awrite(''.join(buf))
+        buf, size = [], 0
+    await wfd.awrite(''.join(buf))
+
+  async def send_file(self, wfd, url, headers=None):
+    """Send the file, or its .gz copy made by tools/mkhtml.py if the client
+    accepts gzip"""
+    # Only the files under HTML_PATH
+    parts = url.lstrip(b'/').split(b'/')
+    if b'..' in parts or b'' in parts:
+      LOG.warning('Invalid path: %s', url)
+      await self.send_error(wfd, 404)
+      return
     fpath = b'/'.join([HTML_PATH, url.lstrip(b'/')])
     mime_type = fpath.split(b'.')[-1]
     LOG.debug('send_file: %s mime_type: %s', url, mime_type)
+    encoding = None
+    if headers and b'gzip' in headers.get(b'Accept-Encoding', b''):
+      try:
+        os.stat(fpath + b'.gz')
+        fpath += b'.gz'
+        encoding = 'gzip'
+      except OSError:
+        pass
     try:
       with open(fpath, 'rb') as fd:
-        await wfd.awrite(self._headers(200, mime_type, cache=-1))
-        for line in fd:
-          await wfd.awrite(line)
+        cache = HTML_CACHE.get(mime_type, STATIC_CACHE)
+        await wfd.awrite(self._headers(200, mime_type, cache=cache, encoding=encoding,
+                                       vary='Accept-Encoding'))
+        buf = bytearray(512)
+        while True:
+          size = fd.readinto(buf)
+          if not size:
+            break
+          await wfd.awrite(buf, 0, size)
     except OSError as err:
       LOG.debug('send file error: %s %s', err, url)
       await self.send_error(wfd, 404)
-    gc.collect()
 
   async def send_error(self, wfd, err_c):
     if err_c not in HTTPCodes:
       err_c = 400
     errors = HTTPCodes[err_c]
-    await wfd.awrite(self._headers(err_c) + HTML_ERROR.format(err_c, errors[1]))
-    gc.collect()
+    await wfd.awrite(self._headers(err_c) + HTML_ERROR.format(err_c, errors[1]).encode())
 
   async def send_redirect(self, wfd, location='/'):
     page = HTML_ERROR.format(303, 'redirect')
     await wfd.awrite(self._headers(303, location=location, content_len=len(page)))
-    await wfd.awrite(HTML_ERROR.format(303, 'redirect'))
-    gc.collect()
+    await wfd.awrite(page)
 
   def close(self):
     LOG.debug('Closing %d sockets', len(self.open_socks))
     for sock in self.open_socks:
       sock.close()
 
-  async def reboot(self, wfd):
-    jdata = ujson.dumps({"status": "reboot"})
+  async def reboot(self, wfd, data=None):
+    data = data or {}
+    data['status'] = 'reboot'
+    jdata = ujson.dumps(data)
     await wfd.awrite(self._headers(200, b'json', content_len=len(jdata)))
     await wfd.awrite(jdata)
     await asyncio.sleep_ms(500)
     reset()
 
   @staticmethod
-  def _headers(code, mime_type=None, location=None, content_len=0, cache=None):
+  def _headers(code, mime_type=None, location=None, content_len=0, cache=None, etag=None,
+               encoding=None, vary=None):
     try:
       labels = HTTPCodes[code]
     except KeyError:
       raise KeyError('HTTP code (%d) not found', code)
     headers = []
-    headers.append(b'HTTP/1.1 {:d} {}'.format(code, labels[0]))
-    headers.append(b'Content-Type: {}'.format(MIME_TYPES.get(mime_type, 'text/html')))
+    headers.append('HTTP/1.1 {:d} {}'.format(code, labels[0]))
+    headers.append('Content-Type: {}'.format(MIME_TYPES.get(mime_type, 'text/html')))
     if location:
-      headers.append(b'Location: {}'.format(location))
+      headers.append('Location: {}'.format(location))
     if content_len:
-      headers.append(b'Content-Length: {:d}'.format(content_len))
+      headers.append('Content-Length: {:d}'.format(content_len))
+    if etag:
+      headers.append('ETag: {}'.format(etag))
+    if encoding:
+      headers.append('Content-Encoding: {}'.format(encoding))
+    if vary:
+      headers.append('Vary: {}'.format(vary))
 
-    if cache and cache == -1:
-      headers.append(b'Cache-Control: public, max-age=604800, immutable')
-    elif cache and isinstance(cache, str):
-      headers.append(b'Cache-Control: '.format(cache))
-    headers.append(b'Connection: close')
-    gc.collect()
-    return b'\n'.join(headers) + b'\n\n'
+    if cache:
+      headers.append('Cache-Control: {}'.format(cache))
+    headers.append('Connection: close')
+    return ('\r\n'.join(headers) + '\r\n\r\n').encode()
 
 
 class MQTTData:
 
   def __init__(self, server, user, password, sname):
-    self.topic = bytes('{}/feeds/{}-{{:s}}'.format(user, sname.lower()), 'utf-8').format
+    from umqtt.simple import MQTTClient
+    self._topic = '{}/feeds/{}-{{:s}}'.format(user, sname.lower())
 
     client_id = hexlify(unique_id()).upper()
-    self.client = MQTTClient(client_id, server, user=user, password=password)
+    self.client = MQTTClient(client_id, server, user=user, password=password,
+                             keepalive=MQTT_KEEPALIVE)
     self.client.set_callback(self.buttons_cb)
-    self.client.connect()
+    self.online = False
+    self._reconnect = True
+    self.due = self._sent = time.ticks_ms()  # Next wakeup, last packet sent
+    self._next = {}                          # zone name -> next publication
+
+  def connect(self):
+    self._close()
+    # umqtt.simple 1.4 or later, the socket keeps the timeout until check_msg()
+    self.client.connect(timeout=MQTT_CONNECT_TIMEOUT)
     # Subscribe to topics
-    LOG.debug("Subscribe: %s", self.topic('force'))
-    self.client.subscribe(self.topic('force'))
+    for zone in ZONES:
+      LOG.debug("Subscribe: %s", self.topic('force', zone))
+      self.client.subscribe(self.topic('force', zone))
+    self._next = {}
+    self.online = True
+
+  def topic(self, key, zone=None):
+    """The feeds of the first zone have no zone name"""
+    if zone and not zone.primary:
+      key = '{}-{}'.format(zone.name, key)
+    return self._topic.format(key).encode()
+
+  def link_up(self):
+    self._reconnect = True
+
+  def link_down(self):
+    self.online = False
+    self._close()
+
+  def _close(self):
+    """umqtt.simple opens a new socket on each connect() and never closes the old one"""
+    sock, self.client.sock = getattr(self.client, 'sock', None), None
+    if sock:
+      try:
+        sock.close()
+      except OSError:
+        pass
 
   def buttons_cb(self, topic, value):
     LOG.info('Button pressed: %s %s', topic.decode(), value.decode())
-    if topic == self.topic('force') and value.upper() == b'TRUE':
-      FAN().status(FAN.ON)
-    elif topic == self.topic('force') and value.upper() == b'FALSE':
-      FAN().status(FAN.AUTOMATIC)
+    for zone in ZONES:
+      if topic != self.topic('force', zone):
+        continue
+      if value.upper() == b'TRUE':
+        zone.status(FAN.ON)
+      elif value.upper() == b'FALSE':
+        zone.status(FAN.AUTOMATIC)
 
   async def run(self):
-    sensor = EnvSensor()
-    if SAMPLING > 20:
-      nb_samples = 7
-      sampling = 1000 * (SAMPLING / nb_samples)
-    else:
-      nb_samples = 1
-      sampling = SAMPLING
-    sampling = int(sampling)
+    backoff = 1
 
     while True:
-      try:
-        for key in ['temperature', 'pressure', 'humidity']:
-          value = "{:.2f}".format(getattr(sensor, key))
-          self.client.publish(self.topic(key), bytes(value, 'utf-8'))
-          LOG.info('Publishing: %s: %s', key, value)
-          await asyncio.sleep_ms(10)
-
-        self.client.check_msg()
+      SUPERVISOR.checkin('mqtt')
+      if self._reconnect:
+        self._reconnect = False
+        try:
+          self.connect()
+          backoff = 1
+        except OSError as exc:
+          METRICS.incr('mqtt_fail')
+          LOG.error('MQTT connect %s %s', type(exc).__name__, exc)
+          self._close()
+      if not self.online:
+        # Wait for the backoff delay or for the WiFi link to come back
+        for _ in range(backoff * 2):
+          if self._reconnect:
+            break
+          await asyncio.sleep_ms(500)
+        backoff = min(backoff * 2, WIFI_BACKOFF_MAX)
+        self._reconnect = True
+        continue
 
+      try:
+        # Each zone is published every sampling period of its own
+        for zone in ZONES:
+          now = time.ticks_ms()
+          if time.ticks_diff(self._next.get(zone.name, now), now) > 0:
+            continue
+          self._next[zone.name] = time.ticks_add(now, zone.sampling * 1000)
+          sensor = zone.sensor
+          # Don't publish the last good reading as if it was new
+          keys = [] if sensor.stale else ['temperature', 'pressure', 'humidity', 'dewpoint',
+                                          'abs_humidity']
+          for key in keys:
+            value = "{:.2f}".format(getattr(sensor, key))
+            # Adafruit IO feed keys can't have an underscore
+            self.client.publish(self.topic(key.replace('_', '-'), zone), bytes(value, 'utf-8'))
+            METRICS.incr('mqtt_publish')
+            LOG.info('Publishing: %s %s: %s', zone.name, key, value)
+            await asyncio.sleep_ms(10)
+
+          stats = zone.stats()
+          for key, fmt in [('runtime', '{:d}'), ('kwh', '{:.3f}')]:
+            value = fmt.format(stats[key])
+            self.client.publish(self.topic(key, zone), bytes(value, 'utf-8'))
+            METRICS.incr('mqtt_publish')
+            LOG.info('Publishing: %s %s: %s', zone.name, key, value)
+            await asyncio.sleep_ms(10)
+          self._sent = time.ticks_ms()
+
+        # Check the incoming messages 7 times per sampling period of the
+        # fastest zone, until the next zone is due
+        step = int(min(zone.sampling for zone in ZONES) * 1000 / 7)
+        if MQTT_KEEPALIVE:
+          step = min(step, MQTT_KEEPALIVE * 500)
+        while True:
+          now = time.ticks_ms()
+          wait = min(time.ticks_diff(due, now) for due in self._next.values())
+          if wait <= 0:
+            break
+          self.client.check_msg()
+          if MQTT_KEEPALIVE and time.ticks_diff(time.ticks_ms(), self._sent) > MQTT_KEEPALIVE * 500:
+            self.client.ping()
+            self._sent = time.ticks_ms()
+          wait = min(wait, step)
+          self.due = time.ticks_add(now, wait)
+          await asyncio.sleep_ms(wait)
       except OSError as exc:
+        METRICS.incr('mqtt_fail')
         LOG.error('MQTT %s %s', type(exc).__name__, exc)
-        await asyncio.sleep_ms(750)
-      finally:
-        for _ in range(nb_samples):
-          self.client.check_msg()
-          await asyncio.sleep_ms(sampling)
-      gc.collect()
-
-def wifi_connect(ssid, password):
-  ap_if = network.WLAN(network.AP_IF)
-  ap_if.active(False)
-  sta_if = network.WLAN(network.STA_IF)
-  if not sta_if.isconnected():
-    LOG.info('Connecting to WiFi...')
-    sta_if.active(True)
-    sta_if.connect(ssid, password)
-    while not sta_if.isconnected():
-      time.sleep(1)
-  LOG.info('Network config: %s', sta_if.ifconfig())
-  gc.collect()
-  return sta_if
+        self.online = False
+        self._close()
+
+
+class WiFi:
+  """Keep the station connected, fail over between the configured networks"""
+
+  def __init__(self, networks):
+    self.networks = networks
+    self.sta_if = network.WLAN(network.STA_IF)
+    self.ssid = None
+    self.rssi = None
+    self.since = 0
+    self.stats = {'connects': 0, 'disconnects': 0, 'failures': 0}
+    self.connecting = False
+    self.due = time.ticks_ms()   # Next link check or connection attempt
+    self._listeners = []
+    self._current = 0
+
+  def subscribe(self, listener):
+    """The listener's link_up and link_down methods are called on link changes"""
+    self._listeners.append(listener)
+
+  def isconnected(self):
+    return self.ssid is not None
+
+  def info(self):
+    data = {'ssid': self.ssid, 'rssi': self.rssi, 'uptime': 0}
+    if self.ssid:
+      data['uptime'] = time.ticks_diff(time.ticks_ms(), self.since) // 1000
+      data['ifconfig'] = self.sta_if.ifconfig()
+    data.update(self.stats)
+    return data
+
+  def _incr(self, name):
+    self.stats[name] += 1
+    METRICS.incr('wifi_' + name)
+
+  async def _connect(self, ssid, password, timeout=WIFI_TIMEOUT):
+    LOG.info('Connecting to WiFi %s...', ssid)
+    self.sta_if.connect(ssid, password)
+    deadline = time.ticks_add(time.ticks_ms(), timeout * 1000)
+    while not self.sta_if.isconnected():
+      if time.ticks_diff(deadline, time.ticks_ms()) <= 0:
+        LOG.warning('WiFi %s connection timeout', ssid)
+        self.sta_if.disconnect()
+        return False
+      await asyncio.sleep_ms(250)
+    return True
+
+  async def connect(self):
+    # Start with the last network that worked
+    self.connecting = True
+    try:
+      for idx in range(len(self.networks)):
+        idx = (self._current + idx) % len(self.networks)
+        ssid, password = self.networks[idx]
+        if await self._connect(ssid, password):
+          self._current = idx
+          return ssid
+      return None
+    finally:
+      self.connecting = False
+
+  async def run(self):
+    ap_if = network.WLAN(network.AP_IF)
+    ap_if.active(False)
+    self.sta_if.active(True)
+    backoff = 5
+    while True:
+      SUPERVISOR.checkin('wifi')
+      if self.sta_if.isconnected():
+        self.rssi = self.sta_if.status('rssi')
+        METRICS.gauges['wifi_rssi'] = self.rssi
+        self.due = time.ticks_add(time.ticks_ms(), WIFI_CHECK * 1000)
+        await asyncio.sleep_ms(WIFI_CHECK * 1000)
+        continue
+
+      if self.ssid:
+        LOG.warning('WiFi connection to %s lost', self.ssid)
+        self.ssid = None
+        self._incr('disconnects')
+        for listener in self._listeners:
+          listener.link_down()
+
+      ssid = await self.connect()
+      if ssid is None:
+        self._incr('failures')
+        LOG.warning('WiFi not available, next try in %d seconds', backoff)
+        self.due = time.ticks_add(time.ticks_ms(), backoff * 1000)
+        await asyncio.sleep_ms(backoff * 1000)
+        backoff = min(backoff * 2, WIFI_BACKOFF_MAX)
+        continue
+
+      backoff = 5
+      self.ssid = ssid
+      self.since = time.ticks_ms()
+      self._incr('connects')
+      LOG.info('Network %s config: %s', ssid, self.sta_if.ifconfig())
+      for listener in self._listeners:
+        listener.link_up()
+
+class LowPower:
+  """Light sleep until the next task needs to run, while the fan is off,
+  WiFi is not associating and no HTTP client is connected"""
+
+  def __init__(self, zones, wifi):
+    self.zones = zones
+    self.wifi = wifi
+    self.server = None
+    self.mqtt = None
+
+  def idle(self):
+    for zone in self.zones:
+      if zone.is_running():
+        return False
+    # The association needs the radio, the backoff between two attempts doesn't
+    if self.wifi.connecting:
+      return False
+    # open_socks holds the listening socket and the clients
+    return not self.server or len(self.server.open_socks) <= 1
+
+  def next_wakeup(self):
+    """Milliseconds until the next sensor reading, WiFi check, MQTT check or
+    schedule transition"""
+    now = time.time()
+    delay = min(LP_MAX_SLEEP, time.ticks_diff(self.wifi.due, time.ticks_ms()))
+    for zone in self.zones:
+      delay = min(delay, (zone.sensor.due() - now) * 1000)
+      if zone.schedule.clock_set and zone.schedule.rules:
+        delay = min(delay, (60 - now % 60) * 1000)
+    if self.mqtt and self.mqtt.online:
+      delay = min(delay, time.ticks_diff(self.mqtt.due, time.ticks_ms()))
+    return int(delay)
+
+  async def run(self):
+    while True:
+      SUPERVISOR.checkin('power')
+      # Let the tasks due after the last sleep run first
+      await asyncio.sleep_ms(LP_MIN_SLEEP)
+      if not self.idle():
+        for zone in self.zones:
+          zone.sensor.low_power(False)
+        continue
+      delay = self.next_wakeup()
+      if delay < LP_MIN_SLEEP or not SUPERVISOR.feed():
+        continue
+      for zone in self.zones:
+        zone.sensor.low_power(True)
+      start = time.ticks_ms()
+      lightsleep(delay)
+      slept = time.ticks_diff(time.ticks_ms(), start)
+      SUPERVISOR.resume(slept)
+      METRICS.incr('sleeps')
+      METRICS.incr('sleep_ms', slept)
+
+def sync_clock():
+  try:
+    import ntptime
+    ntptime.settime()
+  except (ImportError, OSError, OverflowError) as err:
+    LOG.error('NTP error: %s', err)
+    return False
+  LOG.info('Clock synchronized: %s', time.localtime())
+  return True
+
+async def clock_sync(wifi):
+  """Set the clock from NTP, retry with a backoff until it works, then
+  synchronize it again every NTP_RESYNC seconds"""
+  backoff = NTP_RETRY
+  while True:
+    SUPERVISOR.checkin('ntp')
+    if wifi.isconnected() and sync_clock():
+      for zone in ZONES:
+        zone.schedule.clock_set = True
+      backoff = NTP_RETRY
+      delay = NTP_RESYNC
+    else:
+      delay = backoff
+      backoff = min(backoff * 2, NTP_RESYNC)
+    await asyncio.sleep_ms(delay * 1000)
 
 async def heartbeat():
   speed = 1500
   led = Pin(2, Pin.OUT, value=1)
-  wdt = WDT()
   while True:
     led.value(led.value() ^ 1)
-    wdt.feed()
+    SUPERVISOR.checkin('heartbeat')
+    gc_idle()
+    start = time.ticks_ms()
+    slept = METRICS.counters['sleep_ms']
     await asyncio.sleep_ms(speed)
+    slept = METRICS.counters['sleep_ms'] - slept
+    METRICS.loop_lag.observe(max(0, time.ticks_diff(time.ticks_ms(), start) - speed - slept))
 
-def main():
-  LOG.info('Last chance to press [^C]')
-  time.sleep(7)
-  i2c = I2C(scl=Pin(5), sda=Pin(4))
-  sensor = EnvSensor(i2c)
-  fan = FAN(Pin(15, Pin.OUT, value=0), sensor)
+async def network_services(loop, wifi, power=None):
+  """Start the services depending on the network once WiFi is up"""
+  while not wifi.isconnected():
+    await asyncio.sleep_ms(500)
+  # A failing service is logged, it doesn't keep the others from starting
+  if getattr(wc, 'SYSLOG', None):
+    try:
+      logging.addHandler(logging.SyslogHandler(*wc.SYSLOG, hostname=wc.SNAME,
+                                               appname='atticfan'))
+    except (OSError, IndexError) as err:
+      LOG.error('Syslog %s: %s', wc.SYSLOG, err)
+  SUPERVISOR.spawn('ntp', lambda: clock_sync(wifi))
+  server = Server(port=HTTP_PORT, wifi=wifi)
+  wifi.subscribe(server)
+  SUPERVISOR.spawn('server', lambda: server.run(loop))
+  if power:
+    power.server = server
+  if wc.MQTT and wc.IO_USERNAME:
+    try:
+      mqtt = MQTTData(wc.IO_URL, wc.IO_USERNAME, wc.IO_KEY, wc.SNAME)
+    except (ImportError, OSError) as err:
+      LOG.error('MQTT: %s', err)
+      return
+    wifi.subscribe(mqtt)
+    SUPERVISOR.spawn('mqtt', mqtt.run)
+    if power:
+      power.mqtt = mqtt
+
+def repl_requested():
+  """Pressing the BOOT button while the application starts keeps the REPL"""
+  return Pin(BOOT_PIN, Pin.IN, Pin.PULL_UP).value() == 0
 
-  wifi = wifi_connect(wc.SSID, wc.PASSWORD)
-  server = Server()
+def main():
+  if repl_requested():
+    LOG.info('Boot pin %d low, staying in the REPL', BOOT_PIN)
+    logging.flush()
+    return
 
+  try:
+    i2c = I2C(scl=Pin(I2C_SCL), sda=Pin(I2C_SDA), freq=I2C_FREQ)
+    ZONES.setup(i2c, ZONES_CONFIG)
+  except Exception as err:
+    LOG.exc(err, 'Setup error')
+    logging.flush()
+    raise
+
+  gc_setup()
   loop = asyncio.get_event_loop()
-  loop.create_task(heartbeat())
-  loop.create_task(fan.run())
-  loop.create_task(server.run(loop))
-  if wc.MQTT and wc.IO_USERNAME:
-    mqtt = MQTTData(wc.IO_URL, wc.IO_USERNAME, wc.IO_KEY, wc.SNAME)
-    loop.create_task(mqtt.run())
+  SUPERVISOR.spawn('logging', logging.drain)
+  SUPERVISOR.spawn('heartbeat', heartbeat)
+  SUPERVISOR.spawn('fan', ZONES.run, critical=True)
+  wifi = WiFi(getattr(wc, 'NETWORKS', [(wc.SSID, wc.PASSWORD)]))
+  SUPERVISOR.spawn('wifi', wifi.run)
+  power = None
+  if LOW_POWER:
+    power = LowPower(ZONES, wifi)
+    SUPERVISOR.spawn('power', power.run)
+  loop.create_task(network_services(loop, wifi, power))
+  loop.create_task(SUPERVISOR.run())
 
   try:
     loop.run_forever()
   except KeyboardInterrupt:
     LOG.info('Closing all connections')
+    logging.flush()
 
 if __name__ == "__main__":
     main()
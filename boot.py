@@ -1,38 +1,15 @@
 #
-# Verify if some packages are installed. Install the packages if they are missing and then reboot.
-# So far the only required package is logging.
+# The libraries (logging, bme280, psychro) are part of the application
+# and copied in /lib by ./flash.sh. The logging package from upip has a
+# different API, it can't be used in their place.
 
-import time
 import gc
 
-def temporize(ll=10):
-  for _ in range(ll):
-    print('.', end='')
-    time.sleep(1)
-  print('')
-
-def do_connect():
-  import wificonfig as wc
-  import network
-  sta_if = network.WLAN(network.STA_IF)
-  if not sta_if.isconnected():
-    print('Connecting to network...')
-    sta_if.active(True)
-    sta_if.connect(wc.SSID, wc.PASSWORD)
-    while not sta_if.isconnected():
-      time.sleep(1)
-  print('Network config:', sta_if.ifconfig())
-
 try:
   import logging
-except ImportError:
-  temporize()
-  do_connect()
-  from machine import reset
-  from upip import install
-  install('logging')
-  temporize(3)
-  reset()
+  logging.drain
+except (ImportError, AttributeError):
+  print('The lib/logging module is missing or outdated, run ./flash.sh')
 
 def no_debug():
   import esp
@@ -1,30 +1,72 @@
 #!/bin/bash
 #
+# ./flash.sh build   - Cross compile the modules into build/
+# ./flash.sh deploy  - Copy the application, its libraries and the web pages on the device
+# ./flash.sh all     - Build and copy everything, including wificonfig and main.py
+#
 set -xe
 
+MPY_CROSS=${MPY_CROSS:-mpy-cross}
+AMPY=${AMPY:-/opt/local/bin/ampy -d 1}
+BUILD=build
+
+MODULES="atticfan.py lib/logging.py lib/bme280.py lib/psychro.py wificonfig.py"
+
 delay() {
     sleep 1
 }
 
-#delay && /opt/local/bin/ampy -d 1 mkdir lib
-#delay && /opt/local/bin/ampy -d 1 mkdir html
-
-#mpy-cross lib/logging.py
-#delay && /opt/local/bin/ampy -d 1 put lib/logging.mpy lib/logging.mpy
-
-#mpy-cross lib/bme280.py
-#delay && /opt/local/bin/ampy -d 1 put lib/bme280.mpy lib/bme280.mpy
-
-#mpy-cross -v wificonfig.py
-#delay && /opt/local/bin/ampy -d 1 put wificonfig.mpy
-
-#delay && /opt/local/bin/ampy -d 1 put main.py
+build() {
+    rm -rf ${BUILD}
+    mkdir -p ${BUILD}/lib ${BUILD}/html
+    for module in ${MODULES}; do
+	${MPY_CROSS} -v -o ${BUILD}/${module%.py}.mpy ${module}
+    done
+    cp main.py ${BUILD}/main.py
+    python3 tools/mkhtml.py html/index.html ${BUILD}/html
+}
 
-~/bin/cssmin -f html/style.css
-delay && /opt/local/bin/ampy -d 1 put html/style.min.css html/style.min.css
-delay && /opt/local/bin/ampy -d 1 put html/index.html html/index.html
+deploy_config() {
+    delay && ${AMPY} put ${BUILD}/wificonfig.mpy wificonfig.mpy
+    delay && ${AMPY} put ${BUILD}/main.py main.py
+}
 
-mpy-cross -v atticfan.py
-delay && /opt/local/bin/ampy -d 1 put atticfan.mpy
+deploy() {
+    delay && ${AMPY} mkdir lib || true
+    delay && ${AMPY} mkdir html || true
+    delay && ${AMPY} rm html/style.min.css || true
+    # The upip package boot.py used to install, it has a different API
+    delay && ${AMPY} rmdir lib/logging || true
+    delay && ${AMPY} put ${BUILD}/html/index.html html/index.html
+    delay && ${AMPY} put ${BUILD}/html/index.html.gz html/index.html.gz
+    for module in ${MODULES}; do
+	case ${module} in
+	    lib/*)
+		# A .py module would be imported instead of the .mpy
+		delay && ${AMPY} rm ${module} || true
+		delay && ${AMPY} put ${BUILD}/${module%.py}.mpy ${module%.py}.mpy
+		;;
+	esac
+    done
+    delay && ${AMPY} put boot.py boot.py
+    delay && ${AMPY} put ${BUILD}/atticfan.mpy atticfan.mpy
+    delay && ${AMPY} ls
+}
 
-delay && /opt/local/bin/ampy -d 1 ls
+case "${1:-default}" in
+    build)
+	build
+	;;
+    deploy)
+	deploy
+	;;
+    all)
+	build
+	deploy_config
+	deploy
+	;;
+    *)
+	build
+	deploy
+	;;
+esac
@@ -61,6 +61,7 @@ _BME280_TEMP_PRESS_CALIB_DATA_ADDR    = const(0x88)
 _BME280_HUMIDITY_CALIB_DATA_ADDR      = const(0xE1)
 _BME280_PWR_CTRL_ADDR                 = const(0xF4)
 _BME280_CTRL_HUM_ADDR                 = const(0xF2)
+_BME280_STATUS_ADDR                   = const(0xF3)
 _BME280_CTRL_MEAS_ADDR                = const(0xF4)
 _BME280_CONFIG_ADDR                   = const(0xF5)
 _BME280_DATA_ADDR                     = const(0xF7)
@@ -83,6 +84,14 @@ class BME280:
             raise ValueError('A configured I2C object is required.')
         self.i2c = i2c
 
+        self.reinit()
+
+    def reinit(self):
+        """
+        Verify the chip ID, reset the sensor and load its calibration data.
+        Call it again after a bus error or a sensor reset, then write the
+        measurement settings and the power mode again.
+        """
         self._read_chip_id()
         self._soft_reset()
         self._load_calibration_data()
@@ -98,7 +107,7 @@ class BME280:
             if mem[0] == _BME280_CHIP_ID:
                 return
             sleep_ms(1)
-        raise Exception("Couldn't read BME280 chip ID after 5 attempts.")
+        raise OSError("Couldn't read BME280 chip ID after 5 attempts.")
 
     def _soft_reset(self):
         """
@@ -136,7 +145,7 @@ class BME280:
                                             _BME280_HUMIDITY_CALIB_DATA_ADDR,
                                             _BME280_HUMIDITY_CALIB_DATA_LEN)
 
-        self.cal_dig_H2, self.cal_dig_H3 = unpack("<hB", hum_cal_mem)
+        self.cal_dig_H2, self.cal_dig_H3 = unpack_from("<hB", hum_cal_mem)
 
         e4_sign = unpack_from("<b", hum_cal_mem, 3)[0]
         self.cal_dig_H4 = (e4_sign << 4) | (hum_cal_mem[4] & 0b00001111)
@@ -206,10 +215,10 @@ class BME280:
             if settings['osr_h'] not in oversampling_options:
                 raise ValueError("osr_h must be one of the oversampling defines")
         if 'osr_p' in settings:
-            if settings['osr_h'] not in oversampling_options:
+            if settings['osr_p'] not in oversampling_options:
                 raise ValueError("osr_p must be one of the oversampling defines")
         if 'osr_t' in settings:
-            if settings['osr_h'] not in oversampling_options:
+            if settings['osr_t'] not in oversampling_options:
                 raise ValueError("osr_t must be one of the oversampling defines")
         if 'filter' in settings:
             if settings['filter'] not in filter_options:
@@ -292,12 +301,52 @@ class BME280:
             self._soft_reset()
             self._write_measurement_settings(settings)
 
+    def measurement_time_us(self, settings: dict = None) -> int:
+        """
+        Maximum duration of one measurement cycle, in microseconds, for the
+        given settings or for the current settings of the sensor.
+
+        See the data sheet, section 9.1
+        """
+        if settings is None:
+            settings = self.get_measurement_settings()
+        t_us = 1250
+        for key, extra in (('osr_t', 0), ('osr_p', 575), ('osr_h', 575)):
+            osr = settings.get(key, BME280_NO_OVERSAMPLING)
+            if osr != BME280_NO_OVERSAMPLING:
+                t_us += 2300 * (1 << (min(osr, BME280_OVERSAMPLING_16X) - 1)) + extra
+        return t_us
+
+    def force_measurement(self, wait_us: int = None):
+        """
+        Start a measurement in forced mode and wait until it's done.  The
+        sensor goes back to sleep mode once the conversion is finished.
+        wait_us defaults to the measurement time of the current settings.
+
+        See the data sheet, section 3.3.3
+        """
+        mem = self.i2c.readfrom_mem(self.address, _BME280_PWR_CTRL_ADDR, 1)
+        newval = (mem[0] & 0b11111100) | BME280_FORCED_MODE
+        self.i2c.writeto_mem(self.address, _BME280_PWR_CTRL_ADDR, bytearray([newval]))
+        if wait_us is None:
+            wait_us = self.measurement_time_us()
+        sleep_ms(wait_us // 1000 + 1)
+        for _ in range(10):
+            if not self.i2c.readfrom_mem(self.address, _BME280_STATUS_ADDR, 1)[0] & 0b00001000:
+                return
+            sleep_ms(1)
+        raise OSError("BME280 measurement timeout")
+
     def get_measurement(self):
         """
         Return a set of measurements in decimal value, compensated with the
         sensor's stored calibration data.
         """
         uncompensated_data = self._read_uncompensated_data()
+        # 0x80000 is the value of a skipped measurement, and what the data
+        # registers hold after a power-on reset.
+        if uncompensated_data['temperature'] == 0x80000:
+            raise OSError("BME280 temperature measurement skipped")
 
         # Be sure to call self._compensate_temperature() first, as it sets a
         # global "fine" calibration value for the other two compensation
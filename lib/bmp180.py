@@ -37,6 +37,7 @@ class BMP180():
     '''
 
     _bmp_addr = 119             # adress of BMP180 is hardcoded on the sensor
+    max_failures = 8            # failed conversions in a row before blocking_read() gives up
 
     # init
     def __init__(self, i2c_bus):
@@ -69,6 +70,9 @@ class BMP180():
         self.MSB_raw = None
         self.LSB_raw = None
         self.XLSB_raw = None
+        self.errors = 0
+        self.failures = 0       # failed conversions in a row
+        self.error = None
         self.gauge = self.makegauge() # Generator instance
         for _ in range(128):
             next(self.gauge)
@@ -88,32 +92,44 @@ class BMP180():
         '''
         delays = (5, 8, 14, 25)
         while True:
-            self._bmp_i2c.writeto_mem(self._bmp_addr, 0xF4, bytearray([0x2E]))
-            t_start = time.ticks_ms()
-            while (time.ticks_ms() - t_start) <= 5: # 5mS delay
-                yield None
             try:
-                self.UT_raw = self._bmp_i2c.readfrom_mem(self._bmp_addr, 0xF6, 2)
-            except:
-                yield None
-            self._bmp_i2c.writeto_mem(self._bmp_addr, 0xF4, bytearray([0x34+(self.oversample_setting << 6)]))
-            t_pressure_ready = delays[self.oversample_setting]
-            t_start = time.ticks_ms()
-            while (time.ticks_ms() - t_start) <= t_pressure_ready:
-                yield None
-            try:
-                self.MSB_raw = self._bmp_i2c.readfrom_mem(self._bmp_addr, 0xF6, 1)
-                self.LSB_raw = self._bmp_i2c.readfrom_mem(self._bmp_addr, 0xF7, 1)
-                self.XLSB_raw = self._bmp_i2c.readfrom_mem(self._bmp_addr, 0xF8, 1)
-            except:
+                self._bmp_i2c.writeto_mem(self._bmp_addr, 0xF4, bytearray([0x2E]))
+                t_start = time.ticks_ms()
+                while (time.ticks_ms() - t_start) <= 5: # 5mS delay
+                    yield None
+                UT_raw = self._bmp_i2c.readfrom_mem(self._bmp_addr, 0xF6, 2)
+                self._bmp_i2c.writeto_mem(self._bmp_addr, 0xF4, bytearray([0x34+(self.oversample_setting << 6)]))
+                t_pressure_ready = delays[self.oversample_setting]
+                t_start = time.ticks_ms()
+                while (time.ticks_ms() - t_start) <= t_pressure_ready:
+                    yield None
+                MSB_raw = self._bmp_i2c.readfrom_mem(self._bmp_addr, 0xF6, 1)
+                LSB_raw = self._bmp_i2c.readfrom_mem(self._bmp_addr, 0xF7, 1)
+                XLSB_raw = self._bmp_i2c.readfrom_mem(self._bmp_addr, 0xF8, 1)
+            except OSError as err:
+                # Don't keep serving the bytes of an older conversion
+                self.errors += 1
+                self.failures += 1
+                self.error = err
+                self.UT_raw = self.MSB_raw = self.LSB_raw = self.XLSB_raw = None
                 yield None
+                continue
+            self.UT_raw = UT_raw
+            self.MSB_raw, self.LSB_raw, self.XLSB_raw = MSB_raw, LSB_raw, XLSB_raw
+            self.failures = 0
             yield True
 
     def blocking_read(self):
+        '''
+        Wait for a new measurement. Raise the OSError of the bus after
+        max_failures failed conversions in a row.
+        '''
+        self.failures = 0
         if next(self.gauge) is not None: # Discard old data
             pass
         while next(self.gauge) is None:
-            pass
+            if self.failures >= self.max_failures:
+                raise self.error
 
     @property
     def oversample_sett(self):
@@ -133,10 +149,9 @@ class BMP180():
         Temperature in degree C.
         '''
         next(self.gauge)
-        try:
-            UT = unp('>H', self.UT_raw)[0]
-        except:
-            return 0.0
+        if self.UT_raw is None:
+            raise OSError('BMP180: no valid measurement')
+        UT = unp('>H', self.UT_raw)[0]
         X1 = (UT-self._AC6)*self._AC5/2**15
         X2 = self._MC*2**11/(X1+self._MD)
         self.B5_raw = X1+X2
@@ -149,12 +164,11 @@ class BMP180():
         '''
         next(self.gauge)
         self.temperature  # Populate self.B5_raw
-        try:
-            MSB = unp('B', self.MSB_raw)[0]
-            LSB = unp('B', self.LSB_raw)[0]
-            XLSB = unp('B', self.XLSB_raw)[0]
-        except:
-            return 0.0
+        if self.MSB_raw is None:
+            raise OSError('BMP180: no valid measurement')
+        MSB = unp('B', self.MSB_raw)[0]
+        LSB = unp('B', self.LSB_raw)[0]
+        XLSB = unp('B', self.XLSB_raw)[0]
         UP = ((MSB << 16)+(LSB << 8)+XLSB) >> (8-self.oversample_setting)
         B6 = self.B5_raw-4000
         X1 = (self._B2*(B6**2/2**12))/2**11
@@ -181,7 +195,7 @@ class BMP180():
         Altitude in m.
         '''
         try:
-            p = -7990.0*math.log(self._pressure/self.baseline)
-        except:
+            p = -7990.0*math.log(self.mb_pressure/self.baseline)
+        except ValueError:
             p = 0.0
         return p
@@ -1,4 +1,5 @@
 import sys
+import time
 
 CRITICAL = 50
 ERROR    = 40
@@ -16,52 +17,183 @@ _level_dict = {
 }
 
 _stream = sys.stderr
+_ring = None
+_handlers = []
+
+def _level_str(level):
+    l = _level_dict.get(level)
+    if l is not None:
+        return l
+    return "LVL%s" % level
+
+def _format(record):
+    return "%s:%s:%s" % (_level_str(record[1]), record[2], record[3])
+
+
+class Ring:
+    """
+    Bounded buffer of log records. When the buffer is full the oldest
+    records are overwritten.
+    """
+
+    def __init__(self, size):
+        self.records = [None] * size
+        self.head = 0       # Number of records written
+        self.tail = 0       # Number of records drained
+        self.dropped = 0
+
+    def append(self, record):
+        size = len(self.records)
+        if self.head - self.tail >= size:
+            self.tail += 1
+            self.dropped += 1
+        self.records[self.head % size] = record
+        self.head += 1
+
+    def __iter__(self):
+        size = len(self.records)
+        for idx in range(max(0, self.head - size), self.head):
+            yield self.records[idx % size]
+
+    def pending(self):
+        size = len(self.records)
+        while self.tail < self.head:
+            record = self.records[self.tail % size]
+            self.tail += 1
+            yield record
+
+
+class SyslogHandler:
+    """
+    Send the log records to a syslog server (RFC 5424) over UDP.
+
+    Records are batched, newline separated, in datagrams of up to `size`
+    bytes. The socket is non-blocking; when the queue of datagrams is
+    full or the network can't take them the records are dropped.
+    """
+
+    FACILITY = 16           # local0
+    SEVERITY = {CRITICAL: 2, ERROR: 3, WARNING: 4, INFO: 6, DEBUG: 7}
+
+    def __init__(self, host, port=514, hostname="-", appname="-", size=512, queue=4):
+        try:
+            import usocket as socket
+        except ImportError:
+            import socket
+        self.addr = socket.getaddrinfo(host, port, 0, socket.SOCK_DGRAM)[0][-1]
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        self.header = " %s %s - " % (hostname, appname)
+        self.size = size
+        self.queue = queue
+        self.datagrams = []
+        self.batch = []
+        self.batch_len = 0
+        self.dropped = 0
+
+    @staticmethod
+    def _timestamp(t):
+        tm = time.gmtime(t)
+        if tm[0] < 2020:
+            return "-"      # The clock has not been set
+        return "%04d-%02d-%02dT%02d:%02d:%02dZ" % tm[:6]
+
+    def format(self, record):
+        pri = self.FACILITY * 8 + self.SEVERITY.get(record[1], 5)
+        return "<%d>1 %s%s%s - %s" % (pri, self._timestamp(record[0]), self.header,
+                                      record[2] or "-", record[3])
+
+    def emit(self, record):
+        line = self.format(record).encode()[:self.size]
+        if self.batch_len + len(line) + 1 > self.size:
+            self._push()
+        self.batch.append(line)
+        self.batch_len += len(line) + 1
+
+    def _push(self):
+        if not self.batch:
+            return
+        if len(self.datagrams) >= self.queue:
+            self.dropped += self.datagrams.pop(0).count(b"\n") + 1
+        self.datagrams.append(b"\n".join(self.batch))
+        self.batch = []
+        self.batch_len = 0
+
+    def flush(self):
+        self._push()
+        while self.datagrams:
+            datagram = self.datagrams.pop(0)
+            try:
+                self.sock.sendto(datagram, self.addr)
+            except OSError:
+                self.dropped += datagram.count(b"\n") + 1
+                for datagram in self.datagrams:
+                    self.dropped += datagram.count(b"\n") + 1
+                self.datagrams = []
+
 
 class Logger:
 
     level = NOTSET
+    cutoff = INFO
 
     def __init__(self, name):
         self.name = name
+        self.cutoff = _level
 
     def _level_str(self, level):
-        l = _level_dict.get(level)
-        if l is not None:
-            return l
-        return "LVL%s" % level
+        return _level_str(level)
 
     def setLevel(self, level):
         self.level = level
+        self.cutoff = level or _level
 
     def isEnabledFor(self, level):
-        return level >= (self.level or _level)
+        return level >= self.cutoff
 
     def log(self, level, msg, *args):
-        if level >= (self.level or _level):
-            _stream.write("%s:%s:" % (self._level_str(level), self.name))
-            if not args:
-                print(msg, file=_stream)
-            else:
-                print(msg % args, file=_stream)
+        if level >= self.cutoff:
+            self._log(level, msg, args)
+
+    def _log(self, level, msg, args):
+        if args:
+            # Arguments can be callables, evaluated only when the record is emitted.
+            msg = msg % tuple(arg() if callable(arg) else arg for arg in args)
+        record = (time.time(), level, self.name, msg)
+        if _ring is not None:
+            _ring.append(record)
+        else:
+            print(_format(record), file=_stream)
+            for h in _handlers:
+                h.emit(record)
+                h.flush()
 
     def debug(self, msg, *args):
-        self.log(DEBUG, msg, *args)
+        if DEBUG >= self.cutoff:
+            self._log(DEBUG, msg, args)
 
     def info(self, msg, *args):
-        self.log(INFO, msg, *args)
+        if INFO >= self.cutoff:
+            self._log(INFO, msg, args)
 
     def warning(self, msg, *args):
-        self.log(WARNING, msg, *args)
+        if WARNING >= self.cutoff:
+            self._log(WARNING, msg, args)
 
     def error(self, msg, *args):
-        self.log(ERROR, msg, *args)
+        if ERROR >= self.cutoff:
+            self._log(ERROR, msg, args)
 
     def critical(self, msg, *args):
-        self.log(CRITICAL, msg, *args)
+        if CRITICAL >= self.cutoff:
+            self._log(CRITICAL, msg, args)
 
     def exc(self, e, msg, *args):
-        self.log(ERROR, msg, *args)
-        sys.print_exception(e, _stream)
+        if ERROR >= self.cutoff:
+            import io
+            buf = io.StringIO()
+            sys.print_exception(e, buf)
+            self._log(ERROR, msg % args + "\n" + buf.getvalue().rstrip(), ())
 
     def exception(self, msg, *args):
         self.exc(sys.exc_info()[1], msg, *args)
@@ -83,11 +215,44 @@ def info(msg, *args):
 def debug(msg, *args):
     getLogger(None).debug(msg, *args)
 
-def basicConfig(level=INFO, filename=None, stream=None, format=None):
-    global _level, _stream
+def addHandler(handler):
+    _handlers.append(handler)
+
+def records():
+    """Return the records kept in the ring buffer, oldest first"""
+    if _ring is None:
+        return iter(())
+    return iter(_ring)
+
+def flush():
+    """Write the pending records of the ring buffer to the stream and the
+    handlers. Used by drain(), and before returning when the event loop
+    doesn't run."""
+    if _ring is None:
+        return
+    for record in _ring.pending():
+        print(_format(record), file=_stream)
+        for h in _handlers:
+            h.emit(record)
+    for h in _handlers:
+        h.flush()
+
+async def drain(period_ms=250):
+    """Write the records from the ring buffer to the stream"""
+    import uasyncio as asyncio
+    while True:
+        flush()
+        await asyncio.sleep_ms(period_ms)
+
+def basicConfig(level=INFO, filename=None, stream=None, format=None, ring=None):
+    global _level, _stream, _ring
     _level = level
+    for l in _loggers.values():
+        l.cutoff = l.level or _level
     if stream:
         _stream = stream
+    if ring:
+        _ring = Ring(ring)
     if filename is not None:
         print("logging.basicConfig: filename arg is not supported")
     if format is not None:
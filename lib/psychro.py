@@ -0,0 +1,72 @@
+#
+# (c) W6BSD Fred Cirera
+# Check the file LICENCE on https://github.com/0x9900/AtticFan
+#
+"""Dew point and absolute humidity without floating point math.
+
+The saturation vapor pressure over water is tabulated for every degree
+from -40 to 60 C and interpolated linearly in between. All the
+intermediate values fit in a small int, the results are the same on
+CPython and on MicroPython, and nothing is allocated on the heap.
+"""
+
+from array import array
+
+T_MIN = -40
+T_MAX = 60
+
+# Saturation vapor pressure in deci-pascal from T_MIN to T_MAX, Magnus
+# formula with the Alduchov and Eskridge coefficients:
+#   round(6109.4 * exp(17.625 * t / (t + 243.04)))
+SVP = array('I', (
+    190, 210, 233, 258, 285, 315, 348, 383, 422, 464,
+    511, 561, 616, 675, 740, 810, 886, 968, 1057, 1154,
+    1258, 1370, 1492, 1623, 1764, 1916, 2080, 2256, 2446, 2649,
+    2868, 3102, 3353, 3622, 3911, 4219, 4549, 4902, 5278, 5680,
+    6109, 6567, 7055, 7574, 8127, 8716, 9341, 10007, 10713, 11464,
+    12260, 13105, 14001, 14950, 15955, 17020, 18146, 19338, 20597, 21928,
+    23334, 24819, 26386, 28038, 29781, 31617, 33552, 35590, 37735, 39992,
+    42367, 44863, 47486, 50242, 53137, 56176, 59364, 62710, 66217, 69894,
+    73747, 77783, 82009, 86433, 91062, 95904, 100968, 106261, 111793, 117571,
+    123606, 129906, 136481, 143341, 150497, 157958, 165735, 173839, 182282, 191075,
+    200230,
+))
+
+# Water vapor molar mass over the gas constant, in 0.01 g/m3 per dPa per
+# 0.01 K: 100 * 100 * 18.01528 / 8.314462 / 10
+_AH_FACTOR = 2167
+
+
+def saturation(t100):
+    """Saturation vapor pressure in dPa at `t100` hundredths of a degree"""
+    t100 = min(max(t100, T_MIN * 100), T_MAX * 100)
+    idx, frac = divmod(t100 - T_MIN * 100, 100)
+    if frac == 0:
+        return SVP[idx]
+    return SVP[idx] + (SVP[idx + 1] - SVP[idx]) * frac // 100
+
+
+def dewpoint100(vapor):
+    """Dew point in hundredths of a degree for the vapor pressure in dPa"""
+    if vapor <= SVP[0]:
+        return T_MIN * 100
+    if vapor >= SVP[-1]:
+        return T_MAX * 100
+    low, high = 0, len(SVP) - 1
+    while high - low > 1:
+        mid = (low + high) // 2
+        if SVP[mid] <= vapor:
+            low = mid
+        else:
+            high = mid
+    return (T_MIN + low) * 100 + (vapor - SVP[low]) * 100 // (SVP[high] - SVP[low])
+
+
+def derive(temp, humidity):
+    """Return the dew point (C) and the absolute humidity (g/m3) for the
+    temperature (C) and the relative humidity (%)"""
+    t100 = int(round(temp * 100))
+    rh10 = min(max(int(round(humidity * 10)), 0), 1000)
+    vapor = saturation(t100) * rh10 // 1000
+    absolute = _AH_FACTOR * vapor // (t100 + 27315)
+    return dewpoint100(vapor) / 100, absolute / 100
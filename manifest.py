@@ -0,0 +1,10 @@
+# Manifest to freeze the application into a custom MicroPython firmware.
+#   make -C ports/esp32 BOARD=GENERIC FROZEN_MANIFEST=/path/to/AtticFan/manifest.py
+#
+# wificonfig.py is not frozen, it stays on the filesystem with the
+# credentials of each device.
+
+include("$(PORT_DIR)/boards/manifest.py")
+
+freeze(".", "atticfan.py")
+freeze("lib", ("logging.py", "bme280.py", "psychro.py"))
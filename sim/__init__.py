@@ -0,0 +1,145 @@
+#
+# (c) W6BSD Fred Cirera
+# Check the file LICENCE on https://github.com/0x9900/AtticFan
+#
+"""Simulated hardware to run atticfan on a host.
+
+`install()` registers fake `machine`, `network`, `ntptime`,
+`umqtt.simple` and `wificonfig` modules, and under CPython the
+MicroPython specific modules (uasyncio, ujson, utime...). It has to be
+called before importing atticfan.
+"""
+
+import math
+import sys
+
+from sim.clock import CLOCK
+
+# Two levels up from sim/__init__.py, which is relative with `micropython -m sim.run`
+ROOT = '/'.join(__file__.split('/')[:-2]) or '.'
+CPYTHON = sys.implementation.name == 'cpython'
+
+# 2026-06-21 00:00 UTC
+EPOCH = 1782000000
+
+
+def _install_cpython():
+  import binascii
+  import builtins
+  import gc
+  import hashlib
+  import json
+  import socket
+  import struct
+  import time
+  import traceback
+
+  from sim import micropython
+  from sim import uasyncio
+  from sim import uselect
+  from sim import utime
+
+  builtins.const = micropython.const
+  for name in ('time', 'ticks_ms', 'ticks_us', 'ticks_diff', 'ticks_add', 'sleep_ms', 'sleep_us'):
+    setattr(time, name, getattr(utime, name))
+
+  heap = {'size': 111168, 'threshold': -1}
+  def mem_alloc():
+    import tracemalloc
+    return tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else 0
+  def mem_free():
+    return max(0, heap['size'] - mem_alloc())
+  def threshold(amount=None):
+    if amount is None:
+      return heap['threshold']
+    heap['threshold'] = amount
+  gc.mem_alloc = mem_alloc
+  gc.mem_free = mem_free
+  gc.threshold = threshold
+
+  sys.print_exception = lambda exc, file=sys.stdout: traceback.print_exception(
+    type(exc), exc, exc.__traceback__, file=file)
+
+  sys.modules.update({
+    'micropython': micropython,
+    'uasyncio': uasyncio,
+    'ubinascii': binascii,
+    'uhashlib': hashlib,
+    'ujson': json,
+    'uselect': uselect,
+    'usocket': socket,
+    'ustruct': struct,
+    'utime': utime,
+  })
+
+
+def install(epoch=EPOCH):
+  CLOCK.epoch = epoch
+  if CPYTHON:
+    _install_cpython()
+    # asyncio keeps the logging module of the standard library it imported,
+    # lib/logging is imported by atticfan in its place.
+    logging = sys.modules.get('logging')
+    if logging and not logging.__file__.startswith(ROOT + '/lib/'):
+      del sys.modules['logging']
+  for path in (ROOT + '/lib', ROOT):
+    if path not in sys.path:
+      sys.path.insert(0, path)
+
+  from sim import machine
+  from sim import network
+  from sim import ntptime
+  from sim import wificonfig
+  from sim import umqtt
+  from sim.umqtt import simple
+
+  sys.modules.update({
+    'machine': machine,
+    'network': network,
+    'ntptime': ntptime,
+    'umqtt': umqtt,
+    'umqtt.simple': simple,
+    'wificonfig': wificonfig,
+  })
+
+
+def reset():
+  """Forget the zones and the hardware state between two runs"""
+  from sim import machine
+  from sim import network
+  machine.Pin.pins.clear()
+  machine.Pin.inputs.clear()
+  machine.Pin.outputs.clear()
+  machine.I2C.devices.clear()
+  machine.I2C.faults = None
+  network.WLAN._interfaces.clear()
+  network.ACCESS_POINTS.clear()
+  atticfan = sys.modules.get('atticfan')
+  if atticfan:
+    atticfan.ZONES.zones.clear()
+
+
+class Attic:
+  """Attic temperature, driven by the outside temperature and the sun.
+  Running the fan pulls it toward the outside temperature."""
+
+  def __init__(self, fan_pin=15, temperature=20.0, clock=CLOCK):
+    self.fan_pin = fan_pin
+    self.temperature = temperature
+    self.clock = clock
+    self.last = clock.now()
+
+  def outside(self, hour):
+    return 16 + 6 * math.sin(2 * math.pi * (hour - 9) / 24)
+
+  def __call__(self):
+    from sim.machine import Pin
+    now = self.clock.now()
+    elapsed, self.last = now - self.last, now
+    hour = (self.clock.time() % 86400) / 3600
+    outside = self.outside(hour)
+    sun = max(0, 20 * math.sin(2 * math.pi * (hour - 6) / 24))
+    target = outside + sun * (1 - 0.6 * Pin.level(self.fan_pin))
+    self.temperature += (target - self.temperature) * min(1, elapsed / 1200)
+    humidity = max(5, min(95, 55 - 2 * (self.temperature - outside)))
+    return self.temperature, humidity, 1013.25
@@ -0,0 +1,100 @@
+#
+# (c) W6BSD Fred Cirera
+# Check the file LICENCE on https://github.com/0x9900/AtticFan
+#
+"""Register model of a BME280 sensor.
+
+The calibration values are stored with the same layout as the real
+chip, the raw measurements are computed from the environment with the
+compensation functions of lib/bme280.py.
+"""
+
+from struct import pack
+
+import bme280
+
+CHIP_ID = 0x60
+RESET = 0xB6
+
+# Typical calibration values of a BME280.
+CALIBRATION = {
+  'T1': 28245, 'T2': 26393, 'T3': 50,
+  'P1': 36829, 'P2': -10638, 'P3': 3024, 'P4': 7185, 'P5': -41,
+  'P6': -7, 'P7': 9900, 'P8': -10230, 'P9': 4285,
+  'H1': 75, 'H2': 362, 'H3': 0, 'H4': 313, 'H5': 50, 'H6': 30,
+}
+
+
+class BME280Model:
+
+  def __init__(self, environment, calibration=CALIBRATION):
+    """`environment` returns a (temperature, humidity, pressure) tuple"""
+    self.environment = environment
+    self.regs = bytearray(256)
+    self.regs[0xD0] = CHIP_ID
+    self.reset()
+    cal = calibration
+    self.regs[0x88:0xA2] = pack('<HhhHhhhhhhhhBB', cal['T1'], cal['T2'], cal['T3'],
+                                cal['P1'], cal['P2'], cal['P3'], cal['P4'], cal['P5'],
+                                cal['P6'], cal['P7'], cal['P8'], cal['P9'], 0, cal['H1'])
+    self.regs[0xE1:0xE8] = pack('<hBBBBb', cal['H2'], cal['H3'], (cal['H4'] >> 4) & 0xFF,
+                                (cal['H4'] & 0x0F) | ((cal['H5'] & 0x0F) << 4),
+                                (cal['H5'] >> 4) & 0xFF, cal['H6'])
+    # Use the driver to decode the calibration and compensate the values.
+    self._driver = bme280.BME280.__new__(bme280.BME280)
+    self._driver.address = 0
+    self._driver.i2c = self
+    self._driver._load_calibration_data()
+    self.conversions = 0
+
+  # The driver reads the calibration through this minimal I2C interface.
+  def readfrom_mem(self, _addr, reg, length):
+    return self.read(reg, length)
+
+  def read(self, reg, length):
+    # In normal mode the data registers always hold a fresh conversion
+    if reg <= 0xF7 < reg + length and self.regs[0xF4] & 0x03 == bme280.BME280_NORMAL_MODE:
+      self._measure()
+    return bytes(self.regs[reg:reg + length])
+
+  def write(self, reg, data):
+    if reg == 0xE0:
+      if data[0] == RESET:
+        self.reset()
+      return
+    self.regs[reg:reg + len(data)] = data
+    if reg <= 0xF4 < reg + len(data) and self.regs[0xF4] & 0x03 == bme280.BME280_FORCED_MODE:
+      # One conversion, then back to sleep mode
+      self._measure()
+      self.regs[0xF4] &= 0xFC
+
+  def reset(self):
+    """Power-on reset: the settings are cleared, the data registers hold
+    the value of a skipped measurement"""
+    self.regs[0xF2] = self.regs[0xF4] = self.regs[0xF5] = 0
+    self.regs[0xF7:0xFF] = bytes([0x80, 0, 0, 0x80, 0, 0, 0x80, 0])
+
+  @staticmethod
+  def _search(func, target, high, increasing=True):
+    low = 0
+    while low < high:
+      mid = (low + high) // 2
+      value = func(mid)
+      if (value < target) == increasing:
+        low = mid + 1
+      else:
+        high = mid
+    return low
+
+  def _measure(self):
+    temperature, humidity, pressure = self.environment()
+    drv = self._driver
+    adc_t = self._search(drv._compensate_temperature, temperature, 1 << 20)
+    drv._compensate_temperature(adc_t)       # Sets cal_t_fine
+    adc_p = self._search(lambda x: drv._compensate_pressure(x) / 100, pressure, 1 << 20, False)
+    adc_h = self._search(drv._compensate_humidity, humidity, 1 << 16)
+    self.regs[0xF7:0xFF] = bytes([
+      adc_p >> 12, (adc_p >> 4) & 0xFF, (adc_p & 0x0F) << 4,
+      adc_t >> 12, (adc_t >> 4) & 0xFF, (adc_t & 0x0F) << 4,
+      adc_h >> 8, adc_h & 0xFF])
+    self.conversions += 1
@@ -0,0 +1,75 @@
+#
+# (c) W6BSD Fred Cirera
+# Check the file LICENCE on https://github.com/0x9900/AtticFan
+#
+"""Virtual clock for the simulation.
+
+With CPython the event loop runs on virtual time: when there is nothing
+to do the clock jumps to the next timer instead of waiting for it. Under
+the MicroPython unix port the clock follows the real time.
+"""
+
+import time
+
+
+class Clock:
+
+  def __init__(self, epoch=0):
+    self.epoch = epoch      # Unix time of the start of the simulation
+    self.virtual = False
+    self._now = 0.0
+    self._start = time.monotonic() if hasattr(time, 'monotonic') else 0
+
+  def now(self):
+    """Seconds elapsed since the start of the simulation"""
+    if self.virtual:
+      return self._now
+    return time.monotonic() - self._start
+
+  def advance(self, seconds):
+    if self.virtual:
+      self._now += seconds
+
+  def ticks_ms(self):
+    return int(self.now() * 1000)
+
+  def ticks_us(self):
+    return int(self.now() * 1000000)
+
+  def time(self):
+    return self.epoch + int(self.now())
+
+
+CLOCK = Clock()
+
+
+def virtual_loop(clock=CLOCK):
+  """Return a CPython asyncio event loop running on the virtual clock"""
+  import asyncio
+
+  class _Selector:
+    def __init__(self, selector):
+      self._selector = selector
+
+    def select(self, timeout=None):
+      events = self._selector.select(0)
+      if events or timeout == 0:
+        return events
+      if timeout is None:
+        return self._selector.select(None)
+      clock.advance(timeout)
+      return []
+
+    def __getattr__(self, name):
+      return getattr(self._selector, name)
+
+  class VirtualLoop(asyncio.SelectorEventLoop):
+    def __init__(self):
+      super().__init__()
+      self._selector = _Selector(self._selector)
+
+    def time(self):
+      return clock.now()
+
+  clock.virtual = True
+  return VirtualLoop()
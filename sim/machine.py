@@ -0,0 +1,217 @@
+#
+# (c) W6BSD Fred Cirera
+# Check the file LICENCE on https://github.com/0x9900/AtticFan
+#
+"""Fake `machine` module"""
+
+import random
+
+from sim.clock import CLOCK
+
+
+class Pin:
+  IN = 1
+  OUT = 3
+  OPEN_DRAIN = 7
+  PULL_UP = 1
+  PULL_DOWN = 2
+
+  pins = {}               # All the pins created, by id
+  inputs = {}             # pin id -> function(pin) returning the level read
+  outputs = {}            # pin id -> function(level) called on each write
+
+  def __init__(self, pin_id, mode=-1, pull=-1, value=None):
+    self.id = pin_id
+    self.pull = None
+    self._value = 0
+    self.pwm = None
+    self.init(mode, pull, value)
+    Pin.pins[pin_id] = self
+
+  def init(self, mode=-1, pull=-1, value=None):
+    if mode != -1:
+      self.mode = mode
+    if pull != -1:
+      self.pull = pull
+      if pull == Pin.PULL_UP:
+        self._value = 1
+    if value is not None:
+      self._value = int(bool(value))
+
+  def value(self, val=None):
+    if val is None:
+      if self.id in Pin.inputs:
+        return Pin.inputs[self.id](self)
+      return self._value
+    self._value = int(bool(val))
+    if self.id in Pin.outputs:
+      Pin.outputs[self.id](self._value)
+
+  def on(self):
+    self._value = 1
+
+  def off(self):
+    self._value = 0
+
+  @classmethod
+  def level(cls, pin_id):
+    """Output level of a pin, between 0.0 and 1.0 when it is driven by PWM"""
+    pin = cls.pins.get(pin_id)
+    if pin is None:
+      return 0.0
+    if pin.pwm is not None:
+      return pin.pwm.duty() / 1023
+    return float(pin._value)
+
+
+class PWM:
+
+  def __init__(self, pin, freq=1000, duty=0):
+    self.pin = pin
+    self._freq = freq
+    self._duty = duty
+    pin.pwm = self
+
+  def freq(self, val=None):
+    if val is None:
+      return self._freq
+    self._freq = val
+
+  def duty(self, val=None):
+    if val is None:
+      return self._duty
+    self._duty = max(0, min(1023, val))
+
+  def deinit(self):
+    self.pin.pwm = None
+
+
+class I2CFaults:
+  """Fault injection on the I2C bus, each transaction can:
+  - fail (NACK or timeout)
+  - leave a device holding SDA low, the bus is then stuck until SCL is
+    clocked a few times
+  - find the sensor just reset by a brown-out
+  - return a corrupted byte"""
+
+  def __init__(self, rate, scl, sda, seed=0):
+    self.rate = rate
+    random.seed(seed)
+    self.stuck = 0          # SCL clocks before the device releases SDA
+    self.counts = {'errors': 0, 'stuck': 0, 'resets': 0, 'spikes': 0, 'recoveries': 0}
+    Pin.inputs[sda] = lambda pin: pin._value if not self.stuck else 0
+    Pin.outputs[scl] = self._clock
+
+  def _clock(self, level):
+    if self.stuck and not level:
+      self.stuck -= 1
+      if not self.stuck:
+        self.counts['recoveries'] += 1
+
+  def _chance(self, factor):
+    return random.random() < self.rate * factor
+
+  def transfer(self, device):
+    """Called before each transaction"""
+    if self.stuck:
+      raise OSError(116)    # ETIMEDOUT
+    if self._chance(0.1):
+      self.counts['stuck'] += 1
+      self.stuck = random.randint(1, 8)
+      raise OSError(116)
+    if self._chance(1):
+      self.counts['errors'] += 1
+      raise OSError(19)     # NACK
+    if self._chance(0.1) and hasattr(device, 'reset'):
+      self.counts['resets'] += 1
+      device.reset()
+
+  def corrupt(self, data):
+    if len(data) < 8 or not self._chance(0.2):
+      return data
+    self.counts['spikes'] += 1
+    data = bytearray(data)
+    data[3] ^= 1 << random.randint(0, 7)   # Temperature MSB
+    return bytes(data)
+
+
+class I2C:
+
+  devices = {}            # address -> register model
+  faults = None           # I2CFaults
+
+  def __init__(self, *args, scl=None, sda=None, freq=400000):
+    self.init(scl=scl, sda=sda, freq=freq)
+
+  def init(self, scl=None, sda=None, freq=400000):
+    self.scl = scl
+    self.sda = sda
+    self.freq = freq
+
+  def _device(self, addr):
+    device = self.devices.get(addr)
+    if device is None:
+      raise OSError(19)     # ENODEV
+    if I2C.faults:
+      I2C.faults.transfer(device)
+    return device
+
+  def scan(self):
+    return sorted(self.devices)
+
+  def start(self):
+    pass
+
+  def stop(self):
+    pass
+
+  def readfrom_mem(self, addr, reg, nbytes):
+    data = self._device(addr).read(reg, nbytes)
+    if I2C.faults:
+      data = I2C.faults.corrupt(data)
+    return data
+
+  def writeto_mem(self, addr, reg, buf):
+    self._device(addr).write(reg, bytes(buf))
+
+
+class WDT:
+
+  instance = None
+
+  def __init__(self, id=0, timeout=5000):
+    self.timeout = timeout
+    self.last_feed = CLOCK.ticks_ms()
+    self.feeds = 0
+    self.expired = 0
+    WDT.instance = self
+
+  def feed(self):
+    now = CLOCK.ticks_ms()
+    if now - self.last_feed > self.timeout:
+      self.expired += 1
+    self.last_feed = now
+    self.feeds += 1
+
+
+class Reset(SystemExit):
+  pass
+
+
+_sleeps = []
+
+def lightsleep(time_ms=None):
+  _sleeps.append(time_ms)
+  CLOCK.advance((time_ms or 0) / 1000)
+
+def deepsleep(time_ms=None):
+  raise Reset('deepsleep')
+
+def reset():
+  raise Reset('machine.reset()')
+
+def unique_id():
+  return b'\x24\x0a\xc4\x00\x51\x7a'
+
+def freq(hz=None):
+  return 240000000
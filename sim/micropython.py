@@ -0,0 +1,10 @@
+"""Fake `micropython` module for CPython"""
+
+def const(value):
+  return value
+
+def mem_info(*args):
+  pass
+
+def opt_level(*args):
+  return 0
@@ -0,0 +1,71 @@
+#
+# (c) W6BSD Fred Cirera
+# Check the file LICENCE on https://github.com/0x9900/AtticFan
+#
+"""Fake `network` module"""
+
+from sim.clock import CLOCK
+
+STA_IF = 0
+AP_IF = 1
+
+STAT_IDLE = 1000
+STAT_CONNECTING = 1001
+STAT_GOT_IP = 1010
+
+# Simulated access points: ssid -> {'password': ..., 'rssi': ..., 'up': ...}
+ACCESS_POINTS = {}
+ASSOCIATION_TIME = 2.0    # Seconds
+
+
+class WLAN:
+
+  _interfaces = {}
+
+  def __new__(cls, interface=STA_IF):
+    if interface not in cls._interfaces:
+      wlan = super().__new__(cls)
+      wlan.interface = interface
+      wlan._active = False
+      wlan._ssid = None
+      wlan._connected_at = None
+      cls._interfaces[interface] = wlan
+    return cls._interfaces[interface]
+
+  def active(self, is_active=None):
+    if is_active is None:
+      return self._active
+    self._active = bool(is_active)
+
+  def connect(self, ssid=None, password=None):
+    self._ssid = None
+    ap = ACCESS_POINTS.get(ssid)
+    if ap and ap.get('password') == password:
+      self._ssid = ssid
+      self._connected_at = CLOCK.now() + ASSOCIATION_TIME
+
+  def disconnect(self):
+    self._ssid = None
+
+  def isconnected(self):
+    if not self._active or self._ssid is None:
+      return False
+    if not ACCESS_POINTS.get(self._ssid, {}).get('up', True):
+      self._ssid = None
+      return False
+    return CLOCK.now() >= self._connected_at
+
+  def status(self, param=None):
+    if param == 'rssi':
+      return ACCESS_POINTS.get(self._ssid, {}).get('rssi', -100)
+    if self.isconnected():
+      return STAT_GOT_IP
+    return STAT_CONNECTING if self._ssid else STAT_IDLE
+
+  def ifconfig(self):
+    return ('127.0.0.1', '255.0.0.0', '127.0.0.1', '127.0.0.1')
+
+  def config(self, *args, **kwargs):
+    if args == ('essid',):
+      return self._ssid
+    return None
@@ -0,0 +1,20 @@
+#
+# (c) W6BSD Fred Cirera
+# Check the file LICENCE on https://github.com/0x9900/AtticFan
+#
+"""Fake `ntptime` module, the simulation clock is always right"""
+
+from sim import network
+
+host = 'pool.ntp.org'
+failures = 0    # Number of the next synchronizations that time out
+calls = 0
+
+def settime():
+  global failures, calls
+  calls += 1
+  if not network.WLAN(network.STA_IF).isconnected():
+    raise OSError(113)
+  if failures:
+    failures -= 1
+    raise OSError(110)
@@ -0,0 +1,158 @@
+#
+# (c) W6BSD Fred Cirera
+# Check the file LICENCE on https://github.com/0x9900/AtticFan
+#
+"""Run atticfan.main() on the simulated hardware.
+
+  python3 -m sim.run [--duration SECONDS] [--realtime] [--port PORT] [--tracemalloc]
+                     [--low-power] [--zones 1|2] [--i2c-faults RATE]
+  micropython -m sim.run [--duration SECONDS] [--low-power] [--zones 1|2] [--i2c-faults RATE]
+
+With CPython the simulation runs on a virtual clock (a simulated day
+takes a few seconds) unless --realtime is given. The MicroPython unix
+port always runs in real time. With --tracemalloc, CPython's allocations
+are reported as the heap usage. With --zones 2 a second zone, with its
+own attic model and BME280, is driven by the same controller. With
+--i2c-faults, RATE is the probability that an I2C transaction fails.
+Stuck buses, sensor resets and corrupted readings are injected as well.
+A JSON summary is printed at the end.
+"""
+
+import os
+import sys
+
+import sim
+from sim.clock import CLOCK
+
+
+def parse_args(argv):
+  args = {'duration': 3600, 'realtime': not sim.CPYTHON, 'port': 8080, 'tracemalloc': False,
+          'low_power': False, 'zones': 1, 'i2c_faults': 0.0}
+  argv = list(argv)
+  while argv:
+    opt = argv.pop(0)
+    if opt == '--duration':
+      args['duration'] = float(argv.pop(0))
+    elif opt == '--realtime':
+      args['realtime'] = True
+    elif opt == '--port':
+      args['port'] = int(argv.pop(0))
+    elif opt == '--tracemalloc':
+      args['tracemalloc'] = True
+    elif opt == '--low-power':
+      args['low_power'] = True
+    elif opt == '--zones':
+      args['zones'] = int(argv.pop(0))
+      if args['zones'] not in (1, 2):
+        raise SystemExit('The I2C bus has room for two BME280')
+    elif opt == '--i2c-faults':
+      args['i2c_faults'] = float(argv.pop(0))
+    else:
+      raise SystemExit(__doc__)
+  return args
+
+
+def setup(args):
+  """Install the fake modules and build the simulated world"""
+  sim.install()
+  sim.reset()
+  from sim import machine
+  from sim import network
+  from sim.bme280_model import BME280Model
+
+  import wificonfig
+  wificonfig.HTTP_PORT = args['port']
+  wificonfig.LOW_POWER = args['low_power']
+  network.ACCESS_POINTS[wificonfig.SSID] = {'password': wificonfig.PASSWORD, 'rssi': -61}
+  wificonfig.ZONES = [{'name': 'attic', 'pin': 15, 'address': 0x76},
+                      {'name': 'garage', 'pin': 13, 'address': 0x77}][:args['zones']]
+  machine.I2C.devices[0x76] = BME280Model(sim.Attic())
+  if args['zones'] > 1:
+    machine.I2C.devices[0x77] = BME280Model(sim.Attic(fan_pin=13, temperature=18.0))
+
+  if args['i2c_faults']:
+    machine.I2C.faults = machine.I2CFaults(args['i2c_faults'], scl=5, sda=4)
+
+  if sim.CPYTHON:
+    import asyncio
+    import tempfile
+    state_dir = tempfile.mkdtemp(prefix='atticfan-')
+    if args['tracemalloc']:
+      import tracemalloc
+      tracemalloc.start()
+    if not args['realtime']:
+      from sim.clock import virtual_loop
+      asyncio.set_event_loop(virtual_loop())
+    else:
+      asyncio.set_event_loop(asyncio.new_event_loop())
+  else:
+    state_dir = '/tmp'
+
+  import atticfan
+  atticfan.STATE_FILE = state_dir + '/state.json'
+  # The OTA updates land in a scratch file system
+  atticfan.OTA_ROOT = state_dir + '/fs'
+  for path in ('', '/lib', '/html'):
+    try:
+      os.mkdir(atticfan.OTA_ROOT + path)
+    except OSError:
+      pass
+  # Serve the page built by `./flash.sh build` when there is one
+  html = sim.ROOT + '/build/html'
+  try:
+    os.stat(html + '/index.html')
+  except OSError:
+    html = sim.ROOT + '/html'
+  atticfan.HTML_PATH = html.encode()
+  return atticfan
+
+
+def summary(atticfan, start):
+  from sim import machine
+  from sim.umqtt import simple
+  fan = atticfan.ZONES.primary
+  wdt = machine.WDT.instance
+  return {
+    'elapsed': CLOCK.now() - start,
+    'fan': fan.stats(),
+    'temperature': fan.sensor.temp,
+    'zones': {zone.name: {'fan': zone.stats(), 'temperature': zone.sensor.temp}
+              for zone in atticfan.ZONES},
+    'wdt': {'feeds': wdt.feeds, 'expired': wdt.expired} if wdt else None,
+    'mqtt_messages': len(simple.MESSAGES),
+    'mqtt_sockets': simple.Socket.opened,
+    'sensor_conversions': sum(dev.conversions for dev in machine.I2C.devices.values()),
+    'i2c_faults': machine.I2C.faults.counts if machine.I2C.faults else None,
+    'lightsleep': {'count': len(machine._sleeps),
+                   'total_ms': sum(ms or 0 for ms in machine._sleeps),
+                   'min_ms': min([ms or 0 for ms in machine._sleeps] or [0]),
+                   'max_ms': max([ms or 0 for ms in machine._sleeps] or [0])},
+    'counters': atticfan.METRICS.counters,
+    'tasks': {name: {'restarts': task['restarts'], 'error': task['error']}
+              for name, task in atticfan.SUPERVISOR.tasks.items()},
+  }
+
+
+def run(args):
+  atticfan = setup(args)
+  import uasyncio as asyncio
+  loop = asyncio.get_event_loop()
+
+  async def stop():
+    await asyncio.sleep(args['duration'])
+    loop.stop()
+
+  start = CLOCK.now()
+  loop.create_task(stop())
+  atticfan.main()
+  return summary(atticfan, start)
+
+
+def main():
+  result = run(parse_args(sys.argv[1:]))
+  import ujson
+  print(ujson.dumps(result))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,123 @@
+#
+# (c) W6BSD Fred Cirera
+# Check the file LICENCE on https://github.com/0x9900/AtticFan
+#
+"""The subset of uasyncio used by atticfan, on top of CPython's asyncio"""
+
+import asyncio
+
+CancelledError = asyncio.CancelledError
+TimeoutError = asyncio.TimeoutError
+Event = asyncio.Event
+Lock = asyncio.Lock
+gather = asyncio.gather
+sleep = asyncio.sleep
+
+_tasks = set()
+
+
+def sleep_ms(ms):
+  return asyncio.sleep(ms / 1000)
+
+def create_task(coro):
+  task = asyncio.get_event_loop().create_task(coro)
+  # asyncio only keeps weak references to the tasks
+  _tasks.add(task)
+  task.add_done_callback(_tasks.discard)
+  return task
+
+def wait_for(coro, timeout):
+  return asyncio.wait_for(coro, timeout)
+
+def wait_for_ms(coro, timeout):
+  return asyncio.wait_for(coro, timeout / 1000)
+
+def run(coro):
+  return get_event_loop().run_until_complete(coro)
+
+
+class _Loop:
+
+  def __init__(self, loop):
+    self.loop = loop
+
+  def create_task(self, coro):
+    return create_task(coro)
+
+  def run_forever(self):
+    self.loop.run_forever()
+
+  def run_until_complete(self, coro):
+    return self.loop.run_until_complete(coro)
+
+  def stop(self):
+    self.loop.stop()
+
+  def close(self):
+    pass
+
+
+def get_event_loop(*args):
+  return _Loop(asyncio.get_event_loop())
+
+
+class StreamReader:
+
+  def __init__(self, sock, *args):
+    sock.setblocking(False)
+    self.sock = sock
+    self.buf = b''
+
+  async def _fill(self, size=1024):
+    data = await asyncio.get_event_loop().sock_recv(self.sock, size)
+    self.buf += data
+    return data
+
+  async def readline(self):
+    while b'\n' not in self.buf:
+      if not await self._fill():
+        break
+    idx = self.buf.find(b'\n') + 1 or len(self.buf)
+    line, self.buf = self.buf[:idx], self.buf[idx:]
+    return line
+
+  async def read(self, n=-1):
+    if not self.buf:
+      await self._fill(n if n > 0 else 1024)
+    if n < 0:
+      n = len(self.buf)
+    data, self.buf = self.buf[:n], self.buf[n:]
+    return data
+
+  async def readinto(self, buf):
+    data = await self.read(len(buf))
+    buf[:len(data)] = data
+    return len(data)
+
+  async def wait_closed(self):
+    pass
+
+  def close(self):
+    self.sock.close()
+
+
+class StreamWriter(StreamReader):
+
+  def __init__(self, sock, *args):
+    super().__init__(sock)
+    self.out = b''
+
+  async def awrite(self, data, off=0, sz=-1):
+    if isinstance(data, str):
+      data = data.encode()
+    data = bytes(data)
+    if sz == -1:
+      sz = len(data) - off
+    await asyncio.get_event_loop().sock_sendall(self.sock, data[off:off + sz])
+
+  def write(self, data):
+    self.out += data.encode() if isinstance(data, str) else bytes(data)
+
+  async def drain(self):
+    data, self.out = self.out, b''
+    await self.awrite(data)
@@ -0,0 +1,72 @@
+#
+# (c) W6BSD Fred Cirera
+# Check the file LICENCE on https://github.com/0x9900/AtticFan
+#
+"""Fake MQTT client, the messages are kept in `MESSAGES`"""
+
+from sim import network
+
+MESSAGES = []
+INBOX = []                # (topic, message) delivered by check_msg()
+
+
+class Socket:
+  """The session socket, with the timeout given to connect()"""
+  opened = 0
+
+  def __init__(self, timeout):
+    Socket.opened += 1
+    self.timeout = timeout
+    self.closed = False
+
+  def close(self):
+    if not self.closed:
+      Socket.opened -= 1
+    self.closed = True
+
+
+class MQTTClient:
+
+  def __init__(self, client_id, server, port=0, user=None, password=None, keepalive=0, **kwargs):
+    self.client_id = client_id
+    self.server = server
+    self.callback = None
+    self.connected = False
+    self.subscriptions = []
+    self.sock = None
+
+  def set_callback(self, callback):
+    self.callback = callback
+
+  def _check(self):
+    if not network.WLAN(network.STA_IF).isconnected():
+      self.connected = False
+      raise OSError(113)    # EHOSTUNREACH
+    if not self.connected or self.sock is None or self.sock.closed:
+      raise OSError(104)    # ECONNRESET
+
+  def connect(self, clean_session=True, timeout=None):
+    # Like umqtt.simple, the previous socket is not closed
+    self.sock = Socket(timeout)
+    self.connected = True
+    self._check()
+    return 0
+
+  def disconnect(self):
+    self.connected = False
+
+  def ping(self):
+    self._check()
+
+  def subscribe(self, topic, qos=0):
+    self._check()
+    self.subscriptions.append(topic)
+
+  def publish(self, topic, msg, retain=False, qos=0):
+    self._check()
+    MESSAGES.append((topic, msg))
+
+  def check_msg(self):
+    self._check()
+    while INBOX:
+      self.callback(*INBOX.pop(0))
@@ -0,0 +1,38 @@
+#
+# (c) W6BSD Fred Cirera
+# Check the file LICENCE on https://github.com/0x9900/AtticFan
+#
+"""`uselect` for CPython. On the virtual clock poll() never blocks."""
+
+import select
+
+from select import POLLERR, POLLHUP, POLLIN, POLLOUT
+
+from sim.clock import CLOCK
+
+
+class _Poll:
+
+  def __init__(self):
+    self._poll = select.poll()
+
+  def register(self, obj, eventmask=POLLIN | POLLOUT):
+    self._poll.register(obj, eventmask)
+
+  def unregister(self, obj):
+    self._poll.unregister(obj)
+
+  def modify(self, obj, eventmask):
+    self._poll.modify(obj, eventmask)
+
+  def poll(self, timeout=-1):
+    if CLOCK.virtual:
+      events = self._poll.poll(0)
+      if not events and timeout > 0:
+        CLOCK.advance(timeout / 1000)
+      return events
+    return self._poll.poll(timeout)
+
+
+def poll():
+  return _Poll()
@@ -0,0 +1,34 @@
+#
+# (c) W6BSD Fred Cirera
+# Check the file LICENCE on https://github.com/0x9900/AtticFan
+#
+"""`utime` for CPython, on the simulation clock"""
+
+from time import gmtime, localtime, mktime, strftime
+
+from sim.clock import CLOCK
+
+
+def time():
+  return CLOCK.time()
+
+def ticks_ms():
+  return CLOCK.ticks_ms()
+
+def ticks_us():
+  return CLOCK.ticks_us()
+
+def ticks_diff(ticks1, ticks2):
+  return ticks1 - ticks2
+
+def ticks_add(ticks, delta):
+  return ticks + delta
+
+def sleep(seconds):
+  CLOCK.advance(seconds)
+
+def sleep_ms(ms):
+  CLOCK.advance(ms / 1000)
+
+def sleep_us(us):
+  CLOCK.advance(us / 1000000)
@@ -0,0 +1,16 @@
+# Configuration used by the simulation
+
+SSID = 'sim-ap'
+PASSWORD = 'sim-password'
+
+IO_USERNAME = 'sim'
+IO_URL = 'localhost'
+IO_KEY = 'sim-key'
+
+MQTT = True
+SNAME = 'sim'
+
+HTTP_PORT = 8080
+LOG_LEVEL = 20
+FAN_WATTS = 60
+OTA_TOKEN = 'sim-token'
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+#
+# (c) W6BSD Fred Cirera
+# Check the file LICENCE on https://github.com/0x9900/AtticFan
+#
+"""Load test the embedded HTTP server.
+
+Drive a controller (a device, the simulation or the unix port) with
+concurrent clients and print throughput, latency percentiles, peak heap
+and failures as JSON.
+
+  tools/bench_server.py --boot --clients 8 --duration 20
+  tools/bench_server.py --target 192.168.1.20:80 --mix sensors=8,static=1,togglefan=1
+  tools/bench_server.py --boot --flood --clients 16 --duration 30 --max-lag 100 \
+      --mix sensors=8,static=1,bad_request=1,bad_threshold=1
+
+Answers 429 (rate limited) and 503 (connection pool full) are counted
+apart from the failures. The event loop lag histogram is read from
+/metrics before and after the run. After the run the server must answer
+/api/v1/sensors again with all its connection slots free, and with
+--max-lag no loop lag above MS may have been recorded during the run.
+The exit status is 1 when a check fails, or when a request fails
+unless --flood says the server is overloaded on purpose.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+ROUTES = {
+  'static': '/',
+  'sensors': '/api/v1/sensors',
+  'sensors_bin': '/api/v1/sensors.bin',
+  'togglefan': '/api/v1/togglefan',
+  'bad_request': '/ x',               # Four words on the request line
+  'bad_threshold': '/?threshold=1=2',
+}
+# Answer expected from the server, 200 when not listed
+EXPECTED = {
+  'bad_request': 400,
+  'bad_threshold': 400,
+}
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(values, pct):
+  if not values:
+    return None
+  values = sorted(values)
+  idx = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+  return values[idx]
+
+
+async def http_get(host, port, path, timeout):
+  """Return the status code and the size of the response"""
+  reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+  try:
+    writer.write('GET {} HTTP/1.1\r\nHost: {}\r\n\r\n'.format(path, host).encode())
+    await writer.drain()
+    data = await asyncio.wait_for(reader.read(), timeout)
+  finally:
+    writer.close()
+  if not data.startswith(b'HTTP/'):
+    raise ValueError('invalid response')
+  return int(data.split(None, 2)[1]), len(data)
+
+
+class Stats:
+
+  def __init__(self):
+    self.latency = {}
+    self.failures = {}
+    self.throttled = 0
+    self.rejected = 0
+    self.loop_lag = {}
+    self.bytes = 0
+    self.heap_free = []
+    self.heap_alloc = []
+
+  def ok(self, route, elapsed, size):
+    self.latency.setdefault(route, []).append(elapsed)
+    self.bytes += size
+
+  def fail(self, route, reason):
+    key = '{}:{}'.format(route, reason)
+    self.failures[key] = self.failures.get(key, 0) + 1
+
+  def report(self, elapsed, args):
+    every = [x for values in self.latency.values() for x in values]
+    def summary(values):
+      return {
+        'count': len(values),
+        'p50_ms': percentile(values, 50),
+        'p90_ms': percentile(values, 90),
+        'p99_ms': percentile(values, 99),
+        'max_ms': max(values) if values else None,
+      }
+    return {
+      'target': '{}:{}'.format(args.host, args.port),
+      'clients': args.clients,
+      'duration': round(elapsed, 3),
+      'requests': len(every),
+      'throughput_rps': round(len(every) / elapsed, 2) if elapsed else 0,
+      'bytes': self.bytes,
+      'latency': summary(every),
+      'routes': {route: summary(values) for route, values in self.latency.items()},
+      'failures': self.failures,
+      'failure_count': sum(self.failures.values()),
+      'throttled': self.throttled,
+      'rejected': self.rejected,
+      'loop_lag_ms': self.loop_lag,
+      'heap_free_min': min(self.heap_free) if self.heap_free else None,
+      'heap_alloc_peak': max(self.heap_alloc) if self.heap_alloc else None,
+    }
+
+
+async def client(args, mix, stats, deadline):
+  routes, weights = zip(*mix)
+  while time.monotonic() < deadline:
+    route = random.choices(routes, weights)[0]
+    start = time.monotonic()
+    try:
+      status, size = await http_get(args.host, args.port, ROUTES[route], args.timeout)
+    except asyncio.TimeoutError:
+      stats.fail(route, 'timeout')
+      continue
+    except (OSError, ValueError) as err:
+      stats.fail(route, type(err).__name__)
+      await asyncio.sleep(0.05)
+      continue
+    if status == 429:
+      stats.throttled += 1
+    elif status == 503:
+      stats.rejected += 1
+    elif status != EXPECTED.get(route, 200):
+      stats.fail(route, str(status))
+    else:
+      stats.ok(route, (time.monotonic() - start) * 1000, size)
+
+
+async def heap_monitor(args, stats, deadline):
+  while time.monotonic() < deadline:
+    try:
+      _, _ = await scrape_heap(args, stats)
+    except (OSError, ValueError, asyncio.TimeoutError):
+      pass
+    await asyncio.sleep(args.heap_interval)
+
+
+async def get_metrics(args):
+  reader, writer = await asyncio.wait_for(asyncio.open_connection(args.host, args.port), args.timeout)
+  try:
+    writer.write(b'GET /metrics HTTP/1.1\r\n\r\n')
+    await writer.drain()
+    return (await asyncio.wait_for(reader.read(), args.timeout)).decode()
+  finally:
+    writer.close()
+
+
+async def loop_lag(args):
+  """Return the cumulative loop lag histogram as {bucket: count}"""
+  buckets = {}
+  for line in (await get_metrics(args)).splitlines():
+    if line.startswith('atticfan_loop_lag_ms_bucket{'):
+      bound = line.split('le="', 1)[1].split('"', 1)[0]
+      buckets[bound] = int(line.split()[-1])
+  return buckets
+
+
+def lag_over(lag, max_lag):
+  """Number of loop lag observations in the buckets above `max_lag` ms"""
+  below = [count for bound, count in lag.items() if bound != '+Inf' and float(bound) <= max_lag]
+  return lag.get('+Inf', 0) - max(below or [0])
+
+
+async def open_sockets(args):
+  for line in (await get_metrics(args)).splitlines():
+    if line.startswith('atticfan_open_sockets '):
+      return int(line.split()[1])
+  return None
+
+
+async def scrape_heap(args, stats):
+  data = await get_metrics(args)
+  free = alloc = None
+  for line in data.splitlines():
+    if line.startswith('atticfan_heap_free_bytes '):
+      free = int(line.split()[1])
+      stats.heap_free.append(free)
+    elif line.startswith('atticfan_heap_alloc_bytes '):
+      alloc = int(line.split()[1])
+      stats.heap_alloc.append(alloc)
+  return free, alloc
+
+
+async def wait_ready(args, timeout=30):
+  deadline = time.monotonic() + timeout
+  while time.monotonic() < deadline:
+    try:
+      await http_get(args.host, args.port, ROUTES['sensors'], args.timeout)
+      return
+    except (OSError, ValueError, asyncio.TimeoutError):
+      await asyncio.sleep(0.5)
+  raise SystemExit('Server {}:{} not ready'.format(args.host, args.port))
+
+
+async def bench(args):
+  mix = []
+  for item in args.mix.split(','):
+    route, weight = item.split('=')
+    if route not in ROUTES:
+      raise SystemExit('Unknown route {}'.format(route))
+    mix.append((route, float(weight)))
+
+  await wait_ready(args)
+  lag_start = await loop_lag(args)
+  stats = Stats()
+  start = time.monotonic()
+  deadline = start + args.duration
+  tasks = [client(args, mix, stats, deadline) for _ in range(args.clients)]
+  tasks.append(heap_monitor(args, stats, deadline))
+  await asyncio.gather(*tasks)
+  elapsed = time.monotonic() - start
+  await asyncio.sleep(args.timeout)     # Let the server drain
+  report = stats.report(elapsed, args)
+  report['checks'] = await checks(args, stats, lag_start)
+  report['loop_lag_ms'] = stats.loop_lag
+  return report
+
+
+async def checks(args, stats, lag_start):
+  """The server recovered from the load and the fan loop kept up"""
+  errors = (OSError, ValueError, asyncio.TimeoutError)
+  result = {}
+  try:
+    status, _ = await http_get(args.host, args.port, ROUTES['sensors'], args.timeout)
+  except errors as err:
+    status = type(err).__name__
+  result['sensors_after'] = {'value': status, 'ok': status == 200}
+  try:
+    lag_end = await loop_lag(args)
+    # The listening socket and the connection reading the metrics
+    sockets = await open_sockets(args)
+  except errors as err:
+    result['metrics_after'] = {'value': type(err).__name__, 'ok': False}
+    return result
+  stats.loop_lag = {bound: count - lag_start.get(bound, 0) for bound, count in lag_end.items()}
+  result['open_sockets'] = {'value': sockets, 'ok': sockets is not None and sockets <= 2}
+  if args.max_lag is not None:
+    over = lag_over(stats.loop_lag, args.max_lag)
+    result['loop_lag_over_{:g}ms'.format(args.max_lag)] = {'value': over, 'ok': over == 0}
+  return result
+
+
+def boot(args):
+  """Start the simulation in real time"""
+  cmd = args.interpreter.split() + ['-m', 'sim.run', '--realtime', '--port', str(args.port),
+                                    '--duration', str(args.duration + 60)]
+  if 'micropython' not in args.interpreter:
+    cmd.append('--tracemalloc')
+  return subprocess.Popen(cmd, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--target', default='127.0.0.1:8080', help='host:port [%(default)s]')
+  parser.add_argument('--boot', action='store_true', help='Start the simulation on the target port')
+  parser.add_argument('--interpreter', default=sys.executable,
+                      help='Interpreter used with --boot, python3 or micropython [%(default)s]')
+  parser.add_argument('--clients', type=int, default=4)
+  parser.add_argument('--duration', type=float, default=10.0, help='Seconds [%(default)s]')
+  parser.add_argument('--timeout', type=float, default=5.0, help='Request timeout [%(default)s]')
+  parser.add_argument('--mix', default='static=1,sensors=8,togglefan=1',
+                      help='Route weights [%(default)s]')
+  parser.add_argument('--heap-interval', type=float, default=1.0)
+  parser.add_argument('--max-lag', type=float, metavar='MS',
+                      help='Fail when the loop lag went over MS during the run')
+  parser.add_argument('--flood', action='store_true',
+                      help='Timeouts and resets are expected, only the checks can fail the run')
+  parser.add_argument('--output', help='Write the JSON report to this file')
+  args = parser.parse_args()
+  args.host, args.port = args.target.rsplit(':', 1)
+  args.port = int(args.port)
+
+  proc = boot(args) if args.boot else None
+  try:
+    report = asyncio.run(bench(args))
+  finally:
+    if proc:
+      proc.terminate()
+      proc.wait()
+
+  output = json.dumps(report, indent=2)
+  if args.output:
+    with open(args.output, 'w') as fd:
+      fd.write(output + '\n')
+  print(output)
+  failed = not all(check['ok'] for check in report['checks'].values())
+  if report['failure_count'] and not args.flood:
+    failed = True
+  return 1 if failed else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+#
+# (c) W6BSD Fred Cirera
+# Check the file LICENCE on https://github.com/0x9900/AtticFan
+#
+"""Check the light sleep mode against the task deadlines and over a day.
+
+LowPower.next_wakeup() and idle() are checked with zones, WiFi, MQTT and
+server stand-ins on the virtual clock: the sleep must end at the first
+sensor reading, WiFi check, MQTT check or schedule minute. Then a day is
+simulated with and without --low-power, the two runs must read the
+sensors and publish the same number of times, and the controller must
+only sleep while the fan is off. The exit status is the number of failed
+checks.
+
+  tools/check_lowpower.py [--duration SECONDS]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import sim    # noqa: E402
+from sim.clock import CLOCK    # noqa: E402
+
+EPOCH = 1782000000 - 1782000000 % 60     # On a minute boundary
+
+
+class Sensor:
+
+  def __init__(self, due):
+    self.next = due
+    self.lp = None
+
+  def due(self):
+    return self.next
+
+  def low_power(self, enable):
+    self.lp = enable
+
+
+class Schedule:
+  clock_set = False
+  rules = []
+
+
+class Zone:
+
+  def __init__(self, due, running=False):
+    self.sensor = Sensor(due)
+    self.schedule = Schedule()
+    self.running = running
+
+  def is_running(self):
+    return self.running
+
+
+class Stub:
+  """WiFi, MQTT or server, with the attributes read by LowPower"""
+
+  def __init__(self, **kwargs):
+    self.__dict__.update(kwargs)
+
+
+def setup():
+  sim.install()
+  sim.reset()
+  import atticfan
+  CLOCK.virtual = True
+  CLOCK.epoch = EPOCH
+  return atticfan
+
+
+def at(second):
+  """Set the clock to the second of a minute, return the tick counter"""
+  CLOCK._now = 600.0 + second
+  return CLOCK.ticks_ms()
+
+
+def later(ms, seconds):
+  return time.ticks_add(ms, int(seconds * 1000))
+
+
+def check_wakeup(atticfan, opts):
+  ms = at(10)
+  far = time.time() + 3600
+  wifi = Stub(due=later(ms, 3600), connecting=False)
+  zones = [Zone(time.time() + 20), Zone(far)]
+  power = atticfan.LowPower(zones, wifi)
+  assert power.next_wakeup() == atticfan.LP_MAX_SLEEP, 'capped by LP_MAX_SLEEP'
+
+  zones[0].sensor.next = time.time() + 4
+  zones[1].sensor.next = time.time() + 3
+  assert power.next_wakeup() == 3000, 'second zone reading {:d}'.format(power.next_wakeup())
+
+  power.mqtt = Stub(online=True, due=later(ms, 2.5))
+  assert power.next_wakeup() == 2500, 'MQTT check {:d}'.format(power.next_wakeup())
+  power.mqtt.online = False
+  assert power.next_wakeup() == 3000, 'MQTT offline'
+
+  wifi.due = later(ms, 1.5)
+  assert power.next_wakeup() == 1500, 'WiFi check {:d}'.format(power.next_wakeup())
+
+  # The schedule wakes up on each minute, once the clock is set
+  ms = at(56)
+  wifi.due = later(ms, 3600)
+  for zone in zones:
+    zone.sensor.next = time.time() + 3600
+  zones[1].schedule.rules = [{'start': '22:00'}]
+  assert power.next_wakeup() == atticfan.LP_MAX_SLEEP, 'schedule without a clock'
+  zones[1].schedule.clock_set = True
+  assert power.next_wakeup() == 4000, 'schedule minute {:d}'.format(power.next_wakeup())
+
+  # An overdue reading doesn't leave room for a sleep
+  zones[0].sensor.next = time.time() - 5
+  assert power.next_wakeup() < atticfan.LP_MIN_SLEEP, 'overdue reading'
+
+
+def check_idle(atticfan, opts):
+  wifi = Stub(due=0, connecting=False)
+  zones = [Zone(0), Zone(0)]
+  power = atticfan.LowPower(zones, wifi)
+  assert power.idle(), 'nothing to do'
+  zones[1].running = True
+  assert not power.idle(), 'fan running'
+  zones[1].running = False
+  wifi.connecting = True
+  assert not power.idle(), 'WiFi associating'
+  wifi.connecting = False
+  power.server = Stub(open_socks=['listen'])
+  assert power.idle(), 'only the listening socket'
+  power.server.open_socks.append('client')
+  assert not power.idle(), 'HTTP client connected'
+
+
+def simulate(duration, *options):
+  cmd = [sys.executable, '-m', 'sim.run', '--duration', str(duration)] + list(options)
+  output = subprocess.run(cmd, cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                          check=True).stdout
+  return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def check_day(atticfan, opts):
+  duration = opts.duration
+  ref = simulate(duration)
+  low = simulate(duration, '--low-power')
+  sleep = low['lightsleep']
+  assert low['wdt']['expired'] == 0, 'watchdog expired'
+  assert not any(task['restarts'] for task in low['tasks'].values()), low['tasks']
+  assert sleep['count'], 'never slept'
+  assert atticfan.LP_MIN_SLEEP <= sleep['min_ms'] and sleep['max_ms'] <= atticfan.LP_MAX_SLEEP, \
+    'sleep of {min_ms:d} to {max_ms:d} ms'.format(**sleep)
+
+  # Asleep only while the fan is off, and most of that time
+  idle = duration - low['fan']['runtime']
+  slept = sleep['total_ms'] / 1000
+  assert slept <= idle + 1, 'slept {:.0f}s, the fan was off {:.0f}s'.format(slept, idle)
+  assert slept >= idle * 0.8, 'slept {:.0f}s of {:.0f}s'.format(slept, idle)
+
+  # Nothing was missed
+  for key in ('sensor_conversions', 'mqtt_messages'):
+    assert low[key] == ref[key], '{} {:d} expected {:d}'.format(key, low[key], ref[key])
+  runtime, ref_runtime = low['fan']['runtime'], ref['fan']['runtime']
+  assert abs(runtime - ref_runtime) <= ref_runtime / 100, 'fan runtime {:d} {:d}'.format(
+    runtime, ref_runtime)
+
+
+CHECKS = (check_wakeup, check_idle, check_day)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--duration', type=int, default=86400,
+                      help='Simulated seconds of the day check [%(default)s]')
+  opts = parser.parse_args()
+  atticfan = setup()
+  failures = 0
+  for check in CHECKS:
+    try:
+      check(atticfan, opts)
+      print('{:20s} ok'.format(check.__name__))
+    except AssertionError as err:
+      failures += 1
+      print('{:20s} FAIL {}'.format(check.__name__, err))
+  return failures
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+#
+# (c) W6BSD Fred Cirera
+# Check the file LICENCE on https://github.com/0x9900/AtticFan
+#
+"""Check the variable speed fan curve and ramp on the simulated PWM.
+
+curve_duty() and ramp() are checked at and between the points of the
+curve, then a FAN in VARIABLE mode is driven through sim.machine.PWM
+and the duty cycle written to the pin is checked step by step. The exit
+status is the number of failed checks.
+
+  tools/check_pwm.py
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import sim    # noqa: E402
+
+CURVE = ((0.0, 0.3), (2.0, 0.5), (5.0, 1.0))
+FAN_PIN = 15
+
+
+class Sensor:
+  """The part of EnvSensor used by FAN, with a temperature set by the check"""
+  profile = 'control'
+  stale = False
+
+  def __init__(self, temp):
+    self.temp = temp
+
+  def adapt(self, threshold):
+    pass
+
+
+def setup():
+  sim.install()
+  sim.reset()
+  import atticfan
+  atticfan.STATE_FILE = tempfile.mkdtemp(prefix='atticfan-') + '/state.json'
+  atticfan.FAN_PWM = True
+  return atticfan
+
+
+def close(value, expected):
+  return abs(value - expected) < 1e-9
+
+
+def check_curve(atticfan):
+  points = {-1.0: 0.0, 0.0: 0.3, 1.0: 0.4, 2.0: 0.5, 3.5: 0.75, 5.0: 1.0, 12.0: 1.0}
+  for delta, duty in points.items():
+    value = atticfan.curve_duty(delta, CURVE)
+    assert close(value, duty), 'curve_duty({}) = {} expected {}'.format(delta, value, duty)
+
+
+def check_ramp(atticfan):
+  step = 0.05
+  assert close(atticfan.ramp(0.0, 1.0, step), 0.05), 'ramp up'
+  assert close(atticfan.ramp(1.0, 0.0, step), 0.95), 'ramp down'
+  assert close(atticfan.ramp(0.5, 0.52, step), 0.52), 'small change in one step'
+  assert close(atticfan.ramp(0.5, 0.5, step), 0.5), 'no change'
+
+
+def check_fan(atticfan):
+  from sim.machine import Pin
+  from sim.machine import PWM
+  sensor = Sensor(atticfan.TEMPERATURE_THRESHOLD + 10)
+  fan = atticfan.FAN(Pin(FAN_PIN, Pin.OUT, value=0), sensor, pwm=PWM)
+  fan.set_schedule([{'start': '22:00', 'status': atticfan.FAN.OFF}])
+  fan.status(atticfan.FAN.VARIABLE)
+  pin = Pin.pins[FAN_PIN]
+  limit = int(atticfan.FAN_RAMP * 1023) + 1
+
+  # Full speed, one ramp step per control loop
+  last, steps = 0, 0
+  while pin.pwm is None or pin.pwm.duty() < 1023:
+    fan.step()
+    steps += 1
+    duty = pin.pwm.duty()
+    assert 0 < duty - last <= limit, 'step {:d}: duty {:d} -> {:d}'.format(steps, last, duty)
+    assert steps <= 1 / atticfan.FAN_RAMP + 1, 'full speed not reached'
+    last = duty
+  assert fan.is_running() and close(fan.duty, 1.0)
+
+  # Between two points of the curve the duty settles on the interpolation
+  sensor.temp = fan.threshold + 1.0
+  target = atticfan.curve_duty(1.0)
+  for _ in range(40):
+    fan.step()
+    duty = pin.pwm.duty()
+    assert 0 <= last - duty <= limit, 'duty {:d} -> {:d}'.format(last, duty)
+    last = duty
+  assert close(fan.duty, target), 'duty {} expected {}'.format(fan.duty, target)
+  assert pin.pwm.duty() == int(target * 1023)
+
+  # Below the curve the fan ramps down to a stop
+  sensor.temp = fan.threshold - 1.0
+  for _ in range(40):
+    fan.step()
+  assert pin.pwm.duty() == 0 and not fan.is_running(), 'the fan is still running'
+
+  # Leaving the PWM mode gives the pin back to the relay
+  fan.status(atticfan.FAN.OFF)
+  assert pin.pwm is None and pin.value() == 0, 'PWM not released'
+  assert fan.schedule.rules, 'the schedule was lost'
+
+
+CHECKS = (check_curve, check_ramp, check_fan)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.parse_args()
+  atticfan = setup()
+  failures = 0
+  for check in CHECKS:
+    try:
+      check(atticfan)
+      print('{:20s} ok'.format(check.__name__))
+    except AssertionError as err:
+      failures += 1
+      print('{:20s} FAIL {}'.format(check.__name__, err))
+  return failures
+
+
+if __name__ == '__main__':
+  sys.exit(main())
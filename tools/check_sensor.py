@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+#
+# (c) W6BSD Fred Cirera
+# Check the file LICENCE on https://github.com/0x9900/AtticFan
+#
+"""Check the sensor filtering and the recovery from I2C faults.
+
+An EnvSensor reads a simulated BME280 on the virtual clock. The checks
+change the conditions it measures and inject faults through the
+simulated I2C bus: readings out of range and one-off spikes must be
+rejected, a confirmed jump accepted, a failing or stuck bus recovered,
+and the data must go stale, and the sensor snapshot change, while the
+sensor can't be read. The exit status is the number of failed checks.
+
+  tools/check_sensor.py
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import sim    # noqa: E402
+sim.install()
+from sim.bme280_model import BME280Model    # noqa: E402
+from sim.clock import CLOCK    # noqa: E402
+from sim.machine import I2C    # noqa: E402
+from sim.machine import I2CFaults    # noqa: E402
+from sim.machine import Pin    # noqa: E402
+
+ADDRESS = 0x76
+FAN_PIN = 15
+
+
+class Environment:
+  """What the simulated BME280 measures"""
+
+  def __init__(self):
+    self.temp = 25.0
+    self.humidity = 40.0
+    self.pressure = 1013.0
+
+  def __call__(self):
+    return self.temp, self.humidity, self.pressure
+
+
+def setup():
+  sim.reset()
+  import atticfan
+  CLOCK.virtual = True
+  atticfan.STATE_FILE = tempfile.mkdtemp(prefix='atticfan-') + '/state.json'
+  return atticfan
+
+
+def new_sensor(atticfan):
+  """Return a sensor with a first good reading, and its environment"""
+  sim.reset()
+  env = Environment()
+  I2C.devices[ADDRESS] = BME280Model(env)
+  i2c = I2C(scl=Pin(atticfan.I2C_SCL), sda=Pin(atticfan.I2C_SDA), freq=atticfan.I2C_FREQ)
+  sensor = atticfan.EnvSensor(i2c, ADDRESS)
+  assert read(sensor, 0) is not None, 'first reading'
+  return sensor, env
+
+
+def read(sensor, seconds):
+  """Let the time pass until the next reading is due, and read"""
+  CLOCK.advance(seconds or max(0, sensor.due() - CLOCK.time()))
+  return sensor.read_data()
+
+
+def temperature(sensor):
+  return round(sensor.compensated_data['temperature'], 1)
+
+
+def counter(atticfan, name):
+  return atticfan.METRICS.counters[name]
+
+
+class Corruption(I2CFaults):
+  """Flip the top bit of the temperature in each reading, no other fault"""
+
+  def transfer(self, device):
+    pass
+
+  def corrupt(self, data):
+    if len(data) < 8:
+      return data
+    self.counts['spikes'] += 1
+    data = bytearray(data)
+    data[3] ^= 0x80
+    return bytes(data)
+
+
+def check_plausibility(atticfan):
+  sensor, env = new_sensor(atticfan)
+  now = CLOCK.time()
+  # The driver clamps its values to the range of the BME280, a corrupted
+  # reading can't go out of SENSOR_LIMITS on the bus
+  for key, (low, high) in atticfan.SENSOR_LIMITS.items():
+    data = dict(sensor.compensated_data)
+    data[key] = high + 1
+    assert not sensor.plausible(data, now), '{} {} accepted'.format(key, data[key])
+    data[key] = low - 1
+    assert not sensor.plausible(data, now), '{} {} accepted'.format(key, data[key])
+
+  rejected = counter(atticfan, 'sensor_rejected')
+  I2C.faults = Corruption(0, scl=atticfan.I2C_SCL, sda=atticfan.I2C_SDA)
+  env.temp = 25.5
+  read(sensor, 0)
+  assert temperature(sensor) == 25.0, 'corrupted reading accepted'
+  assert counter(atticfan, 'sensor_rejected') > rejected, 'not counted'
+  assert sensor.health < 100, 'health {:d}'.format(sensor.health)
+  I2C.faults = None
+  read(sensor, 0)
+  assert temperature(sensor) == 25.5, 'no good reading after a corrupted one'
+
+
+def check_spike(atticfan):
+  sensor, env = new_sensor(atticfan)
+  # A single reading off by 20 degrees is dropped
+  env.temp = 45.0
+  read(sensor, 0)
+  assert temperature(sensor) == 25.0, 'spike accepted'
+  assert sensor.due() - CLOCK.time() <= atticfan.SENSOR_RETRY, 'no early retry'
+  env.temp = 25.2
+  read(sensor, 0)
+  assert temperature(sensor) == 25.2, 'reading after the spike {}'.format(temperature(sensor))
+
+  # The same jump, confirmed by the next reading, is accepted
+  env.temp = 45.0
+  read(sensor, 0)
+  assert temperature(sensor) == 25.2, 'jump accepted without a confirmation'
+  read(sensor, 0)
+  assert temperature(sensor) == 45.0, 'confirmed jump rejected {}'.format(temperature(sensor))
+
+  # A slow change within SENSOR_SLEW is never held back
+  for _ in range(5):
+    env.temp += atticfan.SENSOR_SPIKE
+    read(sensor, 60)
+    assert temperature(sensor) == round(env.temp, 1), 'slow change rejected'
+
+
+def check_faults(atticfan):
+  sensor, env = new_sensor(atticfan)
+  errors, recoveries = counter(atticfan, 'sensor_errors'), counter(atticfan, 'i2c_recoveries')
+
+  # Every transaction fails: the last reading is kept until it goes stale
+  I2C.faults = I2CFaults(1.0, scl=atticfan.I2C_SCL, sda=atticfan.I2C_SDA)
+  env.temp = 26.0
+  start = CLOCK.time()
+  while CLOCK.time() - start <= atticfan.SENSOR_STALE:
+    assert read(sensor, 0) is not None, 'the last reading was dropped'
+    assert temperature(sensor) == 25.0
+  assert sensor.stale, 'not stale after {:d}s'.format(CLOCK.time() - start)
+  assert counter(atticfan, 'sensor_errors') > errors, 'errors not counted'
+  assert counter(atticfan, 'i2c_recoveries') > recoveries, 'bus never recovered'
+  assert sensor.health < 50, 'health {:d}'.format(sensor.health)
+
+  # A bus left stuck by the device is freed by clocking SCL
+  I2C.faults.rate = 0
+  I2C.faults.stuck = 5
+  read(sensor, 0)
+  assert not I2C.faults.stuck and I2C.faults.counts['recoveries'], 'SDA still held low'
+  assert temperature(sensor) == 26.0 and not sensor.stale, 'no reading after the recovery'
+  health = sensor.health
+  read(sensor, 0)
+  assert sensor.health > health, 'health {:d} after {:d}'.format(sensor.health, health)
+
+  # A sensor reset by a brown-out is configured again
+  I2C.devices[ADDRESS].reset()
+  env.temp = 26.5
+  read(sensor, 0)
+  read(sensor, 0)
+  assert temperature(sensor) == 26.5, 'no reading after a sensor reset'
+
+
+def check_snapshot(atticfan):
+  """The snapshot changes when a reading fails and when the data goes stale,
+  in OFF mode as well where the fan doesn't read the sensor"""
+  sensor, env = new_sensor(atticfan)
+  fan = atticfan.FAN(Pin(FAN_PIN, Pin.OUT, value=0), sensor)
+  fan.status(atticfan.FAN.OFF)
+  snapshot = atticfan.SNAPSHOT
+  assert not sensor.stale
+  version = snapshot.version
+
+  # sensor.stale is what send_sensors() reads before it takes the ETag
+  I2C.faults = I2CFaults(1.0, scl=atticfan.I2C_SCL, sda=atticfan.I2C_SDA)
+  fan.step()
+  CLOCK.advance(sensor.due() - CLOCK.time())
+  assert not sensor.stale and snapshot.version != version, 'failed reading, same snapshot'
+  start = CLOCK.time()
+  while True:
+    CLOCK.advance(1)
+    fan.step()
+    version = snapshot.version
+    if sensor.stale:
+      break
+    assert CLOCK.time() - start <= atticfan.SENSOR_STALE, 'never stale'
+  assert snapshot.version != version, 'stale data, same snapshot'
+  version = snapshot.version
+  assert sensor.stale and snapshot.version == version, 'snapshot changed without a change'
+  assert not fan.is_running(), 'the fan started in OFF mode'
+
+  I2C.faults = None
+  CLOCK.advance(sensor.due() - CLOCK.time())
+  assert not sensor.stale and snapshot.version != version, 'fresh data, same snapshot'
+
+
+CHECKS = (check_plausibility, check_spike, check_faults, check_snapshot)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.parse_args()
+  atticfan = setup()
+  failures = 0
+  for check in CHECKS:
+    try:
+      check(atticfan)
+      print('{:20s} ok'.format(check.__name__))
+    except AssertionError as err:
+      failures += 1
+      print('{:20s} FAIL {}'.format(check.__name__, err))
+  return failures
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+#
+# (c) W6BSD Fred Cirera
+# Check the file LICENCE on https://github.com/0x9900/AtticFan
+#
+"""Check the syslog handler of lib/logging against a local UDP listener.
+
+The records are sent to a socket bound on 127.0.0.1 and the datagrams
+are checked for the batching, the RFC 5424 framing and the records
+dropped when the queue is full or the network fails. The exit status
+is the number of failed checks.
+
+  tools/check_syslog.py
+"""
+
+import argparse
+import os
+import re
+import socket
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The device logging module, not the standard library one
+sys.path.insert(0, os.path.join(ROOT, 'lib'))
+import logging    # noqa: E402
+
+# <PRI>VERSION TIMESTAMP HOSTNAME APP-NAME PROCID MSGID STRUCTURED-DATA MSG
+RFC5424 = re.compile(r'^<(\d{1,3})>1 (\d{4}-\d\d-\d\dT\d\d:\d\d:\d\dZ|-) (\S+) (\S+) - (\S+) - (.*)$')
+
+
+class Listener:
+
+  def __init__(self):
+    self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    self.sock.bind(('127.0.0.1', 0))
+    self.sock.settimeout(0.5)
+    self.port = self.sock.getsockname()[1]
+
+  def receive(self):
+    """Return the datagrams received until the socket is quiet"""
+    datagrams = []
+    while True:
+      try:
+        datagrams.append(self.sock.recv(4096))
+      except socket.timeout:
+        return datagrams
+
+  def close(self):
+    self.sock.close()
+
+
+def records(count, level=logging.INFO, name='check'):
+  now = time.time()
+  return [(now, level, name, 'record {:d}'.format(idx)) for idx in range(count)]
+
+
+def check_framing(listener):
+  handler = logging.SyslogHandler('127.0.0.1', listener.port, hostname='attic', appname='atticfan')
+  for level in (logging.DEBUG, logging.INFO, logging.WARNING, logging.ERROR, logging.CRITICAL):
+    handler.emit((time.time(), level, 'check', 'level {:d}'.format(level)))
+  handler.emit((0, logging.INFO, None, 'clock not set'))
+  handler.flush()
+  lines = [line for data in listener.receive() for line in data.decode().split('\n')]
+  assert len(lines) == 6, '{:d} records received'.format(len(lines))
+  for line in lines:
+    match = RFC5424.match(line)
+    assert match, 'not RFC 5424: {!r}'.format(line)
+    pri, stamp, host, app, msgid, msg = match.groups()
+    assert (host, app) == ('attic', 'atticfan'), line
+    assert int(pri) // 8 == handler.FACILITY, line
+  expected = [handler.FACILITY * 8 + sev for sev in (7, 6, 4, 3, 2, 6)]
+  assert [int(RFC5424.match(line).group(1)) for line in lines] == expected, lines
+  assert RFC5424.match(lines[-1]).group(2) == '-', 'timestamp before the clock is set'
+  assert RFC5424.match(lines[-1]).group(5) == '-', 'empty MSGID'
+
+
+def check_batching(listener):
+  handler = logging.SyslogHandler('127.0.0.1', listener.port, size=256, queue=64)
+  assert handler.sock.gettimeout() == 0, 'the socket is blocking'
+  for record in records(40):
+    handler.emit(record)
+  handler.flush()
+  datagrams = listener.receive()
+  lines = [line for data in datagrams for line in data.decode().split('\n')]
+  assert all(len(data) <= 256 for data in datagrams), 'datagram larger than the size'
+  assert 1 < len(datagrams) < 40, '{:d} datagrams for 40 records'.format(len(datagrams))
+  assert [line.rsplit(' ', 1)[-1] for line in lines] == [str(idx) for idx in range(40)], \
+    'records lost or out of order'
+  assert handler.dropped == 0
+
+
+def check_overflow(listener):
+  handler = logging.SyslogHandler('127.0.0.1', listener.port, size=128, queue=2)
+  for record in records(40):
+    handler.emit(record)
+  handler.flush()
+  lines = [line for data in listener.receive() for line in data.decode().split('\n')]
+  assert len(lines) + handler.dropped == 40, '{:d} sent {:d} dropped'.format(len(lines),
+                                                                            handler.dropped)
+  assert handler.dropped > 0, 'nothing dropped'
+  # The newest records are kept
+  assert lines[-1].endswith('record 39'), lines[-1]
+
+
+def check_send_error(listener):
+  handler = logging.SyslogHandler('127.0.0.1', listener.port, size=128)
+  for record in records(10):
+    handler.emit(record)
+  handler.sock.close()
+  start = time.monotonic()
+  handler.flush()
+  assert time.monotonic() - start < 0.1, 'flush blocked'
+  assert handler.dropped == 10, '{:d} dropped'.format(handler.dropped)
+  assert not handler.datagrams
+
+
+CHECKS = (check_framing, check_batching, check_overflow, check_send_error)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.parse_args()
+  failures = 0
+  for check in CHECKS:
+    listener = Listener()
+    try:
+      check(listener)
+      print('{:20s} ok'.format(check.__name__))
+    except AssertionError as err:
+      failures += 1
+      print('{:20s} FAIL {}'.format(check.__name__, err))
+    finally:
+      listener.close()
+  return failures
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+#
+# (c) W6BSD Fred Cirera
+# Check the file LICENCE on https://github.com/0x9900/AtticFan
+#
+"""Poll a fleet of controllers and record their sensors.
+
+Every device is polled on its own schedule with its own timeout, a
+dead controller never delays the others. The readings are appended to
+a CSV file and the latest state of the fleet is served as a web page
+and as JSON.
+
+  tools/fleet.py attic=192.168.1.20 garage=192.168.1.21:80 --serve 8000
+  tools/fleet.py --file devices.txt --output fleet.csv
+  tools/fleet.py --sim 3 --rounds 5       # Against simulated controllers
+
+The device file has one `name host[:port]` per line.
+"""
+
+import argparse
+import asyncio
+import csv
+import json
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SENSORS = '/api/v1/sensors'
+SIM_PORT = 8180
+
+FIELDS = ('time', 'device', 'status', 'fan', 'running', 'duty', 'temp', 'humidity',
+          'pressure', 'dewpoint', 'abs_humidity', 'threshold', 'runtime', 'kwh', 'latency_ms',
+          'error')
+
+PAGE = """<!DOCTYPE html><html><head><title>AtticFan fleet</title>
+<meta http-equiv="refresh" content="{refresh:d}">
+<style>body{{font-family:Helvetica}}td,th{{padding:4px 10px;text-align:right}}
+.down{{color:#cc3300}}</style></head><body><h2>AtticFan fleet</h2>
+<table><tr><th>Device</th><th>Temp</th><th>Humidity</th><th>Dew point</th><th>Abs humidity</th>
+<th>Pressure</th><th>Fan</th>
+<th>Threshold</th><th>Last seen</th></tr>
+{rows}</table></body></html>
+"""
+ROW = ('<tr class="{cls}"><td>{name}</td><td>{temp}</td><td>{humidity}</td><td>{dewpoint}</td>'
+       '<td>{abs_humidity}</td><td>{pressure}</td>'
+       '<td>{fan}</td><td>{threshold}</td><td>{seen}</td></tr>')
+MODES = ('Off', 'On', 'Automatic', 'Variable', 'Humidity')
+
+
+class Device:
+  """One controller, its HTTP connection and its last reading"""
+
+  def __init__(self, name, host, port=80):
+    self.name = name
+    self.host = host
+    self.port = port
+    self.reader = self.writer = None
+    self.etag = None
+    self.data = None
+    self.seen = None
+    self.error = None
+
+  def close(self):
+    if self.writer:
+      self.writer.close()
+    self.reader = self.writer = None
+
+  async def request(self, path):
+    """GET `path`, keep the connection open if the device allows it"""
+    if not self.writer:
+      self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+    lines = ['GET {} HTTP/1.1'.format(path), 'Host: {}'.format(self.host),
+             'Connection: keep-alive']
+    if self.etag:
+      lines.append('If-None-Match: {}'.format(self.etag))
+    self.writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode())
+    await self.writer.drain()
+
+    status = await self.reader.readline()
+    if not status.startswith(b'HTTP/'):
+      raise ValueError('invalid response')
+    headers = {}
+    while True:
+      line = await self.reader.readline()
+      if line in (b'', b'\r\n', b'\n'):
+        break
+      key, _, val = line.decode().partition(':')
+      headers[key.strip().lower()] = val.strip()
+    code = int(status.split()[1])
+    if 'content-length' in headers:
+      body = await self.reader.readexactly(int(headers['content-length']))
+    elif code == 304:
+      body = b''
+    else:
+      body = await self.reader.read()
+    if headers.get('connection', '').lower() == 'close' or 'content-length' not in headers:
+      self.close()
+    return code, headers, body
+
+  async def poll(self, timeout):
+    """Fetch the sensors, return the latency in ms. A 304 keeps the last reading."""
+    start = time.monotonic()
+    try:
+      code, headers, body = await asyncio.wait_for(self.request(SENSORS), timeout)
+      if code == 200:
+        self.data = json.loads(body)
+        self.etag = headers.get('etag')
+      elif code != 304:
+        raise ValueError('HTTP {:d}'.format(code))
+      self.seen = time.time()
+      self.error = None
+    except asyncio.TimeoutError:
+      self.close()
+      self.error = 'timeout'
+    except (OSError, ValueError, asyncio.IncompleteReadError) as err:
+      self.close()
+      self.error = '{}: {}'.format(type(err).__name__, err)
+    return round((time.monotonic() - start) * 1000, 1)
+
+  def row(self, latency):
+    data = self.data if not self.error and self.data else {}
+    row = {key: data.get(key, '') for key in FIELDS}
+    row.update(time=int(time.time()), device=self.name, status='down' if self.error else 'up',
+               latency_ms=latency, error=self.error or '')
+    return row
+
+  def view(self):
+    return {'name': self.name, 'address': '{}:{:d}'.format(self.host, self.port),
+            'up': not self.error, 'error': self.error, 'seen': self.seen, 'data': self.data}
+
+
+class Recorder:
+  """Append only CSV time series"""
+
+  def __init__(self, path):
+    new = not os.path.exists(path) or os.path.getsize(path) == 0
+    if not new:
+      with open(path, newline='') as fd:
+        if tuple(next(csv.reader(fd), ())) != FIELDS:
+          raise ValueError('{}: the columns have changed, use another file'.format(path))
+    self.fd = open(path, 'a', newline='')
+    self.writer = csv.DictWriter(self.fd, FIELDS)
+    if new:
+      self.writer.writeheader()
+
+  def write(self, row):
+    self.writer.writerow(row)
+    self.fd.flush()
+
+  def close(self):
+    self.fd.close()
+
+
+async def watch(device, args, recorder):
+  count = 0
+  while not args.rounds or count < args.rounds:
+    count += 1
+    start = time.monotonic()
+    latency = await device.poll(args.timeout)
+    recorder.write(device.row(latency))
+    if device.error:
+      print('{}: {}'.format(device.name, device.error), file=sys.stderr)
+    await asyncio.sleep(max(0, args.interval - (time.monotonic() - start)))
+  device.close()
+
+
+def render(devices, refresh):
+  rows = []
+  for dev in devices:
+    data = dev.data or {}
+    fmt = lambda key, spec: format(data[key], spec) if data.get(key) is not None else '-'
+    rows.append(ROW.format(
+      cls='down' if dev.error else 'up', name=dev.name, temp=fmt('temp', '.1f'),
+      humidity=fmt('humidity', '.1f'), dewpoint=fmt('dewpoint', '.1f'),
+      abs_humidity=fmt('abs_humidity', '.1f'), pressure=fmt('pressure', '.1f'),
+      fan='{} ({})'.format(MODES[data['fan']], 'on' if data['running'] else 'off')
+      if 'fan' in data else '-',
+      threshold=fmt('threshold', '.1f'),
+      seen=time.strftime('%H:%M:%S', time.localtime(dev.seen)) if dev.seen else 'never'))
+  return PAGE.format(refresh=refresh, rows='\n'.join(rows))
+
+
+async def serve(devices, args):
+  async def handle(reader, writer):
+    try:
+      request = await asyncio.wait_for(reader.readline(), args.timeout)
+      while (await asyncio.wait_for(reader.readline(), args.timeout)) not in (b'', b'\r\n'):
+        pass
+      path = request.split()[1] if len(request.split()) > 1 else b'/'
+      if path == b'/fleet.json':
+        body, ctype = json.dumps([dev.view() for dev in devices]), 'application/json'
+      else:
+        body, ctype = render(devices, int(args.interval)), 'text/html'
+      body = body.encode()
+      writer.write('HTTP/1.1 200 OK\r\nContent-Type: {}\r\nContent-Length: {:d}\r\n'
+                   'Connection: close\r\n\r\n'.format(ctype, len(body)).encode() + body)
+      await writer.drain()
+    except (OSError, asyncio.TimeoutError):
+      pass
+    finally:
+      writer.close()
+
+  server = await asyncio.start_server(handle, '0.0.0.0', args.serve)
+  print('Fleet view on http://localhost:{:d}/'.format(args.serve), file=sys.stderr)
+  return server
+
+
+async def fleet(devices, args, recorder):
+  server = await serve(devices, args) if args.serve else None
+  try:
+    await asyncio.gather(*(watch(dev, args, recorder) for dev in devices))
+  finally:
+    recorder.close()
+    if server:
+      server.close()
+  return [dev.view() for dev in devices]
+
+
+def parse_device(spec, idx):
+  name, _, address = spec.rpartition('=')
+  host, _, port = address.partition(':')
+  return Device(name or host or 'device{:d}'.format(idx), host, int(port or 80))
+
+
+def boot(count, args):
+  """Start `count` simulated controllers in real time"""
+  procs = []
+  for idx in range(count):
+    cmd = [sys.executable, '-m', 'sim.run', '--realtime', '--port', str(SIM_PORT + idx)]
+    if args.rounds:
+      cmd += ['--duration', str(args.rounds * args.interval + 60)]
+    procs.append(subprocess.Popen(cmd, cwd=ROOT, stdout=subprocess.DEVNULL,
+                                  stderr=subprocess.DEVNULL))
+  time.sleep(5)
+  return procs
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('devices', nargs='*', help='[name=]host[:port]')
+  parser.add_argument('--file', help='Device list, one "name host[:port]" per line')
+  parser.add_argument('--sim', type=int, default=0, metavar='N',
+                      help='Start N simulated controllers on port {:d} and up'.format(SIM_PORT))
+  parser.add_argument('--interval', type=float, default=10.0, help='Seconds [%(default)s]')
+  parser.add_argument('--timeout', type=float, default=3.0, help='Per device [%(default)s]')
+  parser.add_argument('--rounds', type=int, default=0, help='Stop after N polls [forever]')
+  parser.add_argument('--output', default='fleet.csv', help='CSV file [%(default)s]')
+  parser.add_argument('--serve', type=int, metavar='PORT', help='Serve the fleet view')
+  args = parser.parse_args()
+
+  specs = list(args.devices)
+  if args.file:
+    with open(args.file) as fd:
+      for line in fd:
+        line = line.split('#', 1)[0].split()
+        if line:
+          specs.append('='.join(line))
+  specs += ['sim{:d}=127.0.0.1:{:d}'.format(idx, SIM_PORT + idx) for idx in range(args.sim)]
+  if not specs:
+    parser.error('no device')
+  devices = [parse_device(spec, idx) for idx, spec in enumerate(specs)]
+  try:
+    recorder = Recorder(args.output)
+  except ValueError as err:
+    parser.error(err)
+
+  procs = boot(args.sim, args) if args.sim else []
+  try:
+    views = asyncio.run(fleet(devices, args, recorder))
+  except KeyboardInterrupt:
+    return 0
+  finally:
+    for proc in procs:
+      proc.terminate()
+      proc.wait()
+  if args.rounds:
+    print(json.dumps(views, indent=2))
+  return 0 if all(view['up'] for view in views) else 1
+
+
+if __name__ == '__main__':
+  sys.exit(main())
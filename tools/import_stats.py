@@ -0,0 +1,51 @@
+#
+# (c) W6BSD Fred Cirera
+# Check the file LICENCE on https://github.com/0x9900/AtticFan
+#
+# Measure the import time and the heap used by each module, and the
+# file it was loaded from. Run it with the MicroPython unix port after
+# `./flash.sh build`, from the top of the repository:
+#   micropython tools/import_stats.py [module ...]
+#
+# CPython can't load the .mpy files, python3 times the sources.
+#
+
+import gc
+import os
+import sys
+import time
+
+ROOT = '/'.join(__file__.split('/')[:-2]) or '.'
+BUILD = ROOT + '/build'
+
+if sys.platform != 'esp32':
+  # Not running on an ESP32, use the simulated hardware.
+  sys.path.insert(0, ROOT)
+  import sim
+  sim.install()
+  if sim.CPYTHON:
+    import tracemalloc
+    tracemalloc.start()
+
+def main():
+  try:
+    os.stat(BUILD + '/atticfan.mpy')
+  except OSError:
+    print('{}/atticfan.mpy not found, run ./flash.sh build first'.format(BUILD))
+    sys.exit(1)
+  # Ahead of the sources that sim.install() put on the path
+  sys.path[:0] = [BUILD, BUILD + '/lib']
+
+  modules = sys.argv[1:] or ['logging', 'bme280', 'psychro', 'atticfan']
+  for name in modules:
+    gc.collect()
+    free = gc.mem_free()
+    start = time.ticks_us()
+    module = __import__(name)
+    elapsed = time.ticks_diff(time.ticks_us(), start)
+    gc.collect()
+    print('{:12s} {:8d} us {:8d} bytes  {}'.format(name, elapsed, free - gc.mem_free(),
+                                                   getattr(module, '__file__', 'frozen')))
+  print('Free heap after import: {:d} bytes'.format(gc.mem_free()))
+
+main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+#
+# (c) W6BSD Fred Cirera
+# Check the file LICENCE on https://github.com/0x9900/AtticFan
+#
+"""Build the dashboard served by the controller.
+
+The stylesheets linked from the page are inlined, the page is minified
+and a gzip copy is written next to it. The controller sends the .gz
+file to the browsers that accept it.
+
+  tools/mkhtml.py html/index.html build/html
+"""
+
+import argparse
+import gzip
+import os
+import re
+import sys
+
+LINK = re.compile(r'<link href="/([\w.-]+\.css)" rel="stylesheet">')
+LINK_TAG = re.compile(r'<link [^>]*>')
+EXTERNAL = re.compile(r'<(?:script|link)[^>]*(?:src|href)="(?:https?:)?//')
+
+
+def minify_css(css):
+  css = re.sub(r'/\*.*?\*/', '', css, flags=re.S)
+  css = re.sub(r'\s+', ' ', css)
+  css = re.sub(r'\s*([{}:;,>])\s*', r'\1', css)
+  return css.replace(';}', '}').strip()
+
+
+def minify_js(js):
+  lines = []
+  for line in js.splitlines():
+    line = line.strip()
+    if line and not line.startswith('//'):
+      lines.append(line)
+  return '\n'.join(lines)
+
+
+def minify_html(html):
+  parts = re.split(r'(<script>.*?</script>|<style>.*?</style>)', html, flags=re.S)
+  for idx, part in enumerate(parts):
+    if part.startswith('<script>'):
+      parts[idx] = '<script>' + minify_js(part[8:-9]) + '</script>'
+    elif not part.startswith('<style>'):
+      part = re.sub(r'<!--.*?-->', '', part, flags=re.S)
+      part = re.sub(r'\s+', ' ', part)
+      part = re.sub(r'^\s+<', '<', part)
+      part = re.sub(r'>\s+$', '>', part)
+      parts[idx] = re.sub(r'>\s+<', '><', part)
+  return ''.join(parts).strip()
+
+
+def inline_css(html, root):
+  def style(match):
+    with open(os.path.join(root, match.group(1))) as fd:
+      return '<style>' + minify_css(fd.read()) + '</style>'
+  return LINK.sub(style, html)
+
+
+def count_requests(html):
+  """Number of requests a browser makes to render the page"""
+  return 1 + len(re.findall(r'<script [^>]*src=', html)) + sum(
+    1 for tag in LINK_TAG.findall(html) if 'data:' not in tag)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('source', help='HTML page')
+  parser.add_argument('output', help='Output directory')
+  args = parser.parse_args()
+
+  root = os.path.dirname(args.source)
+  with open(args.source) as fd:
+    source = fd.read()
+  html = minify_html(inline_css(source, root))
+  external = EXTERNAL.findall(html)
+  if external:
+    print('Warning: the page still loads {:d} external resources'.format(len(external)),
+          file=sys.stderr)
+
+  os.makedirs(args.output, exist_ok=True)
+  name = os.path.join(args.output, os.path.basename(args.source))
+  data = html.encode()
+  with open(name, 'wb') as fd:
+    fd.write(data)
+  with open(name + '.gz', 'wb') as fd:
+    fd.write(gzip.compress(data, 9, mtime=0))
+
+  before = len(source.encode()) + sum(os.path.getsize(os.path.join(root, css))
+                                      for css in LINK.findall(source))
+  print('{}: {:d} requests {:d} bytes -> {:d} request {:d} bytes, {:d} bytes gzipped'.format(
+    name, count_requests(source), before, count_requests(html), len(data),
+    os.path.getsize(name + '.gz')))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+#
+# (c) W6BSD Fred Cirera
+# Check the file LICENCE on https://github.com/0x9900/AtticFan
+#
+"""Push the application to controllers over the air.
+
+The SHA-256 manifest of the build directory is sent to each device,
+which answers with the files that changed. Only those are uploaded,
+then the device swaps them in and reboots. The devices are updated in
+parallel.
+
+  ./flash.sh build
+  tools/ota_push.py --token SECRET attic=192.168.1.20 garage=192.168.1.21
+  tools/ota_push.py --sim 3          # Against simulated controllers
+
+wificonfig holds per-device settings and is only pushed with
+--include wificonfig.mpy. The token can also be set with the OTA_TOKEN
+environment variable.
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SIM_PORT = 8280
+SIM_TOKEN = 'sim-token'
+EXCLUDE = ('wificonfig.mpy',)
+RETRIES = 5         # Attempts when the device rate limits the requests
+
+
+def manifest(build, include=()):
+  """Return {path: sha256} of the application files in the build directory"""
+  files = {}
+  for dirpath, _, filenames in os.walk(build):
+    for filename in filenames:
+      path = os.path.relpath(os.path.join(dirpath, filename), build).replace(os.sep, '/')
+      if path in EXCLUDE and path not in include:
+        continue
+      with open(os.path.join(dirpath, filename), 'rb') as fd:
+        files[path] = hashlib.sha256(fd.read()).hexdigest()
+  return files
+
+
+class Device:
+
+  def __init__(self, name, host, port=80):
+    self.name = name
+    self.host = host
+    self.port = port
+
+  async def post(self, path, body, token, timeout, headers=None):
+    """POST and return the decoded JSON answer. Retry when throttled."""
+    lines = ['POST {} HTTP/1.1'.format(path), 'Host: {}'.format(self.host),
+             'Authorization: Bearer {}'.format(token),
+             'Content-Length: {:d}'.format(len(body))]
+    lines += ['{}: {}'.format(key, val) for key, val in (headers or {}).items()]
+    request = ('\r\n'.join(lines) + '\r\n\r\n').encode() + body
+    for attempt in range(RETRIES):
+      reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port),
+                                              timeout)
+      try:
+        writer.write(request)
+        await writer.drain()
+        data = await asyncio.wait_for(reader.read(), timeout)
+      finally:
+        writer.close()
+      head, _, payload = data.partition(b'\r\n\r\n')
+      status = int(head.split(None, 2)[1])
+      if status == 429:
+        await asyncio.sleep(2 ** attempt)
+        continue
+      if status != 200:
+        raise ValueError('{} HTTP {:d}'.format(path, status))
+      return json.loads(payload)
+    raise ValueError('{} rate limited'.format(path))
+
+  async def push(self, build, files, args):
+    start = time.monotonic()
+    result = {'device': self.name, 'address': '{}:{:d}'.format(self.host, self.port),
+              'sent': [], 'bytes': 0}
+    try:
+      answer = await self.post('/api/v1/ota/manifest', json.dumps(files).encode(), args.token,
+                               args.timeout)
+      for path in answer['need']:
+        with open(os.path.join(build, path), 'rb') as fd:
+          data = fd.read()
+        await self.post('/api/v1/ota/file/' + path, data, args.token, args.timeout,
+                        {'X-SHA256': files[path]})
+        result['sent'].append(path)
+        result['bytes'] += len(data)
+      if result['sent'] and not args.dry_run:
+        answer = await self.post('/api/v1/ota/commit', b'', args.token, args.timeout)
+        result['status'] = answer.get('status', 'ok')
+      else:
+        result['status'] = 'up to date' if not result['sent'] else 'staged'
+    except (OSError, ValueError, KeyError, asyncio.TimeoutError) as err:
+      result['status'] = 'error'
+      result['error'] = '{}: {}'.format(type(err).__name__, err)
+    result['elapsed'] = round(time.monotonic() - start, 3)
+    return result
+
+
+async def push_all(devices, build, files, args):
+  semaphore = asyncio.Semaphore(args.parallel)
+  async def push(device):
+    async with semaphore:
+      return await device.push(build, files, args)
+  return await asyncio.gather(*(push(dev) for dev in devices))
+
+
+def parse_device(spec):
+  name, _, address = spec.rpartition('=')
+  host, _, port = address.partition(':')
+  return Device(name or host, host, int(port or 80))
+
+
+def boot(count):
+  """Start `count` simulated controllers in real time"""
+  procs = []
+  for idx in range(count):
+    cmd = [sys.executable, '-m', 'sim.run', '--realtime', '--port', str(SIM_PORT + idx),
+           '--duration', '120']
+    procs.append(subprocess.Popen(cmd, cwd=ROOT, stdout=subprocess.DEVNULL,
+                                  stderr=subprocess.DEVNULL))
+  time.sleep(5)
+  return procs
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('devices', nargs='*', help='[name=]host[:port]')
+  parser.add_argument('--build', default=os.path.join(ROOT, 'build'),
+                      help='Directory made by ./flash.sh build [%(default)s]')
+  parser.add_argument('--include', action='append', default=[],
+                      help='Also push this excluded file')
+  parser.add_argument('--token', default=os.environ.get('OTA_TOKEN'))
+  parser.add_argument('--parallel', type=int, default=8, help='Devices at once [%(default)s]')
+  parser.add_argument('--timeout', type=float, default=10.0, help='Per request [%(default)s]')
+  parser.add_argument('--dry-run', action='store_true', help="Upload but don't swap or reboot")
+  parser.add_argument('--sim', type=int, default=0, metavar='N',
+                      help='Start N simulated controllers on port {:d} and up'.format(SIM_PORT))
+  args = parser.parse_args()
+
+  devices = [parse_device(spec) for spec in args.devices]
+  devices += [Device('sim{:d}'.format(idx), '127.0.0.1', SIM_PORT + idx)
+              for idx in range(args.sim)]
+  if not devices:
+    parser.error('no device')
+  if args.sim and not args.token:
+    args.token = SIM_TOKEN
+  if not args.token:
+    parser.error('--token or OTA_TOKEN is required')
+  if not os.path.isdir(args.build):
+    parser.error('{} not found, run ./flash.sh build first'.format(args.build))
+
+  files = manifest(args.build, args.include)
+  procs = boot(args.sim) if args.sim else []
+  try:
+    results = asyncio.run(push_all(devices, args.build, files, args))
+  finally:
+    for proc in procs:
+      proc.terminate()
+      proc.wait()
+  print(json.dumps(results, indent=2))
+  return 1 if any(res['status'] == 'error' for res in results) else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())